@@ -0,0 +1,340 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "scripts"))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "model_evaluation"))
+
+import matplotlib
+matplotlib.use("Agg")
+
+from nlst_actual import build_actual
+from sybil_eval import align, counts_to_matrix
+from subgroups import SubgroupIndex
+from evaluate import get_results
+from models import Models, LinearModel, export_linear_model
+from train_svm import build_model
+
+"""
+Benchmarks for the evaluation scripts on synthetic NLST-shaped data.
+
+For each size (number of screens, i.e. rows of the NLST screen file), the
+following tables are generated: screen, prsn (one row per participant, 3
+screens each), the Sybil data split and Sybil predictions (about 1.2 series
+per screen). The benchmarks time:
+
+- truth: building the truth table (nlst_actual.build_actual).
+- alignment: aligning predictions with the truth (sybil_eval.align).
+- filtering: filter expressions and intersectional subgroups (subgroups.py).
+- metrics: ROC/PR/confusion matrix tables for 6 horizons (evaluate.py,
+sybil_eval.counts_to_matrix).
+- plcom2012, svm_joblib, svm_npz: model scoring (models.py).
+
+The scaling exponent of each benchmark is estimated from consecutive sizes
+(1 = linear, 2 = quadratic). Before a size is run, its time is predicted from
+the smaller sizes (probes at 1/100 and 1/10 of the first size are run first),
+and it is skipped if the prediction exceeds --budget seconds.
+
+Results are compared against a recorded baseline (baseline.json), and a
+benchmark slower than --tolerance times its baseline is reported as a
+regression. Baselines depend on the machine; record new ones with --record.
+"""
+
+DEFAULT_SIZES = [75000, 750000, 7500000]
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "baseline.json")
+N_PREDICTION_YEARS = 6
+# Smallest probe size, so that every horizon has cases.
+MIN_PROBE = 3000
+
+def make_tables(n_screens, seed=0):
+    # Synthetic NLST-shaped tables. 3 screens per participant, some missing
+    # screening days, about 8% of participants diagnosed.
+    rng = np.random.default_rng(seed)
+    n_prsn = max(n_screens // 3, 1)
+    pids = np.arange(100000, 100000 + n_prsn)
+    prsn = pd.DataFrame({
+        "pid": pids,
+        "age": rng.integers(55, 75, n_prsn),
+        "gender": rng.integers(1, 3, n_prsn),
+        "race": rng.choice([1, 2, 3, 4, 5, 6, 7, 95, 96, 98, 99], n_prsn,
+            p=[0.88, 0.04, 0.02, 0.01, 0.01, 0.01, 0.01, 0.005, 0.005,
+                0.005, 0.005]),
+        "scr_days0": 0.0,
+        "scr_days1": rng.integers(330, 400, n_prsn).astype(float),
+        "scr_days2": rng.integers(700, 770, n_prsn).astype(float),
+        "candx_days": np.where(rng.random(n_prsn) < 0.04,
+            rng.integers(0, 2500, n_prsn), np.nan)
+    })
+    # Every 25th participant is diagnosed, so that small sizes have cases.
+    prsn.loc[::25, "candx_days"] = rng.integers(0, 2500, len(prsn[::25]))
+    prsn.loc[rng.random(n_prsn) < 0.03, "scr_days2"] = np.nan
+    screen = pd.DataFrame({
+        "pid": np.repeat(pids, 3)[:n_screens],
+        "study_yr": np.tile([0, 1, 2], n_prsn)[:n_screens]
+    })
+    in_split = rng.random(n_prsn) < 0.6
+    split = pd.DataFrame({
+        "pid": pids[in_split],
+        "split": rng.choice(["train", "dev", "test"], in_split.sum(),
+            p=[0.7, 0.15, 0.15])
+    })
+    # About 1.2 series per screen.
+    series = np.repeat(np.arange(n_screens),
+        rng.choice([1, 2], n_screens, p=[0.8, 0.2]))
+    prediction = screen.iloc[series].reset_index(drop=True)
+    prediction["unique_id"] = "series"
+    risk = np.cumsum(rng.random((len(prediction), N_PREDICTION_YEARS)) * 0.02,
+        axis=1)
+    for year in range(1, N_PREDICTION_YEARS + 1):
+        prediction["pred_yr" + str(year)] = risk[:, year - 1].round(5)
+    plco = pd.DataFrame({
+        "age": rng.integers(55, 75, n_screens),
+        "race": rng.choice([1, 2, 3, 4, 5, 8], n_screens),
+        "education": rng.integers(1, 7, n_screens),
+        "bmi": rng.normal(27, 5, n_screens),
+        "copd": rng.integers(0, 2, n_screens),
+        "cancer_hist": rng.integers(0, 2, n_screens),
+        "family_hist_lung_cancer": rng.integers(0, 2, n_screens),
+        "smoking_status": rng.integers(0, 2, n_screens),
+        "cig_day": rng.integers(10, 60, n_screens),
+        "smoking_years": rng.integers(20, 50, n_screens),
+        "quit_years": rng.integers(0, 15, n_screens)
+    })
+    return {"screen": screen, "prsn": prsn, "split": split,
+        "prediction": prediction, "plco": plco}
+
+def actual_for(tables):
+    # Truth table used by the downstream benchmarks, built without the
+    # (timed) row-by-row lookups of build_actual.
+    if "actual" not in tables:
+        screen = tables["screen"].merge(tables["prsn"], on="pid", how="left")
+        days = screen["candx_days"] - screen["scr_days0"]
+        actual = screen[["pid", "study_yr", "age", "gender", "race"]].copy()
+        actual["days_to_diagnosis"] = days.fillna(-1).astype(int)
+        for year in range(1, N_PREDICTION_YEARS + 1):
+            actual["canc_yr" + str(year)] = (
+                (actual["days_to_diagnosis"] != -1) &
+                (actual["days_to_diagnosis"] <= year * 365)).astype(int)
+        tables["actual"] = actual
+    return tables["actual"]
+
+def aligned_for(tables):
+    if "aligned" not in tables:
+        tables["aligned"] = align(actual_for(tables), tables["prediction"])
+    return tables["aligned"]
+
+def svm_for(tables, directory):
+    # A small linear SVM pipeline on the PLCO features, saved as .joblib and
+    # exported as .npz before timing, so that only scoring is timed.
+    if "svm" not in tables:
+        X = tables["plco"].iloc[:5000]
+        y = (X["age"] + 5 * X["copd"] + np.random.default_rng(0).normal(
+            0, 3, len(X)) > 70).astype(int)
+        model = build_model("linear").fit(X, y)
+        os.makedirs(directory, exist_ok=True)
+        import joblib
+        joblib.dump(model, os.path.join(directory, "svm_1.joblib"))
+        export_linear_model(model, os.path.join(directory, "svm_npz_1.npz"))
+        tables["svm"] = directory
+    return tables["svm"]
+
+def bench_truth(tables):
+    build_actual(tables["split"], tables["screen"], tables["prsn"])
+
+def bench_alignment(tables):
+    align(actual_for(tables), tables["prediction"])
+
+def bench_filtering(tables):
+    index = SubgroupIndex(aligned_for(tables))
+    index.evaluate_all(["race:2:e | race:3:e", "gender:1:e"])
+    index.evaluate("~race:1,4:in & age:65:ge")
+    for key, bitmap in index.intersections(["race", "gender", "study_yr"]):
+        index.mask(bitmap)
+
+def bench_metrics(tables):
+    aligned = aligned_for(tables)
+    for year in range(1, N_PREDICTION_YEARS + 1):
+        y = aligned["canc_yr" + str(year)].to_numpy()
+        scores = aligned["pred_yr" + str(year)].to_numpy()
+        get_results(y, scores, f"Year {year}")
+        counts_to_matrix(y, scores, 0.05)
+
+def bench_plcom2012(tables):
+    Models(tables["svm"]).plcom2012(tables["plco"])
+
+def bench_svm_joblib(tables):
+    Models(tables["svm"], cache_size=1).get_models("svm_1")["svm_1"](
+        tables["plco"])
+
+def bench_svm_npz(tables):
+    LinearModel(os.path.join(tables["svm"], "svm_npz_1.npz")).predict_proba(
+        tables["plco"])
+
+BENCHMARKS = {
+    "truth": bench_truth,
+    "alignment": bench_alignment,
+    "filtering": bench_filtering,
+    "metrics": bench_metrics,
+    "plcom2012": bench_plcom2012,
+    "svm_joblib": bench_svm_joblib,
+    "svm_npz": bench_svm_npz
+}
+
+def time_benchmark(function, tables, repeat):
+    # Best of `repeat` runs, in seconds. The output of the scripts (e.g. one
+    # line per missing screening day) is discarded.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), \
+            warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            function(tables)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def predict_time(measured, size):
+    # Extrapolates from the last two measured sizes with the empirical
+    # scaling exponent (linear if only one size was measured).
+    if len(measured) == 0:
+        return 0.0
+    if len(measured) == 1:
+        n, t = measured[0]
+        return t * size / n
+    (n1, t1), (n2, t2) = measured[-2], measured[-1]
+    exponent = max(np.log(max(t2, 1e-9) / max(t1, 1e-9)) / np.log(n2 / n1), 1)
+    return t2 * (size / n2) ** exponent
+
+def scaling_exponent(measured):
+    if len(measured) < 2:
+        return None
+    (n1, t1), (n2, t2) = measured[-2], measured[-1]
+    return round(float(np.log(max(t2, 1e-9) / max(t1, 1e-9)) /
+        np.log(n2 / n1)), 2)
+
+def run(names, sizes, budget, repeat, workdir):
+    # Returns {benchmark: {size: seconds or None (skipped)}} and the scaling
+    # exponents.
+    probes = sorted(set([max(sizes[0] // 100, MIN_PROBE),
+        max(sizes[0] // 10, MIN_PROBE)]))
+    all_sizes = [s for s in probes if s < sizes[0]] + sizes
+    results = {name: {} for name in names}
+    measured = {name: [] for name in names}
+    for size in all_sizes:
+        tables = None
+        for name in names:
+            predicted = predict_time(measured[name], size)
+            if predicted > budget:
+                print(f"{name:<12}{size:>10}  skipped (predicted " +
+                    f"{predicted:0.1f} s > budget {budget} s)")
+                if size in sizes:
+                    results[name][str(size)] = None
+                continue
+            if tables is None:
+                tables = make_tables(size)
+                tables["workdir"] = workdir
+                svm_for(tables, workdir)
+            seconds = time_benchmark(BENCHMARKS[name], tables, repeat)
+            measured[name].append((size, seconds))
+            if size in sizes:
+                results[name][str(size)] = round(seconds, 4)
+            print(f"{name:<12}{size:>10}  {seconds:0.4f} s")
+    exponents = {name: scaling_exponent(measured[name]) for name in names}
+    return results, exponents
+
+def compare(results, baseline, tolerance):
+    # Returns the (benchmark, size, seconds, baseline seconds) regressions.
+    regressions = []
+    for name, sizes in results.items():
+        for size, seconds in sizes.items():
+            reference = baseline.get("results", {}).get(name, {}).get(size)
+            if seconds is None or reference is None:
+                continue
+            ratio = seconds / max(reference, 1e-9)
+            status = "REGRESSION" if ratio > tolerance else "ok"
+            print(f"{name:<12}{size:>10}  {seconds:0.4f} s vs baseline " +
+                f"{reference:0.4f} s ({ratio:0.2f}x) {status}")
+            if ratio > tolerance:
+                regressions.append((name, size, seconds, reference))
+    return regressions
+
+def main():
+    print("Benchmarks")
+
+    # ArgParse library is used to manage command line arguments.
+    parser = argparse.ArgumentParser(
+        epilog="Example: benchmark.py -s 75000 750000 -b truth alignment"
+    )
+    parser.add_argument('-s', '--sizes', help="Numbers of screens to \
+        generate. Default: 75000 750000 7500000.", type=int, nargs='+',
+        default=DEFAULT_SIZES)
+    parser.add_argument('-b', '--benchmarks', help="Benchmarks to run. \
+        Default: all.", nargs='+', choices=list(BENCHMARKS.keys()),
+        default=list(BENCHMARKS.keys()))
+    parser.add_argument('--budget', help="Sizes predicted to take longer \
+        than this many seconds are skipped. Default: 300.", type=float,
+        default=300)
+    parser.add_argument('-r', '--repeat', help="Number of runs per \
+        benchmark; the best is reported. Default: 1.", type=int, default=1)
+    parser.add_argument('-t', '--tolerance', help="Ratio to the baseline \
+        above which a result is a regression. Default: 1.5.", type=float,
+        default=1.5)
+    parser.add_argument('--baseline', help="Baseline JSON file. \
+        Default: benchmarks/baseline.json.", default=BASELINE_FILE)
+    parser.add_argument('--record', action='store_true', help="Record the \
+        results as the new baseline instead of comparing.")
+    parser.add_argument('-o', '--output', help="Optional JSON file in which \
+        to save the results.", default=None)
+    parser.add_argument('-w', '--workdir', help="Directory for temporary \
+        model files. Default: benchmarks/work.",
+        default=os.path.join(BENCHMARK_DIR, "work"))
+    args = parser.parse_args()
+
+    results, exponents = run(args.benchmarks, sorted(args.sizes),
+        args.budget, args.repeat, args.workdir)
+    print("Scaling exponents (1 = linear, 2 = quadratic):")
+    for name, exponent in exponents.items():
+        print(f"{name:<12}{exponent}")
+
+    report = {
+        "machine": f"{platform.node()} {platform.processor()} " +
+            f"{platform.python_version()}",
+        "date": time.strftime("%Y-%m-%d"),
+        "results": results,
+        "scaling_exponents": exponents
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.record:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Recorded baseline in {args.baseline}.")
+        return
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline found. Record one with --record.")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print(f"Baseline from {baseline.get('machine')} ({baseline.get('date')}):")
+    regressions = compare(results, baseline, args.tolerance)
+    if len(regressions) > 0:
+        print(f"{len(regressions)} regression(s) found.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
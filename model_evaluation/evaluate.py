@@ -1,16 +1,85 @@
+import os
+import sys
+import joblib
 import numpy as np
 import pandas as pd
 import scipy.stats as st
 from numbers import Number
-from sklearn.metrics import roc_curve, precision_recall_curve, auc, confusion_matrix
+from sklearn.metrics import auc
+
+# metrics.py is shared with the scripts directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'scripts'))
+from metrics import (binary_metrics, operating_point_table, simplify_curve,
+    simplify_band, PLOT_TOLERANCE)
+
+# Sensitivities of the operating points printed in verbose mode.
+VERBOSE_SENSITIVITIES = np.arange(1, 10) / 10.0
+
+# Columns of the results table returned by generate_results.
+RESULT_COLUMNS = ['label', 'roc_auc', 'pr_auc', 'sensitivity', 'specificity', 'ppv', 'npv',
+    'proportion', 'n_diagnosed', 'n_total']
+
+class ScoreCache:
+    # Computes each model's predictions once per (model, dataset) so the PR
+    # curve, ROC curve and confusion matrix share one model(X) call.
+    # If a directory is given, scores are also stored there as .npy files
+    # keyed by a hash of the model and the data, and reused by later runs.
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._memory = {}
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def scores(self, model, X, keep=True):
+        # keep=False skips the in-memory layer, so that X is not kept alive
+        # when test sets are streamed one at a time.
+        key = (model, id(X))
+        if key in self._memory:
+            return self._memory[key][1]
+        path = None
+        if self.directory is not None:
+            path = os.path.join(self.directory, joblib.hash((model, X)) + '.npy')
+            if os.path.isfile(path):
+                pred_y = np.load(path)
+                if keep:
+                    self._memory[key] = (X, pred_y)
+                return pred_y
+        pred_y = _predict(model, X)
+        if path is not None:
+            np.save(path, pred_y)
+        # X is kept alive with its scores so that id(X) cannot be reused.
+        if keep:
+            self._memory[key] = (X, pred_y)
+        return pred_y
+
+def _predict(model, X):
+    pred_y = np.asarray(model(X))
+    if len(pred_y.shape) > 1:
+        pred_y = pred_y[:, pred_y.shape[1]-1]
+    return pred_y
+
+def _get_scores(model, X, score_cache=None, keep=True):
+    if score_cache is None:
+        return _predict(model, X)
+    return score_cache.scores(model, X, keep=keep)
 
 def generate_results(model, X, y, ax_pr, ax_roc, z_index=0,
     plot_label='Line', plot_color='#000000', draw_roc_diagonal=False,
-    n_digits=3, verbose=False
+    n_digits=3, verbose=False, score_cache=None, tolerance=PLOT_TOLERANCE
 ):
+    # tolerance: the curves are simplified before they are plotted (see
+    # simplify_curve in metrics.py); AUCs use the full curves.
+    scores = _get_scores(model, X, score_cache)
+    # The scores are sorted once for the curves and the confusion matrix.
+    metrics = binary_metrics(np.asarray(y).astype(int), scores)
+
     # PR Curve
-    _x, _y = _get_curve(model, X, y, curve='pr', verbose=verbose)
-    pr_auc = auc(_x, _y)
+    _x, _y = _get_curve(model, X, y, curve='pr', verbose=verbose,
+        scores=scores, metrics=metrics)
+    pr_auc = metrics.pr_auc
+    _x, _y = _simplified(_x, _y, tolerance)
     ax_pr.plot(_x, _y, color=plot_color,
         label=plot_label + f' AUC {pr_auc:.2f}',
         zorder=z_index)
@@ -19,8 +88,10 @@ def generate_results(model, X, y, ax_pr, ax_roc, z_index=0,
     ax_pr.legend(loc='upper right', fontsize=7, frameon=False)
 
     # ROC Curve
-    _x, _y = _get_curve(model, X, y, curve='roc', verbose=verbose)
-    roc_auc = auc(_x, _y)
+    _x, _y = _get_curve(model, X, y, curve='roc', verbose=verbose,
+        scores=scores, metrics=metrics)
+    roc_auc = metrics.roc_auc
+    _x, _y = _simplified(_x, _y, tolerance)
     ax_roc.plot(_x, _y, color=plot_color,
         label=plot_label + f' AUC {roc_auc:.2f}',
         zorder=z_index)
@@ -29,38 +100,49 @@ def generate_results(model, X, y, ax_pr, ax_roc, z_index=0,
     ax_roc.legend(loc='lower right', fontsize=7, frameon=False)
 
     # Confusion Matrix
-    sen, spe, ppv, npv = get_confusion_matrix(model, X, y)
-    cols = ['label', 'roc_auc', 'pr_auc', 'sensitivity', 'specificity', 'ppv', 'npv',
-        'proportion', 'n_diagnosed', 'n_total']
+    sen, spe, ppv, npv = get_confusion_matrix(model, X, y, scores=scores,
+        metrics=metrics)
     output = [plot_label, roc_auc, pr_auc, sen, spe, ppv, npv, baseline, y.sum(), len(y)]
-    for i in range(len(output)):
-        if isinstance(output[i], Number):
-            output[i] = round(output[i], n_digits)
-    return pd.DataFrame([output], columns=cols)
+    return _results_table(output, n_digits)
     # return pandas dataframe of all the table deta points.
 
 def generate_results_ci(model, X_list, y, ax_pr, ax_roc, z_index=0,
     plot_label='Line', plot_color='#000000', draw_roc_diagonal=False,
-    n_digits=3, verbose=False, n_points=None, confidence=0.95
+    n_digits=3, verbose=False, n_points=None, confidence=0.95,
+    score_cache=None, tolerance=PLOT_TOLERANCE
 ):
     # like 'generate_results' above, but with CIs.
+    # X_list may be any iterable (e.g. a generator reading one test set at a
+    # time). Each test set is scored once and reduced to its curves and
+    # confusion matrix before the next one is requested, so only one test
+    # set needs to be in memory.
+    pr_xs, pr_ys, roc_xs, roc_ys = [], [], [], []
+    sens, spes, ppvs, npvs = [], [], [], []
+    for X in X_list:
+        scores = _get_scores(model, X, score_cache, keep=False)
+        metrics = binary_metrics(np.asarray(y).astype(int), scores)
+        _x, _y = _get_curve(model, X, y, curve='pr',
+            verbose=verbose, n_points=n_points, scores=scores, metrics=metrics)
+        pr_xs.append(_x)
+        pr_ys.append(_y)
+        _x, _y = _get_curve(model, X, y, curve='roc',
+            verbose=verbose, n_points=n_points, scores=scores, metrics=metrics)
+        roc_xs.append(_x)
+        roc_ys.append(_y)
+        sen, spe, ppv, npv = get_confusion_matrix(model, X, y,
+            scores=scores, metrics=metrics)
+        sens.append(sen)
+        spes.append(spe)
+        ppvs.append(ppv)
+        npvs.append(npv)
 
     # PR Curve
-    _xs, _ys = [], []
-    for i in range(len(X_list)):
-        _x, _y = _get_curve(model, X_list[i], y, curve='pr',
-            verbose=verbose, n_points=n_points)
-        _xs.append(_x)
-        _ys.append(_y)
-    _x = np.mean(np.stack(_xs, axis=0), axis=0)
-    _y = np.mean(np.stack(_ys, axis=0), axis=0)
-    intervals = []
-    for i in range(len(_ys[0])):
-        values = [arr[i] for arr in _ys]
-        interval = st.t.interval(confidence, len(values)-1, loc=np.mean(values), scale=st.sem(values))
-        intervals.append(interval)
+    _x = np.mean(np.stack(pr_xs, axis=0), axis=0)
+    _y, lower, upper = confidence_band(np.stack(pr_ys, axis=0), confidence)
     
     pr_auc = auc(_x, _y)
+    keep = simplify_band(_x, [_y, lower, upper], tolerance)
+    _x, _y, lower, upper = _x[keep], _y[keep], lower[keep], upper[keep]
     ax_pr.plot(_x, _y, color=plot_color,
         label=plot_label + f' AUC {pr_auc:.2f}',
         zorder=z_index)
@@ -70,26 +152,17 @@ def generate_results_ci(model, X_list, y, ax_pr, ax_roc, z_index=0,
 
     ax_pr.fill_between(
         _x,
-        [i[0] for i in intervals], [i[1] for i in intervals],
+        lower, upper,
         color=plot_color, alpha=.2
     )
 
     # ROC Curve
-    _xs, _ys = [], []
-    for i in range(len(X_list)):
-        _x, _y = _get_curve(model, X_list[i], y, curve='roc',
-            verbose=verbose, n_points=n_points)
-        _xs.append(_x)
-        _ys.append(_y)
-    _x = np.mean(np.stack(_xs, axis=0), axis=0)
-    _y = np.mean(np.stack(_ys, axis=0), axis=0)
-    intervals = []
-    for i in range(len(_ys[0])):
-        values = [arr[i] for arr in _ys]
-        interval = st.t.interval(confidence, len(values)-1, loc=np.mean(values), scale=st.sem(values))
-        intervals.append(interval)
+    _x = np.mean(np.stack(roc_xs, axis=0), axis=0)
+    _y, lower, upper = confidence_band(np.stack(roc_ys, axis=0), confidence)
 
     roc_auc = auc(_x, _y)
+    keep = simplify_band(_x, [_y, lower, upper], tolerance)
+    _x, _y, lower, upper = _x[keep], _y[keep], lower[keep], upper[keep]
     ax_roc.plot(_x, _y, color=plot_color,
         label=plot_label + f' AUC {roc_auc:.2f}',
         zorder=z_index)
@@ -99,82 +172,100 @@ def generate_results_ci(model, X_list, y, ax_pr, ax_roc, z_index=0,
 
     ax_roc.fill_between(
         _x,
-        [i[0] for i in intervals], [i[1] for i in intervals],
+        lower, upper,
         color=plot_color, alpha=.2
     )
 
     # Confusion Matrix
-    sens, spes, ppvs, npvs = [], [], [], []
-    for i in range(len(X_list)):
-        sen, spe, ppv, npv = get_confusion_matrix(model, X_list[i], y)
-        sens.append(sen)
-        spes.append(spe)
-        ppvs.append(ppv)
-        npvs.append(npv)
     sen, spe, ppv, npv = np.mean(sens), np.mean(spes), np.mean(ppvs), np.mean(npvs)
 
-    cols = ['label', 'roc_auc', 'pr_auc', 'sensitivity', 'specificity', 'ppv', 'npv',
-        'proportion', 'n_diagnosed', 'n_total']
     output = [plot_label, roc_auc, pr_auc, sen, spe, ppv, npv, baseline, y.sum(), len(y)]
+    return _results_table(output, n_digits)
+    # return pandas dataframe of all the table deta points.
+
+def get_results(y, scores, label='Line', n_digits=3):
+    # Same table as 'generate_results', computed from precomputed scores
+    # without plotting, e.g. for cross-validation folds.
+    y = pd.Series(np.asarray(y))
+    metrics = binary_metrics(y.astype(int), scores)
+    pr_auc = metrics.pr_auc
+    roc_auc = metrics.roc_auc
+    sen, spe, ppv, npv = get_confusion_matrix(None, None, y, scores=scores,
+        metrics=metrics)
+    baseline = (y.sum() / len(y))
+    output = [label, roc_auc, pr_auc, sen, spe, ppv, npv, baseline, y.sum(), len(y)]
+    return _results_table(output, n_digits)
+
+def _results_table(output, n_digits):
     for i in range(len(output)):
         if isinstance(output[i], Number):
             output[i] = round(output[i], n_digits)
-    return pd.DataFrame([output], columns=cols)
-    # return pandas dataframe of all the table deta points.
+    return pd.DataFrame([output], columns=RESULT_COLUMNS)
 
 def plot_ci_curve(arrays, ax, baseline=None, roc_diagonal=None, confidence=0.95, plot_color='red',
-    plot_label='line', legend_position='lower right', layer=1
+    plot_label='line', legend_position='lower right', layer=1,
+    tolerance=PLOT_TOLERANCE
 ):
-    mean_x_val = np.linspace(0,1,len(arrays[0]))
-    means = np.mean(np.stack(arrays, axis=0), axis=0)
-    intervals = []
-    for i in range(len(arrays[0])):
-        values = [arr[i] for arr in arrays]
-        interval = st.t.interval(confidence, len(values)-1, loc=np.mean(values), scale=st.sem(values))
-        intervals.append(interval)
+    arrays = np.asarray(arrays)
+    mean_x_val = np.linspace(0,1,arrays.shape[1])
+    means, lower, upper = confidence_band(arrays, confidence)
     if baseline:
         ax.plot([0,1], [baseline, baseline], color=plot_color + '80', linestyle='dashed', zorder=layer)
         # ax.text(0, baseline + 0.02, f'Baseline = {baseline}', color='gray')
     if roc_diagonal:
         ax.plot([0,1], [0,1], color=roc_diagonal, linestyle='dashed')
     area_under_curve = auc(mean_x_val, means)
+    keep = simplify_band(mean_x_val, [means, lower, upper], tolerance)
+    mean_x_val, means = mean_x_val[keep], means[keep]
+    lower, upper = lower[keep], upper[keep]
     ax.plot(mean_x_val, means, color=plot_color,
         label=plot_label + f' AUC {area_under_curve:.2f}',
         zorder=layer)
     ax.fill_between(
         mean_x_val,
-        [i[0] for i in intervals], [i[1] for i in intervals],
+        lower, upper,
         color=plot_color, alpha=.2
     )
     ax.legend(loc=legend_position, fontsize=7)
 
-def _get_curve(model, X, y, curve='roc', verbose=False, n_points=None): # curve = 'roc' or 'pr'
-    y = y.astype(int)
-    pred_y = model(X)
-    if len(pred_y.shape) > 1:
-        pred_y = [p[pred_y.shape[1]-1] for p in pred_y]
+def _simplified(x, y, tolerance):
+    keep = simplify_curve(x, y, tolerance)
+    return np.asarray(x)[keep], np.asarray(y)[keep]
+
+def confidence_band(curves, confidence=0.95):
+    # Mean and Student's t confidence interval at every point of a stack of
+    # curves with shape (n_sets, n_points), computed for all points at once.
+    curves = np.asarray(curves, dtype=float)
+    n_sets = curves.shape[0]
+    mean = curves.mean(axis=0)
+    if n_sets < 2:
+        return mean, mean.copy(), mean.copy()
+    sem = curves.std(axis=0, ddof=1) / np.sqrt(n_sets)
+    half_width = st.t.ppf((1 + confidence) / 2, n_sets - 1) * sem
+    return mean, mean - half_width, mean + half_width
+
+def _get_curve(model, X, y, curve='roc', verbose=False, n_points=None,
+    scores=None, metrics=None
+): # curve = 'roc' or 'pr'
+    # metrics: the BinaryMetrics of the scores (see metrics.py), if already
+    # computed.
+    if metrics is None:
+        y = y.astype(int)
+        pred_y = _predict(model, X) if scores is None else scores
+        metrics = binary_metrics(y, pred_y)
     if curve == 'pr':
-        precision, recall, _ = precision_recall_curve(y, pred_y)
+        precision, recall = metrics.precision, metrics.recall
         if n_points is not None:
             x_out = np.linspace(0,1,n_points)
             y_out = np.interp(x_out, np.flip(recall), np.flip(precision))
             return x_out, y_out
         return recall, precision
     elif curve == 'roc':
-        fpr, tpr, thresholds = roc_curve(y, pred_y)
+        fpr, tpr, thresholds = metrics.fpr, metrics.tpr, metrics.roc_thresholds
         if verbose:
-            data = []
-            for sensitivity in [i/10.0 for i in range(1,10)]:
-                cutoff = thresholds[np.abs(tpr - sensitivity).argmin()]
-                decision = [1 if prob >= cutoff else 0 for prob in pred_y]
-                _, fp, fn, tp = confusion_matrix(y, decision).ravel()
-                sen = tp/(tp+fn) if (tp+fn) != 0 else np.nan
-                ppv = tp/(tp+fp) if (tp+fp) != 0 else np.nan
-                current_data = [sen, ppv]
-                for i in range(len(current_data)):
-                    current_data[i] = round(current_data[i], 3)
-                data.append(current_data)
-            print(pd.DataFrame(data, columns=['sensitivity', 'PPV']))
+            points = metrics.operating_points(VERBOSE_SENSITIVITIES)
+            print(pd.DataFrame({'sensitivity': points['sensitivity'],
+                'PPV': points['ppv']}).round(3))
         if n_points is not None:
             x_out = np.linspace(0,1,n_points)
             y_out = np.interp(x_out, fpr, tpr)
@@ -183,20 +274,30 @@ def _get_curve(model, X, y, curve='roc', verbose=False, n_points=None): # curve
     else:
         return None, None
     
-def get_confusion_matrix(model, X, y, sensitivity=0.8):
-    y = y.astype(int)
-    pred_y = model(X)
-    if len(pred_y.shape) > 1:
-        pred_y = [p[pred_y.shape[1]-1] for p in pred_y]
-
-    _, tpr, thresholds = roc_curve(y, pred_y)
-    cutoff = thresholds[np.abs(tpr - sensitivity).argmin()]
-    decision = [1 if prob >= cutoff else 0 for prob in pred_y]
+def get_confusion_matrix(model, X, y, sensitivity=0.8, scores=None,
+    metrics=None):
+    if metrics is None:
+        y = y.astype(int)
+        pred_y = _predict(model, X) if scores is None else scores
+        metrics = binary_metrics(y, pred_y)
 
-    tn, fp, fn, tp = confusion_matrix(y, decision).ravel()
-    sen = tp/(tp+fn) if (tp+fn) != 0 else np.nan
-    spe = tn/(tn+fp) if (tn+fp) != 0 else np.nan
-    ppv = tp/(tp+fp) if (tp+fp) != 0 else np.nan
-    npv = tn/(tn+fn) if (tn+fn) != 0 else np.nan
+    points = metrics.operating_points([sensitivity])
+    return tuple(float(points[rate][0])
+        for rate in ['sensitivity', 'specificity', 'ppv', 'npv'])
 
-    return sen, spe, ppv, npv
\ No newline at end of file
+def get_operating_points(models, X, y, targets, by='sensitivity',
+    score_cache=None):
+    # Cutoff, sensitivity, specificity, PPV and NPV of each model at each
+    # target sensitivity (or specificity), one row per (model, target).
+    # models: {label: model}, or {label: (model, X, y)} when the models are
+    # evaluated on different data (e.g. one truth column per horizon). The
+    # scores of each model are sorted once for the whole grid.
+    metrics = {}
+    for label, model in models.items():
+        model_X, model_y = X, y
+        if isinstance(model, tuple):
+            model, model_X, model_y = model
+        scores = _get_scores(model, model_X, score_cache)
+        metrics[label] = binary_metrics(np.asarray(model_y).astype(int),
+            scores)
+    return operating_point_table(metrics, targets, by)
@@ -1,50 +1,245 @@
-from math import exp
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import joblib
 import os
 import re
 
-class Models:
-    svm_dict = {}
+# Default number of loaded models kept in memory by Models.
+CACHE_SIZE = 8
+
+# Default number of rows per chunk for Models.plcom2012_csv.
+CHUNK_SIZE = 100000
+
+PLCOM2012_COLUMNS = [
+    'age',
+    'race',
+    'education',
+    'bmi',
+    'copd',
+    'cancer_hist',
+    'family_hist_lung_cancer',
+    'smoking_status',
+    'cig_day',
+    'smoking_years',
+    'quit_years'
+]
+
+# PLCOm2012 race/ethnicity terms, relative to White.
+PLCOM2012_RACE_OFFSETS = {
+    1: 0.0,         # White
+    4: 0.0,         # American Indian or Alaskan Native
+    2: 0.3944778,   # Black or African American
+    8: -0.7434744,  # Hispanic or Latino
+    3: -0.466585,   # Asian
+    5: 1.027152     # Native Hawaiian or Other Pacific Islander
+}
+
+class ModelCache:
+    # Least recently used cache of loaded models, keyed by file path.
+    # Models are loaded with mmap_mode='c' so that their numpy arrays are
+    # memory-mapped (copy-on-write, as libsvm needs writable buffers) from
+    # the file instead of copied into memory.
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._models = OrderedDict()
+
+    def get(self, path):
+        if path in self._models:
+            self._models.move_to_end(path)
+            return self._models[path]
+        if path.endswith('.npz'):
+            model = LinearModel(path)
+        else:
+            model = joblib.load(path, mmap_mode='c')
+        self._models[path] = model
+        if len(self._models) > self.size:
+            self._models.popitem(last=False)
+        return model
+
+class LazyModel:
+    # Callable returned by Models.get_models. The model file is only loaded
+    # the first time predictions are requested.
+
+    def __init__(self, path, cache):
+        self.path = path
+        self.cache = cache
+
+    def __call__(self, X):
+        return self.cache.get(self.path).predict_proba(X)
+
+    def __getstate__(self):
+        # Identifies the model by its file, e.g. for evaluate.ScoreCache.
+        return {'path': self.path, 'mtime': os.path.getmtime(self.path)}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.cache = ModelCache(1)
+
+class LinearModel:
+    # Scores an exported linear model (see export_linear_model) with plain
+    # NumPy: standard scaling, a linear decision function and a sigmoid or
+    # isotonic probability calibration.
 
     def __init__(self, path):
-        self.load_models(path)
+        with np.load(path, allow_pickle=False) as data:
+            self.arrays = {key: data[key] for key in data.files}
+        self.features = list(self.arrays['features'])
+        self.calibration = str(self.arrays['calibration'])
+
+    def decision_function(self, X):
+        if isinstance(X, pd.DataFrame) and len(self.features) > 0:
+            X = X[self.features]
+        X = np.asarray(X, dtype=float)
+        X = (X - self.arrays['mean']) / self.arrays['scale']
+        return X @ self.arrays['coef'] + self.arrays['intercept']
+
+    def predict_proba(self, X):
+        f = self.decision_function(X)
+        if self.calibration == 'isotonic':
+            p = np.interp(f, self.arrays['x_thresholds'],
+                self.arrays['y_thresholds'])
+        else:
+            p = _logistic(-(self.arrays['a'] * f + self.arrays['b']))
+        return np.stack([1 - p, p], axis=1)
 
-    def load_models(self, path):
-        for filename in os.listdir(path):
+def export_linear_model(model, path):
+    # Writes the scaler, coefficients, intercept and probability calibration
+    # of a trained linear Pipeline (see train_svm.py) to a small .npz file
+    # that LinearModel can score without sklearn.
+    scaler = model.named_steps['scaler']
+    classifier = model.named_steps['svm']
+    arrays = {
+        'mean': scaler.mean_,
+        'scale': scaler.scale_,
+        'features': np.array(getattr(model, 'feature_names_in_', []), dtype=str)
+    }
+    if hasattr(classifier, 'calibrated_classifiers_'):
+        # CalibratedClassifierCV(ensemble=False): one estimator refitted on
+        # all data, calibrated on cross-validated decision values.
+        calibrated = classifier.calibrated_classifiers_[0]
+        estimator = calibrated.estimator
+        calibrator = calibrated.calibrators[0]
+        if hasattr(calibrator, 'a_'):
+            arrays.update(calibration='sigmoid', a=calibrator.a_,
+                b=calibrator.b_)
+        else:
+            arrays.update(calibration='isotonic',
+                x_thresholds=calibrator.X_thresholds_,
+                y_thresholds=calibrator.y_thresholds_)
+    elif getattr(classifier, 'kernel', None) == 'linear':
+        # SVC(probability=True): libsvm's Platt scaling uses its own decision
+        # value, the negated sklearn one, so P(class 1) = 1 / (1 + exp(A f - B)).
+        estimator = classifier
+        arrays.update(calibration='sigmoid', a=classifier.probA_[0],
+            b=-classifier.probB_[0])
+    else:
+        raise Exception("Only linear models with a scaler and a calibrated " \
+            "linear classifier can be exported.")
+    arrays.update(coef=np.ravel(estimator.coef_),
+        intercept=np.ravel(estimator.intercept_)[0])
+    np.savez(path, **arrays)
+
+def feature_columns(df, truth, features=None, horizon=None, exclude=None):
+    # Returns the feature columns of one horizon. Shared by train_svm.py and
+    # test_model.py, so that a model is tested on the columns it was trained
+    # on, in the same order. truth may contain '#' for every horizon.
+    # Without features, every other column is used in sorted order, except
+    # the truth columns of all horizons and exclude.
+    if features is not None:
+        if horizon is None:
+            return list(features)
+        return [f.replace('#', str(horizon)) for f in features]
+    pattern = re.escape(truth).replace(re.escape('#'), r'\d+')
+    exclude = [] if exclude is None else list(exclude)
+    exclude += [c for c in df.columns if re.fullmatch(pattern, c)]
+    return list(df.columns.difference(exclude))
+
+class Models:
+
+    def __init__(self, path, cache_size=CACHE_SIZE, exported=False):
+        # model name -> file path. Files are indexed here and loaded lazily.
+        # exported: a model's .npz export (see export_linear_model) is used
+        # instead of its .joblib file; otherwise only models without a
+        # .joblib file are loaded from their .npz.
+        self.model_files = {}
+        self.cache = ModelCache(cache_size)
+        self.load_models(path, exported)
+
+    def __getstate__(self):
+        # Leaves out the loaded models, so that the bound methods feature and
+        # plcom2012 hash the same whatever is cached, e.g. for
+        # evaluate.ScoreCache.
+        return {'model_files': self.model_files}
+
+    def __setstate__(self, state):
+        self.model_files = state['model_files']
+        self.cache = ModelCache(CACHE_SIZE)
+
+    def load_models(self, path, exported=False):
+        exports = {}
+        for filename in sorted(os.listdir(path)):
             f = os.path.join(path, filename)
             if os.path.isfile(f) and f.endswith('.joblib'):
                 name = filename.split('.')[0]
-                self.svm_dict[name] = joblib.load(f)
-    
+                self.model_files.setdefault(name, f)
+            elif os.path.isfile(f) and f.endswith('.npz'):
+                exports.setdefault(filename.split('.')[0], f)
+        for name, f in exports.items():
+            if name not in self.model_files:
+                self.model_files[name] = f
+            elif exported:
+                # The export of a calibrated SVC does not reproduce its
+                # predict_proba exactly, so the file used is reported.
+                print(f"Model {name}: using {f} instead of " +
+                    f"{self.model_files[name]}.")
+                self.model_files[name] = f
+            else:
+                print(f"Model {name}: using {self.model_files[name]}; " +
+                    f"{f} is ignored.")
+
     def get_models(self, name):
         output = {}
         if name == 'feature':
             return {name: self.feature}
         if name == 'plcom2012':
             return {name: self.plcom2012}
-        for key in self.svm_dict.keys():
+        for key in self.model_files.keys():
             if bool(re.search(name, key)):
-                output[key] = self.svm_dict[key].predict_proba
+                output[key] = LazyModel(self.model_files[key], self.cache)
         return output
     
     def feature(self, X):
         return X[X.columns[0]]
 
     def plcom2012(self, X):
-        required_columns = [
-            'age',
-            'race',
-            'education',
-            'bmi',
-            'copd',
-            'cancer_hist',
-            'family_hist_lung_cancer',
-            'smoking_status',
-            'cig_day',
-            'smoking_years',
-            'quit_years'
-        ]
+        self._check_plcom2012_columns(X)
+        return pd.Series(plcom2012_probability(X), index=X.index)
+
+    def plcom2012_csv(self, path, outfile=None, chunksize=CHUNK_SIZE):
+        # Scores a CSV too large to hold in memory, reading only the
+        # PLCOm2012 columns, chunksize rows at a time. If outfile is given,
+        # probabilities are appended to it chunk by chunk and nothing is
+        # returned; otherwise they are returned as one Series.
+        output = []
+        header = True
+        for chunk in pd.read_csv(path, usecols=PLCOM2012_COLUMNS,
+            chunksize=chunksize
+        ):
+            result = self.plcom2012(chunk).rename('plcom2012')
+            if outfile is None:
+                output.append(result)
+            else:
+                result.to_csv(outfile, mode='w' if header else 'a',
+                    header=header, index=False)
+                header = False
+        if outfile is None:
+            return pd.concat(output) if len(output) > 0 else \
+                pd.Series(dtype=float, name='plcom2012')
+
+    def _check_plcom2012_columns(self, X):
+        required_columns = PLCOM2012_COLUMNS
         for c in required_columns:
             if c not in X.columns:
                 print(
@@ -52,53 +247,46 @@ class Models:
                     f"\nRequired columns: {required_columns}"
                 )
                 exit(1)
-        return X.apply(self._plcom2012_single, axis=1)
-
-    def _plcom2012_single(self, X):
-        age = X['age']
-        race = X['race']
-        education = X['education']
-        bmi = X['bmi']
-        copd = X['copd']
-        cancer_hist = X['cancer_hist']
-        family_hist_lung_cancer = X['family_hist_lung_cancer']
-        smoking_status = X['smoking_status']
-        smoking_intensity = X['cig_day']
-        duration_smoking = X['smoking_years']
-        smoking_quit_time = X['quit_years']
-
-        model = 0
-        if race == 1 or race == 4: # White, American Indian or Alaskan Native
-            model = (0.0778868 * (age - 62) - 0.0812744 * (education - 4) - 0.0274194 * (bmi - 27) + 0.3553063 * copd + 0.4589971 * cancer_hist +
-                0.587185 * family_hist_lung_cancer + 0.2597431 * smoking_status - 1.822606 * ((smoking_intensity/10)**(-1) - 0.4021541613) + 0.0317321 *
-                (duration_smoking - 27) - 0.0308572 * (smoking_quit_time - 10) - 4.532506)
-            
-        elif race == 2: # Black or African American
-            model = (0.0778868 * (age - 62) - 0.0812744 * (education - 4) - 0.0274194 * (bmi - 27) + 0.3553063 * copd + 0.4589971 * cancer_hist +
-                0.587185 * family_hist_lung_cancer + 0.2597431 * smoking_status - 1.822606 * ((smoking_intensity/10)**(-1) - 0.4021541613) + 0.0317321 *
-                (duration_smoking - 27) - 0.0308572 * (smoking_quit_time - 10) - 4.532506 + 0.3944778)
-            
-        elif race == 8: # Hispanic or Latino
-            model = (0.0778868 * (age - 62) - 0.0812744 * (education - 4) - 0.0274194 * (bmi - 27) + 0.3553063 * copd + 0.4589971 * cancer_hist +
-                0.587185 * family_hist_lung_cancer + 0.2597431 * smoking_status - 1.822606 * ((smoking_intensity/10)**(-1) - 0.4021541613) + 0.0317321 *
-                (duration_smoking - 27) - 0.0308572 * (smoking_quit_time - 10) - 4.532506 - 0.7434744)
-            
-        elif race == 3: # Asian
-            model = (0.0778868 * (age - 62) - 0.0812744 * (education - 4) - 0.0274194 * (bmi - 27) + 0.3553063 * copd + 0.4589971 * cancer_hist +
-                0.587185 * family_hist_lung_cancer + 0.2597431 * smoking_status - 1.822606 * ((smoking_intensity/10)**(-1) - 0.4021541613) + 0.0317321 *
-                (duration_smoking - 27) - 0.0308572 * (smoking_quit_time - 10) - 4.532506 - 0.466585)
-            
-        elif race == 5: # Native Hawaiian or Other Pacific Islander
-            model = (0.0778868 * (age - 62) - 0.0812744 * (education - 4) - 0.0274194 * (bmi - 27) + 0.3553063 * copd + 0.4589971 * cancer_hist +
-                0.587185 * family_hist_lung_cancer + 0.2597431 * smoking_status - 1.822606 * ((smoking_intensity/10)**(-1) - 0.4021541613) + 0.0317321 *
-                (duration_smoking - 27) - 0.0308572 * (smoking_quit_time - 10) - 4.532506 + 1.027152)
-        
-        else:
-            print("Race: no match:", race)
-            return None
-        
-        prob = exp(model)/(1 + exp(model))
-        return prob
+
+def plcom2012_probability(X):
+    # Vectorized PLCOm2012: the linear predictor is computed for all rows at
+    # once, with the race term taken from PLCOM2012_RACE_OFFSETS. Rows whose
+    # race has no coefficient get NaN.
+    race = X['race'].to_numpy(dtype=float)
+    offset = np.full(race.shape, np.nan)
+    for value, race_offset in PLCOM2012_RACE_OFFSETS.items():
+        offset[race == value] = race_offset
+    n_unmatched = int(np.isnan(offset).sum())
+    if n_unmatched > 0:
+        unmatched = np.unique(race[np.isnan(offset)])
+        print(f"Race: no match for {n_unmatched} rows:", unmatched)
+
+    age = X['age'].to_numpy(dtype=float)
+    education = X['education'].to_numpy(dtype=float)
+    bmi = X['bmi'].to_numpy(dtype=float)
+    copd = X['copd'].to_numpy(dtype=float)
+    cancer_hist = X['cancer_hist'].to_numpy(dtype=float)
+    family_hist_lung_cancer = X['family_hist_lung_cancer'].to_numpy(dtype=float)
+    smoking_status = X['smoking_status'].to_numpy(dtype=float)
+    smoking_intensity = X['cig_day'].to_numpy(dtype=float)
+    duration_smoking = X['smoking_years'].to_numpy(dtype=float)
+    smoking_quit_time = X['quit_years'].to_numpy(dtype=float)
+
+    with np.errstate(divide='ignore'):
+        model = (0.0778868 * (age - 62) - 0.0812744 * (education - 4) - 0.0274194 * (bmi - 27) + 0.3553063 * copd + 0.4589971 * cancer_hist +
+            0.587185 * family_hist_lung_cancer + 0.2597431 * smoking_status - 1.822606 * ((smoking_intensity/10)**(-1) - 0.4021541613) + 0.0317321 *
+            (duration_smoking - 27) - 0.0308572 * (smoking_quit_time - 10) - 4.532506 + offset)
+    return _logistic(model)
+
+def _logistic(z):
+    # exp(z) / (1 + exp(z)), as in the original row-wise formula, switching
+    # to 1 / (1 + exp(-z)) where exp(z) would overflow.
+    output = np.empty_like(z)
+    large = z > 700
+    output[large] = 1 / (1 + np.exp(-z[large]))
+    exp_z = np.exp(z[~large])
+    output[~large] = exp_z / (1 + exp_z)
+    return output
 
 if __name__ == '__main__':
     cols = ['age', 'race', 'education', 'bmi', 'copd', 'cancer_hist',
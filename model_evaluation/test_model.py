@@ -1,9 +1,20 @@
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
 from os.path import isfile
 import pandas as pd
 
-from models import Models
-from evaluate import generate_results, generate_results_ci
+from models import Models, feature_columns
+from evaluate import (generate_results, generate_results_ci, ScoreCache,
+    get_operating_points)
+
+# profiling.py and metrics.py are shared with the scripts directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'scripts'))
+from profiling import Profiler, phase
+from metrics import PLOT_TOLERANCE
 
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
@@ -42,7 +53,8 @@ def get_cli_args():
     parser.add_argument('-f', '--features', nargs='+',
         help="Optional list of features to use for testing. " + 
         "If not specified, all columns other than the ground truth " +
-        "will be used as features for testing.",
+        "columns of every horizon will be used as features for testing, " +
+        "in sorted order.",
         required=False,
         default=None)
     parser.add_argument('-e', '--ensemble', action='store_true',
@@ -50,12 +62,42 @@ def get_cli_args():
         "Any test set will be used. " +
         "This means that a 95%% confidence interval will be generated across " +
         "all test sets. Uses 'feature' model.")
+    parser.add_argument('-s', '--scorecache', default=None,
+        help="Optional directory in which to store model predictions. " +
+        "Predictions already stored there for the same model and data " +
+        "are reused instead of being recomputed.")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+        help="Optional number of test sets read in parallel with " +
+        "--ensemble. Default: 4.")
+    parser.add_argument('-t', '--tolerance', type=float,
+        default=PLOT_TOLERANCE,
+        help="Optional tolerance of the simplification of the plotted " +
+        "curves, in axis units. 0 plots every point. AUCs are computed " +
+        "on the full curves. Default: 0.001.")
+    parser.add_argument('--targets', type=float, nargs='+', default=None,
+        help="Optional grid of target sensitivities (or specificities, " +
+        "see --by). The cutoff, sensitivity, specificity, PPV and NPV of " +
+        "every model at each target are written to a CSV file ending in " +
+        "_operating_points.csv. Not available with --ensemble.")
+    parser.add_argument('--by', choices=['sensitivity', 'specificity'],
+        default='sensitivity',
+        help="Optional criterion of the --targets. Default: sensitivity.")
+    parser.add_argument('-x', '--exported', action='store_true',
+        help="Optional argument to score models with their .npz export " +
+        "(see train_svm.py --export) instead of their .joblib file. " +
+        "Exports of calibrated svc models can differ slightly from the " +
+        "original model.")
     parser.add_argument('-v', '--verbose', action='store_true',
         help="Optional argument to provide more information during execution.")
+    parser.add_argument('--profile', action='store_true',
+        help="Optional argument to write a profile report (cProfile " +
+        "statistics, time and peak memory per phase) in the output " +
+        "directory. See scripts/profiling.py.")
     args = parser.parse_args()
     return args
 
 def get_csvs(path, verbose):
+    # Returns the paths of the '#'-numbered test sets without reading them.
     output = []
     MAX_ITER = 10000
     index = 1
@@ -66,17 +108,47 @@ def get_csvs(path, verbose):
             break
         if verbose:
             print(f'Found {current_path}.')
-        output.append(pd.read_csv(current_path))
+        output.append(current_path)
         index += 1
     if verbose:
         print(f'Found {index} csvs.')
     return output
 
+def read_csvs(paths, columns, n_jobs=4):
+    # Reads only the given columns of each CSV, in parallel threads, and
+    # yields the DataFrames in order. At most n_jobs files are read ahead of
+    # the consumer, so memory scales with n_jobs rather than len(paths).
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(pd.read_csv, path, usecols=columns))
+            if len(pending) >= n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def get_feature_sets(paths, feature, truth, n_jobs=4):
+    # Streams one single-feature test set at a time for generate_results_ci.
+    for df in read_csvs(paths, [feature, truth], n_jobs):
+        X = df.dropna(subset=[truth])
+        yield X.drop(columns=[truth])
+
+def save_operating_points(evaluated, args, filename, score_cache):
+    # Operating points of every evaluated model for --targets, if given.
+    if args.targets is None:
+        return
+    points = get_operating_points(evaluated, None, None, args.targets,
+        args.by, score_cache)
+    points.round(3).to_csv(filename + '_operating_points.csv', index=False)
+
 if __name__ == '__main__':
     args = get_cli_args()
+    profiler = Profiler(args.profile)
 
-    models = Models(args.modeldir)
-    predictors = models.get_models(args.model)
+    with phase("load models"):
+        models = Models(args.modeldir, exported=args.exported)
+        predictors = models.get_models(args.model)
+    score_cache = ScoreCache(args.scorecache)
 
     f = plt.figure(figsize=(6.5,3), dpi=144)
     ax_pr = f.add_subplot(121)
@@ -100,7 +172,7 @@ if __name__ == '__main__':
         # 3D data- X (specificity), Y (senstivity), N year
         # Data is 4D when you include the model.
         # Then generate the image with CIs.
-        dfs = get_csvs(args.testset, args.verbose)
+        paths = get_csvs(args.testset, args.verbose)
 
         results = pd.DataFrame()
         index = 0
@@ -108,33 +180,37 @@ if __name__ == '__main__':
             truth = args.truth
             if '#' in truth:
                 truth = truth.replace('#', feature[-1])
-            X_list, y = [], []
-            for inner_index, df in enumerate(dfs):
-                X = df[[feature, truth]]
-                X = X.dropna(subset=[truth])
-                if inner_index == 0:
-                    y = X[truth]
-                X = X.drop(columns=[truth])
-                X_list.append(X)
+            # The ground truth is taken from the first test set.
+            y = pd.read_csv(paths[0], usecols=[truth])[truth].dropna()
+            X_list = get_feature_sets(paths, feature, truth, args.jobs)
             print(f"Model (None)")
             print(f"Truth column: {truth}")
             print(f"Feature columns: {feature}")
-            result = generate_results_ci(predictors['feature'], X_list, y, ax_pr, ax_roc,
-                plot_label=f'Year {truth[-1]}',
-                plot_color=colors[index % len(colors)],
-                draw_roc_diagonal= index==0,
-                z_index=6-index,
-                n_points=1000,
-                verbose=args.verbose)
+            with phase("evaluate"):
+                result = generate_results_ci(predictors['feature'], X_list, y, ax_pr, ax_roc,
+                    plot_label=f'Year {truth[-1]}',
+                    plot_color=colors[index % len(colors)],
+                    draw_roc_diagonal= index==0,
+                    z_index=6-index,
+                    n_points=1000,
+                    verbose=args.verbose,
+                    score_cache=score_cache,
+                    tolerance=args.tolerance)
             results = pd.concat([results, result])
             index += 1
         filename = args.outdir + '\\' + 'feature-' + args.testset.split('\\')[-1].split('.')[0]
         filename = filename.replace('#', 'N_ci')
-        f.savefig(filename + '.svg', format='svg', bbox_inches='tight')
-        results.to_csv(filename + '.csv', index=False)
+        with phase("save"):
+            f.savefig(filename + '.svg', format='svg', bbox_inches='tight')
+            results.to_csv(filename + '.csv', index=False)
+        profiler.report(args.outdir)
         exit(0)
     
-    df = pd.read_csv(args.testset)
+    with phase("read"):
+        df = pd.read_csv(args.testset)
+
+    # (model, X, y) of each plotted line, for --targets.
+    evaluated = {}
 
     if args.model == 'feature':
         results = pd.DataFrame()
@@ -150,17 +226,24 @@ if __name__ == '__main__':
             print(f"Model (None)")
             print(f"Truth column: {truth}")
             print(f"Feature columns: {feature}")
-            result = generate_results(predictors['feature'], X, y, ax_pr, ax_roc,
-                plot_label=f'Year {truth[-1]}',
-                plot_color=colors[index % len(colors)],
-                draw_roc_diagonal= index==0,
-                z_index=6-index,
-                verbose=args.verbose)
+            with phase("evaluate"):
+                result = generate_results(predictors['feature'], X, y, ax_pr, ax_roc,
+                    plot_label=f'Year {truth[-1]}',
+                    plot_color=colors[index % len(colors)],
+                    draw_roc_diagonal= index==0,
+                    z_index=6-index,
+                    verbose=args.verbose,
+                    score_cache=score_cache,
+                    tolerance=args.tolerance)
             results = pd.concat([results, result])
+            evaluated[feature] = (predictors['feature'], X, y)
             index += 1
         filename = args.outdir + '\\' + 'feature-' + args.testset.split('\\')[-1].split('.')[0]
-        f.savefig(filename + '.svg', format='svg', bbox_inches='tight')
-        results.to_csv(filename + '.csv', index=False)
+        with phase("save"):
+            f.savefig(filename + '.svg', format='svg', bbox_inches='tight')
+            results.to_csv(filename + '.csv', index=False)
+            save_operating_points(evaluated, args, filename, score_cache)
+        profiler.report(args.outdir)
         exit(0)
 
     results = pd.DataFrame()
@@ -174,28 +257,29 @@ if __name__ == '__main__':
         if '#' in truth:
             truth = truth.replace('#', name[-1])
         print(f"Truth column: {truth}")
-        if args.features is None:
-            X = df[df.columns.difference([truth]) + [truth]]
-            print(f"Feature columns: {df.columns.difference([truth])}")
-        else:
-            features = args.features.copy()
-            for i in range(len(features)):
-                if '#' in features[i]:
-                    features[i] = features[i].replace('#', name[-1])
-            print(f"Feature columns: {features}")
-            X = df[features + [truth]]
+        # The columns selected by train_svm.py for this model.
+        features = feature_columns(df, args.truth, args.features, name[-1])
+        print(f"Feature columns: {features}")
+        X = df[features + [truth]]
         X = X.dropna(subset=[truth])
         y = X[truth]
         X = X.drop(columns=[truth])
-        result = generate_results(model, X, y, ax_pr, ax_roc,
-            plot_label=f'Year {truth[-1]}',
-            plot_color=colors[index % len(colors)],
-            draw_roc_diagonal= index==0,
-            z_index=6-index,
-            verbose=args.verbose)
+        with phase("evaluate"):
+            result = generate_results(model, X, y, ax_pr, ax_roc,
+                plot_label=f'Year {truth[-1]}',
+                plot_color=colors[index % len(colors)],
+                draw_roc_diagonal= index==0,
+                z_index=6-index,
+                verbose=args.verbose,
+                score_cache=score_cache,
+                tolerance=args.tolerance)
         results = pd.concat([results, result])
+        evaluated[name] = (model, X, y)
         index += 1
     filename = args.outdir + '\\' + model_name + '-' + args.testset.split('\\')[-1].split('.')[0]
-    f.savefig(filename + '.svg', format='svg', bbox_inches='tight')
-    results.to_csv(filename + '.csv', index=False)
+    with phase("save"):
+        f.savefig(filename + '.svg', format='svg', bbox_inches='tight')
+        results.to_csv(filename + '.csv', index=False)
+        save_operating_points(evaluated, args, filename, score_cache)
+    profiler.report(args.outdir)
     exit(0)
\ No newline at end of file
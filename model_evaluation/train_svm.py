@@ -1,51 +1,275 @@
 import argparse
+import os
+import sys
+import numpy as np
 import pandas as pd
 import joblib
 import time
 
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import (train_test_split, StratifiedKFold,
+    StratifiedGroupKFold)
 from sklearn.pipeline import Pipeline
-from sklearn.svm import SVC
+from sklearn.svm import SVC, LinearSVC
 from sklearn.preprocessing import StandardScaler
 
+from evaluate import get_results
+from models import export_linear_model, feature_columns
+
+# profiling.py is shared with the scripts directory.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'scripts'))
+from profiling import Profiler, phase
+
+SOLVERS = ['svc', 'linear', 'sgd']
+
+# Horizons (years) trained when the truth column contains '#'.
+HORIZONS = range(1, 7)
+
 def get_cli_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('data', 
+    parser.add_argument('data',
         help="CSV file containing the data for training.")
     parser.add_argument('truth',
-        help="The column name in the data set for the ground truth")
+        help="The column name in the data set for the ground truth. " +
+        "If it contains '#', e.g. canc_yr#, one model is trained per " +
+        "horizon (# = 1 to 6, where the column exists), in parallel.")
     parser.add_argument('-o', '--outfile', default='model.joblib',
-        help="Name of the joblib file to store the trained model.",
+        help="Name of the joblib file to store the trained model. " +
+        "With a '#' truth column, '#' in this name is replaced by the " +
+        "horizon, or '_N' is appended to the name, e.g. model_1.joblib.",
         required=False)
     parser.add_argument('-f', '--features', nargs='+',
-        help="Optional list of features to use for training. " + 
+        help="Optional list of features to use for training. " +
         "If not specified, all columns other than the ground truth " +
-        "will be used as features for training.",
+        "columns of every horizon will be used as features for training, " +
+        "in sorted order. " +
+        "'#' is replaced by the horizon, as for the truth column.",
         required=False,
         default=None)
+    parser.add_argument('-j', '--jobs', type=int, default=-1,
+        help="Number of horizons (or cross-validation folds) trained in " +
+        "parallel. Default: -1 (all cores).")
+    parser.add_argument('-s', '--solver', choices=SOLVERS, default='svc',
+        help="svc: kernel SVC with built-in Platt scaling (original). " +
+        "linear: primal linear SVM (liblinear), scales to large data sets. " +
+        "sgd: linear SVM trained by stochastic gradient descent. " +
+        "linear and sgd are calibrated separately, see --calibration. " +
+        "Default: svc.")
+    parser.add_argument('-c', '--calibration', choices=['sigmoid', 'isotonic'],
+        default='sigmoid',
+        help="Probability calibration for the linear and sgd solvers. " +
+        "sigmoid is Platt scaling, as used by svc. Default: sigmoid.")
+    parser.add_argument('-k', '--calibration-cv', type=int, default=5,
+        help="Number of cross-validation folds used to fit the probability " +
+        "calibration for the linear and sgd solvers. Default: 5.")
+    parser.add_argument('-x', '--export', action='store_true',
+        help="Also export each model as a compact .npz file next to the " +
+        ".joblib file. test_model.py --exported scores it with NumPy " +
+        "only, without loading sklearn.")
+    parser.add_argument('--compare', action='store_true',
+        help="Instead of saving a model, compare the fit time and ROC AUC " +
+        "of every solver on a stratified hold-out split of the data.")
+    parser.add_argument('--cv', type=int, default=None,
+        help="Instead of saving a model, estimate out-of-sample " +
+        "performance with this many cross-validation folds, fitted in " +
+        "parallel (--jobs). Per-fold and pooled results are written in the " +
+        "format of test_model.py to the outfile name ending in _cv.csv.")
+    parser.add_argument('-g', '--group', default=None,
+        help="Optional column, e.g. pid, whose rows are always kept in the " +
+        "same cross-validation fold.")
+    parser.add_argument('--holdout', type=float, default=0.2,
+        help="Fraction of the data held out by --compare. Default: 0.2.")
+    parser.add_argument('--seed', type=int, default=0,
+        help="Random seed for the sgd solver, --compare and --cv. " +
+        "Default: 0.")
+    parser.add_argument('--profile', action='store_true',
+        help="Write a profile report (cProfile statistics, time and peak " +
+        "memory per phase) in the directory of the outfile. Processes " +
+        "fitting in parallel are included in the peak memory of child " +
+        "processes only. See scripts/profiling.py.")
     args = parser.parse_args()
     return args
 
-def main():
-    args = get_cli_args()
-    df = pd.read_csv(args.data)
-
-    if args.features is None:
-        X = df[df.columns.difference([args.truth]) + [args.truth]]
+def build_model(solver='svc', calibration='sigmoid', calibration_cv=5,
+    seed=0
+):
+    # Every solver is a Pipeline ending in an estimator with predict_proba,
+    # so the saved model works with Models.get_models in the same way.
+    if solver == 'svc':
+        classifier = SVC(kernel='linear', C=1, class_weight='balanced',
+            probability=True)
     else:
-        X = df[args.features + [args.truth]]
-    
-    X = X.dropna(subset=[args.truth])
-    y = X[args.truth]
-    X = X.drop(columns=[args.truth])
-
-    model = Pipeline([
+        if solver == 'linear':
+            estimator = LinearSVC(C=1, class_weight='balanced', dual=False)
+        else:
+            estimator = SGDClassifier(loss='hinge', class_weight='balanced',
+                early_stopping=True, random_state=seed)
+        # ensemble=False fits one calibration on cross-validated decision
+        # values and refits the estimator on all of the data, like
+        # SVC(probability=True) does internally.
+        classifier = CalibratedClassifierCV(estimator, method=calibration,
+            cv=calibration_cv, ensemble=False)
+    return Pipeline([
         ('scaler', StandardScaler()),
-        ('svm', SVC(kernel='linear', C=1, class_weight='balanced', probability=True))
+        ('svm', classifier)
     ])
+
+def compare_solvers(X, y, args):
+    X_train, X_test, y_train, y_test = train_test_split(X, y,
+        test_size=args.holdout, stratify=y, random_state=args.seed)
+    output = []
+    for solver in SOLVERS:
+        model = build_model(solver, args.calibration, args.calibration_cv,
+            args.seed)
+        start = time.time()
+        model.fit(X_train, y_train)
+        fit_time = time.time() - start
+        roc_auc = roc_auc_score(y_test, model.predict_proba(X_test)[:, 1])
+        output.append([solver, round(fit_time, 3), round(roc_auc, 3),
+            len(y_train), len(y_test)])
+    return pd.DataFrame(output, columns=['solver', 'fit_seconds', 'roc_auc',
+        'n_train', 'n_test'])
+
+def get_horizons(df, truth):
+    # Returns {horizon: truth column}, a single entry if truth has no '#'.
+    if '#' not in truth:
+        return {None: truth}
+    return {year: truth.replace('#', str(year)) for year in HORIZONS
+        if truth.replace('#', str(year)) in df.columns}
+
+def get_outfile(outfile, horizon):
+    if horizon is None:
+        return outfile
+    if '#' in outfile:
+        return outfile.replace('#', str(horizon))
+    name, extension = os.path.splitext(outfile)
+    return f"{name}_{horizon}{extension}"
+
+def get_data(df, truth, template, features, horizon=None):
+    # Returns the feature matrix and ground truth for one horizon. template
+    # is the truth argument, see feature_columns.
+    features = feature_columns(df, template, features, horizon)
+    X = df[features + [truth]]
+    X = X.dropna(subset=[truth])
+    y = X[truth]
+    X = X.drop(columns=[truth])
+    return X, y
+
+def fit_model(X, y, outfile, args):
+    model = build_model(args.solver, args.calibration, args.calibration_cv,
+        args.seed)
     model.fit(X, y)
-    joblib.dump(model, args.outfile)
+    joblib.dump(model, outfile)
+    if args.export:
+        export_linear_model(model, os.path.splitext(outfile)[0] + '.npz')
+    return outfile
+
+def fit_fold(F, train, test, columns, y_train, args):
+    # F is the feature matrix of the whole data set. joblib passes it to
+    # each worker process as one shared read-only memory map.
+    model = build_model(args.solver, args.calibration, args.calibration_cv,
+        args.seed)
+    model.fit(F[np.ix_(train, columns)], y_train)
+    return model.predict_proba(F[np.ix_(test, columns)])[:, 1]
+
+def cross_validate(df, horizons, args):
+    # The group column is never used as a feature.
+    exclude = None if args.group is None else [args.group]
+    features = {horizon: feature_columns(df, args.truth, args.features,
+        horizon, exclude) for horizon in horizons.keys()}
+    all_features = sorted(set(f for columns in features.values()
+        for f in columns))
+    non_numeric = [f for f in all_features
+        if not pd.api.types.is_numeric_dtype(df[f])]
+    if len(non_numeric) > 0:
+        raise Exception("Non-numeric feature columns: " +
+            ", ".join(non_numeric) + ". Select the features with -f.")
+    F = df[all_features].to_numpy(dtype=float)
+    groups = None if args.group is None else df[args.group].to_numpy()
+
+    jobs, folds = [], []
+    for horizon, truth in horizons.items():
+        columns = [all_features.index(f) for f in features[horizon]]
+        rows = np.flatnonzero(df[truth].notna().to_numpy())
+        y = df[truth].to_numpy()[rows].astype(int)
+        if groups is None:
+            splitter = StratifiedKFold(n_splits=args.cv, shuffle=True,
+                random_state=args.seed)
+            splits = splitter.split(rows, y)
+        else:
+            splitter = StratifiedGroupKFold(n_splits=args.cv, shuffle=True,
+                random_state=args.seed)
+            splits = splitter.split(rows, y, groups[rows])
+        for fold, (train, test) in enumerate(splits):
+            jobs.append(joblib.delayed(fit_fold)(F, rows[train], rows[test],
+                columns, y[train], args))
+            folds.append((horizon, fold, y[test]))
+
+    scores = joblib.Parallel(n_jobs=args.jobs, mmap_mode='r')(jobs)
+
+    results = pd.DataFrame()
+    for horizon in horizons.keys():
+        label = 'Fold' if horizon is None else f'Year {horizon} fold'
+        pooled_y, pooled_scores = [], []
+        for (fold_horizon, fold, y_test), fold_scores in zip(folds, scores):
+            if fold_horizon != horizon:
+                continue
+            results = pd.concat([results,
+                get_results(y_test, fold_scores, f'{label} {fold + 1}')])
+            pooled_y.append(y_test)
+            pooled_scores.append(fold_scores)
+        label = 'Pooled' if horizon is None else f'Year {horizon} pooled'
+        results = pd.concat([results, get_results(np.concatenate(pooled_y),
+            np.concatenate(pooled_scores), label)])
+    return results
+
+def main():
+    args = get_cli_args()
+    profiler = Profiler(args.profile)
+    run(args)
+    profiler.report(os.path.dirname(os.path.abspath(args.outfile)))
+
+def run(args):
+    with phase("read"):
+        df = pd.read_csv(args.data)
+    horizons = get_horizons(df, args.truth)
+    if len(horizons) == 0:
+        print(f"No columns found for truth column template {args.truth}.")
+        return
+
+    if args.compare:
+        for horizon, truth in horizons.items():
+            X, y = get_data(df, truth, args.truth, args.features, horizon)
+            print(f"Truth column: {truth}")
+            with phase("compare"):
+                print(compare_solvers(X, y, args).to_string(index=False))
+        return
+
+    if args.cv is not None:
+        with phase("cross-validate"):
+            results = cross_validate(df, horizons, args)
+        print(results.to_string(index=False))
+        filename = os.path.splitext(args.outfile)[0].replace('#', 'N')
+        results.to_csv(filename + '_cv.csv', index=False)
+        return
+
+    # The data set is read and parsed once; each horizon is fitted in its
+    # own process.
+    jobs = []
+    for horizon, truth in horizons.items():
+        X, y = get_data(df, truth, args.truth, args.features, horizon)
+        jobs.append(joblib.delayed(fit_model)(X, y,
+            get_outfile(args.outfile, horizon), args))
+    n_jobs = 1 if len(jobs) == 1 else args.jobs
+    with phase("fit"):
+        for outfile in joblib.Parallel(n_jobs=n_jobs)(jobs):
+            print(f"Saved {outfile}.")
 
-start = time.time()
-main()
-end = time.time()
-print(f"Completed execution in {end-start:.2f} seconds.")
\ No newline at end of file
+if __name__ == '__main__':
+    start = time.time()
+    main()
+    end = time.time()
+    print(f"Completed execution in {end-start:.2f} seconds.")
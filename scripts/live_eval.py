@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from io import StringIO
+import numpy as np
+import pandas as pd
+
+from metrics import ScoreHistogram, N_HISTOGRAM_BINS
+
+"""
+This script evaluates the predictions of the main.py portions (shards) while
+they are still running, from the sybil_partial_{start}_{end}.csv files to
+which main.py appends each prediction.
+
+- The new lines of each partial file are read, aligned with the actual values
+(nlst_actual.py) on pid and study year as in sybil_eval.py, and added to a
+ScoreHistogram of the shard (see metrics.py): the number of positives and
+negatives of each year in --bins score bins. Its memory does not depend on
+the number of predictions.
+- The histograms of the shards (and any given with --histograms, e.g. from
+watchers on other machines) are merged into the overall metrics: for each
+year, ROC AUC with a bound on its error, and sensitivity, specificity, PPV
+and NPV at the given cutoffs or at the Youden cutoff.
+- The offset read in each partial file and the histogram of each shard are
+kept in a state directory, so the script can be run periodically (e.g. by
+cron) instead of with --interval. When a shard is restarted, main.py
+replaces its partial file, whose histogram is then started again.
+
+The metrics of the complete evaluation are still those of sybil_eval.py on
+the merged predictions; these are available during a multi-day run.
+"""
+
+PARTIAL_RE = re.compile(r"^sybil_partial_(\d+)_(\d+)\.csv$")
+N_PREDICTION_YEARS = 6
+
+def main():
+    print("Sybil Live Evaluation")
+
+    # ArgParse library is used to manage command line arguments.
+    parser = argparse.ArgumentParser(
+        epilog="Example: live_eval.py path/to/actual.csv path/to/dicom_dir \
+        -i 600"
+    )
+    parser.add_argument("actual", help="A CSV file generated by \
+        nlst_actual.py.")
+    parser.add_argument("dicomdir", help="The directory passed to main.py, \
+        which contains the sybil_partial_{start}_{end}.csv files.")
+    parser.add_argument('-o', '--outfile', help="The CSV file of the \
+        metrics. Default: dicomdir/sybil_live_metrics.csv.", default=None)
+    parser.add_argument('-s', '--state', help="The directory in which read \
+        offsets and histograms are kept between runs. \
+        Default: dicomdir/sybil_live.", default=None)
+    parser.add_argument('-b', '--bins', help="Number of score bins of the \
+        histograms. The error of the AUC decreases with more bins. \
+        Default: 10000.", type=int, default=N_HISTOGRAM_BINS)
+    parser.add_argument('-c', '--cutoffs', help="Probability cutoffs of the \
+        confusion counts. Default: the Youden cutoff of each year.",
+        type=float, nargs='+', default=None)
+    parser.add_argument('--histograms', help="Histogram files (.npz) saved \
+        by other runs of this script, merged with those of dicomdir.",
+        nargs='+', default=[])
+    parser.add_argument('-i', '--interval', help="Update every INTERVAL \
+        seconds until every shard is complete. Default: 0 (update once).",
+        type=float, default=0)
+    args = parser.parse_args()
+    outfile = args.outfile
+    if outfile is None:
+        outfile = os.path.join(args.dicomdir, "sybil_live_metrics.csv")
+    state_dir = args.state
+    if state_dir is None:
+        state_dir = os.path.join(args.dicomdir, "sybil_live")
+    os.makedirs(state_dir, exist_ok=True)
+
+    actual = pd.read_csv(args.actual)
+    while True:
+        histograms, running = update_shards(args.dicomdir, actual, state_dir,
+            args.bins)
+        for file_path in args.histograms:
+            histograms.append(ScoreHistogram.load(file_path))
+        total = ScoreHistogram(N_PREDICTION_YEARS, args.bins)
+        for histogram in histograms:
+            total.merge(histogram)
+        results = summarize(total, args.cutoffs)
+        results.to_csv(outfile, index=False)
+        print(time.strftime("%Y-%m-%d %H:%M:%S"))
+        print(results.to_string(index=False))
+        if args.interval <= 0 or running == 0:
+            break
+        time.sleep(args.interval)
+
+def load_offsets(state_dir):
+    offsets_path = os.path.join(state_dir, "offsets.json")
+    if not os.path.isfile(offsets_path):
+        return {}
+    with open(offsets_path) as f:
+        return json.load(f)
+
+def save_offsets(offsets, state_dir):
+    offsets_path = os.path.join(state_dir, "offsets.json")
+    with open(offsets_path + ".tmp", 'w') as f:
+        json.dump(offsets, f)
+    os.replace(offsets_path + ".tmp", offsets_path)
+
+def read_new_lines(file_path, offset):
+    # Returns the header, the complete lines after offset, the new offset and
+    # the inode of the file, which changes when main.py replaces it.
+    with open(file_path, 'rb') as f:
+        inode = os.fstat(f.fileno()).st_ino
+        header = f.readline()
+        offset = max(offset, len(header))
+        f.seek(offset)
+        content = f.read()
+    # The last line may still be incomplete.
+    end = content.rfind(b"\n") + 1
+    return header, content[:end], offset + end, inode
+
+def aligned_labels(actual, predictions):
+    # Truth and scores of the new predictions, aligned as in sybil_eval.py.
+    labels = ["canc_yr" + str(i) for i in range(1, N_PREDICTION_YEARS + 1)]
+    scores = ["pred_yr" + str(i) for i in range(1, N_PREDICTION_YEARS + 1)]
+    aligned = actual[["pid", "study_yr"] + labels].merge(
+        predictions[["pid", "study_yr"] + scores], on=["pid", "study_yr"],
+        how="inner")
+    return aligned[labels].to_numpy(), aligned[scores].to_numpy()
+
+def update_shards(dicomdir, actual, state_dir, n_bins):
+    # Adds the new predictions of each shard to its histogram. Returns the
+    # histograms and the number of shards still running.
+    offsets = load_offsets(state_dir)
+    histograms = []
+    running = 0
+    for file_name in sorted(os.listdir(dicomdir)):
+        match = PARTIAL_RE.match(file_name)
+        if match is None:
+            continue
+        name = f"{match.group(1)}_{match.group(2)}"
+        histogram_path = os.path.join(state_dir, f"histogram_{name}.npz")
+        file_path = os.path.join(dicomdir, file_name)
+        try:
+            inode = os.stat(file_path).st_ino
+        except OSError:
+            # Being replaced by main.py.
+            continue
+        # [inode, offset] read so far; a new inode is a restarted shard.
+        previous = offsets.get(name)
+        offset = 0
+        histogram = ScoreHistogram(N_PREDICTION_YEARS, n_bins)
+        if previous is not None and previous[0] == inode and \
+            os.path.isfile(histogram_path):
+            offset = previous[1]
+            histogram = ScoreHistogram.load(histogram_path)
+            if histogram.n_bins != n_bins:
+                raise Exception(f"{histogram_path} has {histogram.n_bins} " +
+                    f"bins, not {n_bins}.")
+
+        header, lines, new_offset, read_inode = read_new_lines(file_path,
+            offset)
+        if read_inode != inode:
+            # Replaced since it was checked: read at the next update.
+            running += 1
+            continue
+        if len(lines) > 0:
+            predictions = pd.read_csv(StringIO((header + lines).decode()))
+            truth, scores = aligned_labels(actual, predictions)
+            histogram.update(truth, scores)
+        histogram.save(histogram_path)
+        offsets[name] = [inode, new_offset]
+        histograms.append(histogram)
+        if not os.path.isfile(os.path.join(dicomdir,
+            f"sybil_predictions_{name}.csv")):
+            running += 1
+    save_offsets(offsets, state_dir)
+    print(f"Shards: {len(histograms)}, running: {running}.")
+    return histograms, running
+
+def summarize(histogram, cutoffs=None):
+    # ROC AUC and confusion metrics of each year, one row per cutoff.
+    positives, negatives = histogram.totals()
+    auc = histogram.roc_auc()
+    error = histogram.auc_error()
+    n_years = histogram.positives.shape[0]
+    if cutoffs is None:
+        year_cutoffs = histogram.youden_cutoffs()[:, None]
+    else:
+        year_cutoffs = np.tile(np.asarray(cutoffs, dtype=float), (n_years, 1))
+    rows = []
+    for year in range(n_years):
+        for cutoff in year_cutoffs[year]:
+            if np.isnan(cutoff):
+                # No positives or no negatives yet.
+                counts = [np.nan] * 4
+            else:
+                counts = [int(x[year, 0]) for x in histogram.counts([cutoff])]
+            rows.append([f"year{year + 1}", int(positives[year] +
+                negatives[year]), int(positives[year]), auc[year],
+                error[year], cutoff] + rates(*counts) + counts)
+    return pd.DataFrame(rows, columns=["year", "n", "n_positive", "roc_auc",
+        "roc_auc_error", "cutoff", "sensitivity", "specificity", "ppv", "npv",
+        "tn", "fp", "fn", "tp"]).round(5)
+
+def rates(tn, fp, fn, tp):
+    sensitivity = tp/(tp+fn) if (tp+fn) != 0 else np.nan
+    specificity = tn/(tn+fp) if (tn+fp) != 0 else np.nan
+    ppv = tp/(tp+fp) if (tp+fp) != 0 else np.nan
+    npv = tn/(tn+fn) if (tn+fn) != 0 else np.nan
+    return [sensitivity, specificity, ppv, npv]
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
@@ -1,14 +1,22 @@
 from sybil import Serie, Sybil
 from pydicom import dcmread
+import numpy as np
 import pandas as pd
-from os import listdir, path
+import torch
+from os import listdir, path, replace, cpu_count, scandir
 import time
 import sys
+import csv
+import re
 from math import ceil
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
+from profiling import Profiler, phase
+
 """
-This script is utilized by sybil_dir.sif, and must be in the same directory.
+This script is utilized by sybil_dir.sif, and must be in the same directory,
+along with profiling.py.
 
 The DICOMs must be in the same directory structure as if they were downloaded
 via the NBIA retriever tool. See README for more details.
@@ -17,6 +25,24 @@ via the NBIA retriever tool. See README for more details.
 #CONSTANTS
 STUDY_YEAR_INDEX = ["1999", "2000", "2001"]
 MINIMUM_IMAGE_COUNT = 10
+# Number of slices of a series read and decoded concurrently (1: Sybil's
+# own loader reads them in turn). See decode_slices.
+SLICE_THREADS = 1
+# Number of ensemble members run concurrently (1: Sybil runs them in turn).
+ENSEMBLE_WORKERS = 1
+# Failure registry: one file per portion, all read by every portion.
+FAILURE_RE = re.compile(r"^sybil_failures_\d+_\d+\.csv$")
+FAILURE_COLUMNS = ["file_location", "category", "exception", "detail",
+    "signature", "time"]
+# Failures that recur as long as the files are unchanged, skipped on reruns.
+# Other failures (e.g. model errors, which may be out of memory) are recorded
+# but retried.
+SKIPPED_FAILURES = ["missing directory", "unsupported transfer syntax",
+    "pixel data conversion"]
+# Category recorded when a DICOM of the registry is scored.
+SUCCESS = "success"
+PREDICTION_COLUMNS = ["pid", "study_yr", "unique_id", "pred_yr1", "pred_yr2",
+    "pred_yr3", "pred_yr4", "pred_yr5", "pred_yr6", "metadata_index"]
 
 def main():
     print("Sybil Prediction")
@@ -33,54 +59,144 @@ def main():
         the data to be evaluated. This option allows for concurrent instances \
         of Sybil to evaluate different portions of the same directory in \
         parallel. Examples: \
-        1/5 is the first 20%% of the data. 5/5 is the last 20%% of the data.",
+        1/5 is the first 20%% of the data. 5/5 is the last 20%% of the data. \
+        A range of metadata.csv indexes can also be given, e.g. 100-249, \
+        to rerun the missing ranges reported by merge_predictions.py.",
         default="keep_all")
     parser.add_argument("-m", "--minimages", help="Identifies the minimum \
         number of images required for the DICOM to be included for evaluation. \
         If the value is below this minimum, it is considered to be a scout \
         image. Default = 10 images.", type=int, default=MINIMUM_IMAGE_COUNT)
+    parser.add_argument("-t", "--threads", help="Number of slices of a DICOM \
+        read and decoded concurrently, which hides the latency of network \
+        file systems. Relies on internals of Sybil 1.x, see decode_slices. \
+        1 reads them one at a time with Sybil's loader. Default = 1.", type=int,
+        default=SLICE_THREADS)
+    parser.add_argument("-e", "--ensemble-workers", help="Number of members \
+        of the Sybil ensemble run concurrently on each DICOM, sharing one \
+        decoded volume and dividing the CPU cores between them. Their \
+        predictions are combined as by Sybil. 1 runs them one after the \
+        other. Default = 1.", type=int, default=ENSEMBLE_WORKERS)
+    parser.add_argument("--retry-failed", action="store_true", help="Evaluate \
+        the DICOMs recorded in the failure registry again, even if their \
+        files did not change. Otherwise missing directories, unsupported \
+        transfer syntaxes and pixel data conversion failures are skipped, \
+        and other failures are retried.")
+    parser.add_argument("--profile", action="store_true", help="Write a \
+        profile report (cProfile statistics, time and peak memory per phase) \
+        in dicomdir, named after the portion. See profiling.py.")
     args = parser.parse_args()
     print("DICOM Directory:", args.dicomdir)
     print("Portion:", args.portion)
     print("Minimum images:", args.minimages)
+    print("Threads:", args.threads)
+    print("Ensemble workers:", args.ensemble_workers)
+    print("Retry failed:", args.retry_failed)
 
     # Simple directory check:
-    root_dir_contents = listdir(args.dicomdir)
-    if ("metadata.csv" not in root_dir_contents or
-        "NLST" not in root_dir_contents
-    ):
+    if not check_dicomdir(args.dicomdir):
         print("Invalid directory structure. Please see README.")
         return
 
-    # Load a trained model
-    model = Sybil("sybil_ensemble")
+    profiler = Profiler(args.profile)
 
-    # Set up output dataframe
-    output = pd.DataFrame(columns=[
-        "pid", "study_year", "unique_id", 
-        "yr1", "yr2", "yr3", "yr4", "yr5", "yr6"
-    ])
+    # Concurrent members share the cores instead of each using all of them.
+    if args.ensemble_workers > 1:
+        torch.set_num_threads(max(1, cpu_count() // args.ensemble_workers))
+
+    output_df, excluded_df, start_index, end_index = predict_directory(
+        args.dicomdir, args.portion, args.minimages, threads=args.threads,
+        ensemble_workers=args.ensemble_workers,
+        retry_failed=args.retry_failed)
+
+    # Save output CSV in output directory
+    with phase("write"):
+        output_df.to_csv(args.dicomdir + 
+            f"/sybil_predictions_{start_index}_{end_index}.csv",
+            index = False)      
+        # Excluded DICOMs are saved too, so that merge_predictions.py can
+        # verify that every metadata.csv row was either scored or excluded.
+        excluded_df.to_csv(args.dicomdir +
+            f"/sybil_excluded_{start_index}_{end_index}.csv",
+            index = False)
+
+    profiler.report(args.dicomdir, f"_{start_index}_{end_index}")
+
+def check_dicomdir(dicomdir):
+    # The directory must be structured as downloaded by the NBIA retriever.
+    root_dir_contents = listdir(dicomdir)
+    return ("metadata.csv" in root_dir_contents and
+        "NLST" in root_dir_contents)
+
+def get_portion(row_count, portion="keep_all"):
+    # Returns the first and last metadata.csv index of a portion, e.g. 1/5,
+    # or of an index range, e.g. 100-249.
+    if portion == "keep_all":
+        return 0, row_count - 1
+    if "-" in portion:
+        start_index, end_index = [int(i) for i in portion.split("-")]
+        if start_index > end_index or end_index >= row_count:
+            raise Exception(f"Invalid range {portion} for {row_count} " +
+                "metadata.csv rows.")
+        return start_index, end_index
+    portion = [int(i) for i in portion.split("/")]
+    start_index = int(ceil(row_count / portion[1]) * (portion[0] - 1))
+    end_index = int(min(
+        start_index + ceil(row_count / portion[1]) - 1, row_count - 1
+    ))
+    return start_index, end_index
+
+def predict_directory(dicomdir, portion="keep_all",
+    minimages=MINIMUM_IMAGE_COUNT, model=None, threads=SLICE_THREADS,
+    ensemble_workers=ENSEMBLE_WORKERS, retry_failed=False):
+    # Runs Sybil on a portion of an NBIA download directory and returns the
+    # predictions and the excluded DICOMs as DataFrames, along with the
+    # metadata.csv index range.
+    # DICOMs which failed in a previous run (failure registry) for a reason
+    # in SKIPPED_FAILURES are skipped without being read, unless their files
+    # changed or retry_failed.
+    if not check_dicomdir(dicomdir):
+        raise Exception("Invalid directory structure. Please see README.")
+
+    # Load a trained model
+    if model is None:
+        with phase("load model"):
+            model = Sybil("sybil_ensemble")
 
     # Read in metadata CSV file
-    metadata = pd.read_csv(args.dicomdir + "/metadata.csv")
+    with phase("read metadata"):
+        metadata = pd.read_csv(dicomdir + "/metadata.csv")
     row_count = metadata.shape[0]
 
     # Take a portion of the metadata
-    if args.portion != "keep_all":
-        portion = [int(i) for i in args.portion.split("/")]
-        start_index = int(ceil(row_count / portion[1]) * (portion[0] - 1))
-        end_index = int(min(
-            start_index + ceil(row_count / portion[1]) - 1, row_count - 1
-        ))
-        metadata = metadata.loc[start_index:end_index,:]
-        row_count = metadata.shape[0]
+    start_index, end_index = get_portion(row_count, portion)
+    metadata = metadata.loc[start_index:end_index,:]
+    row_count = metadata.shape[0]
 
     output = [] 
+    # Rows of metadata.csv that were not scored: index, location, reason.
+    excluded = []
     n_excluded = 0  
 
+    # Failures of previous runs of any portion, and the file in which this
+    # portion records its failures.
+    failures = load_failures(dicomdir)
+    failure_file = dicomdir + f"/sybil_failures_{start_index}_{end_index}.csv"
+
+    # Start time recorded in the progress file, see monitor.py.
+    started = time.time()
+
+    # Predictions are also appended to a partial file as they are made, so
+    # that live_eval.py can evaluate them before the portion is complete.
+    # The file of a previous run of the portion is replaced by a new file,
+    # which live_eval.py recognizes and reads from the start.
+    partial_file = dicomdir + f"/sybil_partial_{start_index}_{end_index}.csv"
+    append_partial(partial_file + ".tmp", PREDICTION_COLUMNS, mode='w')
+    replace(partial_file + ".tmp", partial_file)
+
     # Logging
     print("Sybil prediction to be performed on contents of:" +
-        f"\n{args.dicomdir}" +
+        f"\n{dicomdir}" +
         f"\nFrom index {start_index} to index {end_index}."
     )
 
@@ -91,29 +207,56 @@ def main():
         #Logging
         print(f"Evaluating {file_path}.")
         
+        full_dir = dicomdir + file_path
+
+        # Known failure, with the same files as when it failed.
+        failure = failures.get(file_path)
+        if failure is not None and not retry_failed and \
+            failure["category"] in SKIPPED_FAILURES and \
+            failure["signature"] == directory_signature(full_dir):
+            print(f"Known failure ({failure['category']}: " +
+                f"{failure['exception']}). Skipping.")
+            excluded.append([index, file_path,
+                f"known failure: {failure['category']}"])
+            n_excluded += 1
+            continue
+
         # Exclusion criteria: directory does not exist
-        full_dir = args.dicomdir + file_path
         if not path.exists(full_dir):
             print("Directory does not exist. Skipping.")
+            record_failure(failure_file, file_path, "missing directory",
+                None, directory_signature(full_dir))
+            excluded.append([index, file_path, "missing directory"])
             n_excluded += 1
             continue
 
         # Exclusion criteria: scout image, made up of 1-2 images.
         n_slices = row["Number of Images"]
-        if n_slices < args.minimages:
-            print(f"This DICOM has too few slices (< {args.minimages})." +
+        if n_slices < minimages:
+            print(f"This DICOM has too few slices (< {minimages})." +
                 "Skipping.")
+            excluded.append([index, file_path, "too few slices"])
             n_excluded += 1
             continue
 
         # Reading in first slice of the DICOM for verification.
-        dcm = dcmread(
-            full_dir + "/" + listdir(args.dicomdir + file_path)[0]
-        )
+        try:
+            with phase("read first slice"):
+                dcm = dcmread(
+                    full_dir + "/" + listdir(dicomdir + file_path)[0]
+                )
+        except Exception as e:
+            print(f"Unable to read the first slice ({e}). Skipping.")
+            record_failure(failure_file, file_path, "unreadable file", e,
+                directory_signature(full_dir))
+            excluded.append([index, file_path, "unreadable file"])
+            n_excluded += 1
+            continue
 
         # Exclusion criteria: cannot read slice thickness.
         if not hasattr(dcm, "SliceThickness"):
             print("Cannot read slice thickness. Skipping.")
+            excluded.append([index, file_path, "no slice thickness"])
             n_excluded += 1
             continue
         else:
@@ -122,14 +265,21 @@ def main():
             slice_thickness = float(dcm.SliceThickness)
             if slice_thickness > 5.0:
                 print("Slice thickness is too large (> 5 mm). Skipping.")
+                excluded.append([index, file_path, "slice thickness > 5 mm"])
                 n_excluded += 1
                 continue
 
         # Exclusion criteria: Pydicom is unable to convert pixel data.
         try:
-            dcm.convert_pixel_data()
-        except:
-            print("Pydicom unable to convert pixel data. Skipping.")
+            with phase("convert pixel data"):
+                dcm.convert_pixel_data()
+        except Exception as e:
+            category = classify_pixel_error(e)
+            print(f"Pydicom unable to convert pixel data ({category}: {e})." +
+                " Skipping.")
+            record_failure(failure_file, file_path, category, e,
+                directory_signature(full_dir))
+            excluded.append([index, file_path, category])
             n_excluded += 1
             continue
 
@@ -152,56 +302,227 @@ def main():
 
         # Evaluate probabilities with Sybil.
         try:
-            scores = evaluate(args.dicomdir + file_path, model)
+            with phase("predict"):
+                scores = evaluate(dicomdir + file_path, model, threads,
+                    ensemble_workers)
             # Rounding for legibility
             scores = [round(i, 5) for i in scores]
             
             # Output current progress to text file
             write_progress(index + 1 - start_index, row_count, n_excluded, 
-                args.dicomdir + f"/progress_{start_index}_{end_index}.out",
-                start_index, end_index
+                dicomdir + f"/progress_{start_index}_{end_index}.out",
+                start_index, end_index, started
             )
 
             # Add row to final output.
-            output.append(output_row + scores)
-        except:
-            print("Evaluation failed. Skipping.")
+            output.append(output_row + scores + [index])
+        except Exception as e:
+            print(f"Evaluation failed ({type(e).__name__}: {e}). Skipping.")
+            record_failure(failure_file, file_path, "model error", e,
+                directory_signature(full_dir))
+            excluded.append([index, file_path, "model error"])
+            n_excluded += 1
             continue
+        append_partial(partial_file, output[-1])
+        # Clears the failure of the registry.
+        if file_path in failures:
+            record_failure(failure_file, file_path, SUCCESS, None,
+                directory_signature(full_dir))
 
     # Convert output into a Pandas DataFrame.
-    output_df = pd.DataFrame(output, columns=[
-        "pid",
-        "study_yr",
-        "unique_id",
-        "pred_yr1",
-        "pred_yr2",
-        "pred_yr3",
-        "pred_yr4",
-        "pred_yr5",
-        "pred_yr6"
+    output_df = pd.DataFrame(output, columns=PREDICTION_COLUMNS)
+    excluded_df = pd.DataFrame(excluded, columns=[
+        "metadata_index",
+        "file_location",
+        "reason"
     ])
-    # Save output CSV in output directory
-    output_df.to_csv(args.dicomdir + 
-        f"/sybil_predictions_{start_index}_{end_index}.csv",
-        index = False)      
+    return output_df, excluded_df, start_index, end_index
 
-def evaluate(file_path, model):
+def evaluate(file_path, model, threads=SLICE_THREADS,
+    ensemble_workers=ENSEMBLE_WORKERS):
     start = time.perf_counter()
-    serie = Serie([file_path + "/" + 
-        i for i in listdir(file_path)])
-    scores = model.predict([serie])
+    paths = [file_path + "/" + i for i in listdir(file_path)]
+    restore = None
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            with phase("read slices"):
+                read_slices(paths, executor)
+            serie = Serie(paths)
+            with phase("decode slices"):
+                restore = decode_slices(serie, executor)
+    else:
+        serie = Serie(paths)
+    try:
+        with phase("sybil"):
+            scores = None
+            if ensemble_workers > 1:
+                with ThreadPoolExecutor(max_workers=ensemble_workers) as \
+                    executor:
+                    scores = predict_ensemble(model, serie, executor)
+            if scores is None:
+                scores = model.predict([serie]).scores[0]
+    finally:
+        if restore is not None:
+            restore()
     end = time.perf_counter()
     print(f"Prediction on {file_path} in {end - start:0.4f} seconds.")
-    return scores.scores[0]
+    return scores
+
+def predict_ensemble(model, serie, executor):
+    # Runs the members of the Sybil ensemble concurrently on the volume of the
+    # serie, assembled once, and combines them as Sybil.predict does: mean of
+    # the members' probabilities, then calibration. PyTorch releases the GIL
+    # during inference, so threads run the members on separate cores without
+    # copying the models or the volume to other processes. Returns None if
+    # this version of Sybil does not expose the members.
+    members = getattr(model, "ensemble", None)
+    if members is None or not hasattr(model, "_calibrate") or \
+        not hasattr(serie, "get_volume"):
+        return None
+    volume = serie.get_volume()
+    device = getattr(model, "device", None)
+    if device is not None:
+        volume = volume.to(device)
+
+    def run(member):
+        with torch.no_grad():
+            output = member(volume)
+        return output["logit"].sigmoid().squeeze(0).cpu().numpy()
+
+    scores = np.mean(np.array(list(executor.map(run, members))), axis=0)
+    return model._calibrate(scores[np.newaxis, :])[0].tolist()
+
+def read_slices(paths, executor):
+    # Reads the slice files of a series concurrently. This brings them into
+    # the page cache, so that the header of each slice, read one at a time
+    # by Serie (which also orders the slices), no longer waits for the file
+    # system.
+    def read(path):
+        with open(path, "rb") as f:
+            return len(f.read())
+
+    for _ in executor.map(read, paths):
+        pass
+
+def decode_slices(serie, executor):
+    # Decodes the slices of a Serie concurrently with its own loader (which
+    # applies the modality LUT and windowing), and hands the decoded slices to
+    # Sybil: the loader then returns them instead of reading the files again
+    # when the model assembles the volume. A slice that fails to decode is
+    # loaded again by Sybil, which reports the error.
+    # This replaces a private method of Sybil: it was written against the
+    # Serie of Sybil 1.x (sybil/serie.py), whose _meta.paths lists the
+    # ordered slices and whose _loader.load_input(path, sample) loads one.
+    # Versions of Sybil without these attributes load the slices one at a
+    # time as before; check them again before using --threads with another
+    # version. Returns a function restoring the loader, or None.
+    loader = getattr(serie, "_loader", None)
+    meta = getattr(serie, "_meta", None)
+    if loader is None or meta is None or not hasattr(loader, "load_input"):
+        return None
+    load_input = loader.load_input
+
+    def decode(path):
+        try:
+            return load_input(path, {})
+        except Exception:
+            return None
+
+    decoded = dict(zip(meta.paths, executor.map(decode, meta.paths)))
+
+    def load_decoded(path, sample):
+        array = decoded.pop(path, None)
+        return array if array is not None else load_input(path, sample)
 
-def write_progress(current, total, excluded, file_name, start_i, end_i):
-    f = open(file_name, 'w')
+    loader.load_input = load_decoded
+
+    def restore():
+        # Removes the instance attribute, exposing the loader's own method.
+        decoded.clear()
+        if vars(loader).get("load_input") is load_decoded:
+            del loader.load_input
+
+    return restore
+
+def directory_signature(full_dir):
+    # Number of files, total size and latest modification time of a DICOM
+    # directory, which change when its files are downloaded again.
+    if not path.isdir(full_dir):
+        return "missing"
+    n_files, size, modified = 0, 0, 0
+    for entry in scandir(full_dir):
+        if entry.is_file():
+            stat = entry.stat()
+            n_files += 1
+            size += stat.st_size
+            modified = max(modified, int(stat.st_mtime))
+    return f"{n_files}:{size}:{modified}"
+
+def classify_pixel_error(error):
+    # pydicom reports compressed transfer syntaxes without an installed pixel
+    # data handler with NotImplementedError, or with a message naming the
+    # transfer syntax or the missing handlers.
+    message = str(error).lower()
+    if isinstance(error, NotImplementedError) or "transfer syntax" in message \
+        or "handler" in message:
+        return "unsupported transfer syntax"
+    return "pixel data conversion"
+
+def load_failures(dicomdir):
+    # Returns {file location: failure} from the failure files of every
+    # portion, keeping the latest failure of each DICOM. DICOMs scored since
+    # their latest failure are left out.
+    failures = {}
+    for file_name in sorted(listdir(dicomdir)):
+        if not FAILURE_RE.match(file_name):
+            continue
+        failure_df = pd.read_csv(path.join(dicomdir, file_name), dtype=str,
+            keep_default_na=False)
+        for failure in failure_df.to_dict("records"):
+            previous = failures.get(failure["file_location"])
+            if previous is None or float(failure["time"]) >= \
+                float(previous["time"]):
+                failures[failure["file_location"]] = failure
+    failures = {location: failure for location, failure in failures.items()
+        if failure["category"] != SUCCESS}
+    if len(failures) > 0:
+        print(f"Failure registry: {len(failures)} DICOMs.")
+    return failures
+
+def record_failure(file_name, file_path, category, error, signature):
+    # Appends a failure (or a success, see load_failures) to the registry
+    # file of the portion.
+    exception = "" if error is None else type(error).__name__
+    detail = "" if error is None else str(error)
+    new_file = not path.isfile(file_name)
+    with open(file_name, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(FAILURE_COLUMNS)
+        writer.writerow([file_path, category, exception, detail, signature,
+            f"{time.time():0.3f}"])
+
+def append_partial(file_name, row, mode='a'):
+    # Writes one line of the partial predictions file. The file is closed
+    # after each line, so that live_eval.py reads complete lines.
+    with open(file_name, mode, newline='') as f:
+        csv.writer(f).writerow(row)
+
+def write_progress(current, total, excluded, file_name, start_i, end_i,
+    started=None):
+    # The file is replaced atomically so that monitor.py never reads a
+    # partially written file.
+    f = open(file_name + ".tmp", 'w')
     f.write(f"metadata.csv {start_i} to {end_i}:\n")
     f.write(f"Current progress: {current} / {total}. " +
         f"{excluded} excluded.\n")
+    if started is not None:
+        f.write(f"Started: {started:0.0f}\n")
     f.close()
+    replace(file_name + ".tmp", file_name)
 
-start = time.perf_counter()
-main()
-end = time.perf_counter()
-print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
@@ -0,0 +1,241 @@
+import argparse
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+"""
+This script merges the prediction files written by main.py, one per
+--portion, into a single CSV file for nlst_actual.py/sybil_eval.py, and
+verifies that the portions cover metadata.csv.
+
+- Shards (sybil_predictions_{start}_{end}.csv) are found in the DICOM
+directory, or given with --shards. They are read in chunks and written to the
+output file one chunk at a time, with fixed column types, so the whole set of
+predictions is never held in memory.
+- Every metadata.csv row must be either scored (metadata_index column of the
+predictions) or excluded (sybil_excluded_{start}_{end}.csv) exactly once.
+Rows covered by no shard, or by a shard which failed before writing its
+output, are reported as missing ranges, along with the main.py command to
+rerun each of them (-p start-end). Rows scored more than once, e.g. by
+overlapping shards, are reported and only written once.
+- Shards written before main.py recorded metadata_index and exclusions can
+still be merged, but only their index range can be checked, not their
+individual rows.
+
+The merged exclusions are written next to the output file, with the suffix
+_excluded.csv. The script exits with code 1 if any row is missing or
+duplicated.
+"""
+
+SHARD_RE = re.compile(r"^sybil_predictions_(\d+)_(\d+)\.csv$")
+PREDICTION_DTYPES = {
+    "pid": "int64",
+    "study_yr": "int64",
+    "unique_id": "string",
+    "pred_yr1": "float64",
+    "pred_yr2": "float64",
+    "pred_yr3": "float64",
+    "pred_yr4": "float64",
+    "pred_yr5": "float64",
+    "pred_yr6": "float64",
+    "metadata_index": "Int64"
+}
+CHUNK_SIZE = 100000
+
+def main():
+    print("Sybil Prediction Merge")
+
+    # ArgParse library is used to manage command line arguments.
+    parser = argparse.ArgumentParser(
+        epilog="Example: merge_predictions.py path/to/dicom_dir \
+        -o path/to/sybil_predictions.csv"
+    )
+    parser.add_argument("dicomdir", help="The directory passed to main.py. \
+        It contains metadata.csv and the sybil_predictions_{start}_{end}.csv \
+        files written by each portion.")
+    parser.add_argument('-o', '--outfile', help="The merged CSV file. \
+        Default: dicomdir/sybil_predictions.csv.", default=None)
+    parser.add_argument('-s', '--shards', help="Prediction files to merge \
+        instead of every sybil_predictions_{start}_{end}.csv file in \
+        dicomdir.", nargs='+', default=None)
+    parser.add_argument('--chunksize', help="Number of rows read at a time. \
+        Default: 100000.", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    outfile = args.outfile
+    if outfile is None:
+        outfile = os.path.join(args.dicomdir, "sybil_predictions.csv")
+    print("DICOM Directory:", args.dicomdir)
+    print("Output file:", outfile)
+
+    shards = find_shards(args.dicomdir) if args.shards is None \
+        else parse_shards(args.shards)
+    row_count = count_metadata_rows(os.path.join(args.dicomdir,
+        "metadata.csv"))
+    report = merge_shards(shards, outfile, row_count, args.chunksize)
+    print_report(report, args.dicomdir)
+    if len(report["missing"]) > 0 or len(report["duplicated"]) > 0:
+        sys.exit(1)
+
+def parse_shards(paths):
+    # Returns (start, end, path) for each prediction file, sorted by start.
+    shards = []
+    for shard_path in paths:
+        match = SHARD_RE.match(os.path.basename(shard_path))
+        if match is None:
+            raise Exception(f"Invalid prediction file name: {shard_path}. " \
+                "\nPrediction files are named " \
+                "sybil_predictions_{start}_{end}.csv by main.py.")
+        shards.append((int(match.group(1)), int(match.group(2)), shard_path))
+    return sorted(shards)
+
+def find_shards(directory):
+    return parse_shards([os.path.join(directory, f)
+        for f in os.listdir(directory) if SHARD_RE.match(f)])
+
+def excluded_path(shard_path):
+    directory, file_name = os.path.split(shard_path)
+    return os.path.join(directory,
+        file_name.replace("sybil_predictions_", "sybil_excluded_", 1))
+
+def count_metadata_rows(metadata_path):
+    # Only the first column is parsed.
+    return pd.read_csv(metadata_path, usecols=[0]).shape[0]
+
+def read_shard(shard_path, chunksize):
+    try:
+        for chunk in pd.read_csv(shard_path, chunksize=chunksize,
+            dtype=PREDICTION_DTYPES):
+            # Shards written before metadata_index was recorded.
+            if "metadata_index" not in chunk.columns:
+                chunk["metadata_index"] = pd.array([pd.NA] * len(chunk),
+                    dtype="Int64")
+            yield chunk[list(PREDICTION_DTYPES.keys())]
+    except (ValueError, KeyError) as e:
+        raise Exception(f"Invalid prediction file {shard_path}: {e}")
+
+def merge_shards(shards, outfile, row_count, chunksize=CHUNK_SIZE):
+    # Streams the shards into outfile and returns the coverage report.
+    # coverage counts how many times each metadata.csv row was scored or
+    # excluded; written marks the rows already written to outfile.
+    coverage = np.zeros(row_count, dtype=np.int64)
+    written = np.zeros(row_count, dtype=bool)
+    # Rows covered by shards whose rows cannot be checked individually.
+    unchecked = np.zeros(row_count, dtype=bool)
+    report = {"shards": [], "row_count": row_count, "out_of_range": []}
+
+    excluded_outfile = os.path.splitext(outfile)[0] + "_excluded.csv"
+    header = True
+    excluded_header = True
+    n_written = 0
+    for start, end, shard_path in shards:
+        if end >= row_count:
+            raise Exception(f"{shard_path} ends at index {end}, but " \
+                f"metadata.csv only has {row_count} rows.")
+        # Without an exclusion file (shards written by older versions of
+        # main.py), a shard counts as covering its whole range once.
+        shard_excluded = excluded_path(shard_path)
+        checked = os.path.isfile(shard_excluded)
+        n_scored = 0
+        for chunk in read_shard(shard_path, chunksize):
+            indexes = chunk["metadata_index"]
+            known = indexes.notna().to_numpy()
+            index_values = indexes[known].to_numpy(dtype=np.int64)
+            outside = (index_values < start) | (index_values > end)
+            if outside.any():
+                report["out_of_range"].append((shard_path,
+                    index_values[outside].tolist()))
+            # Rows already written by a previous shard (or earlier in the
+            # same chunk) are counted but not written again.
+            keep = np.ones(len(chunk), dtype=bool)
+            inside = index_values[~outside]
+            _, first_positions = np.unique(inside, return_index=True)
+            first = np.zeros(len(inside), dtype=bool)
+            first[first_positions] = True
+            first &= ~written[inside]
+            keep_known = np.zeros(len(index_values), dtype=bool)
+            keep_known[~outside] = first
+            keep[known] = keep_known
+            written[inside] = True
+            if checked:
+                np.add.at(coverage, inside, 1)
+            chunk[keep].to_csv(outfile, mode='w' if header else 'a',
+                header=header, index=False)
+            header = False
+            n_written += int(keep.sum())
+            n_scored += len(chunk)
+
+        n_excluded = 0
+        if checked:
+            excluded_df = pd.read_csv(shard_excluded)
+            index_values = excluded_df["metadata_index"].to_numpy(
+                dtype=np.int64)
+            np.add.at(coverage, index_values[(index_values >= start) &
+                (index_values <= end)], 1)
+            excluded_df.to_csv(excluded_outfile,
+                mode='w' if excluded_header else 'a',
+                header=excluded_header, index=False)
+            excluded_header = False
+            n_excluded = excluded_df.shape[0]
+        else:
+            coverage[start:end + 1] += 1
+            unchecked[start:end + 1] = True
+        report["shards"].append({"path": shard_path, "start": start,
+            "end": end, "scored": n_scored, "excluded": n_excluded,
+            "checked": checked})
+
+    if header:
+        # No shards: an empty file with the expected columns.
+        pd.DataFrame({c: pd.Series(dtype=t) for c, t in
+            PREDICTION_DTYPES.items()}).to_csv(outfile, index=False)
+
+    report["written"] = n_written
+    report["missing"] = to_ranges(np.flatnonzero(coverage == 0))
+    report["duplicated"] = to_ranges(np.flatnonzero(coverage > 1))
+    report["unchecked"] = to_ranges(np.flatnonzero(unchecked))
+    return report
+
+def to_ranges(indexes):
+    # Converts sorted indexes into (start, end) ranges of consecutive indexes.
+    if len(indexes) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indexes) != 1)
+    starts = np.concatenate([[indexes[0]], indexes[breaks + 1]])
+    ends = np.concatenate([indexes[breaks], [indexes[-1]]])
+    return [(int(s), int(e)) for s, e in zip(starts, ends)]
+
+def format_ranges(ranges):
+    return ", ".join(f"{s}-{e}" if s != e else str(s) for s, e in ranges)
+
+def print_report(report, dicomdir):
+    print(f"metadata.csv rows: {report['row_count']}")
+    for shard in report["shards"]:
+        checked = "" if shard["checked"] else \
+            " (no exclusion file: range only)"
+        print(f"{os.path.basename(shard['path'])}: {shard['scored']} " +
+            f"scored, {shard['excluded']} excluded{checked}")
+    print(f"Predictions written: {report['written']}")
+    for shard_path, index_values in report["out_of_range"]:
+        print(f"{shard_path} contains rows outside of its range: " +
+            format_ranges(to_ranges(np.array(sorted(set(index_values))))))
+    if len(report["unchecked"]) > 0:
+        print("Rows only checked by range: " +
+            format_ranges(report["unchecked"]))
+    if len(report["duplicated"]) > 0:
+        print("Rows scored or excluded more than once: " +
+            format_ranges(report["duplicated"]))
+    if len(report["missing"]) > 0:
+        print("Missing rows: " + format_ranges(report["missing"]))
+        print("Rerun the missing ranges with:")
+        for start, end in report["missing"]:
+            print(f"./sybil_dir.sif {dicomdir} -p {start}-{end}")
+    else:
+        print("Every metadata.csv row was scored or excluded.")
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
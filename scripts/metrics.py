@@ -0,0 +1,448 @@
+import numpy as np
+import pandas as pd
+
+"""
+Binary classification metrics shared by sybil_eval.py and
+model_evaluation/evaluate.py.
+
+The scores of each horizon (prediction year) are sorted once, in decreasing
+order, and every metric is derived from the sorted scores and the cumulative
+number of positives:
+
+- ROC curve (false/true positive rates and thresholds) and its AUC.
+- Precision-recall curve, its AUC (trapezoidal, as sklearn.metrics.auc) and
+the average precision.
+- Brier score.
+- Binned calibration curve: number of scores, mean score and observed rate
+of positives in each of n_bins equal-width bins of [0, 1].
+- Confusion counts at any number of cutoffs, by binary search in the sorted
+scores instead of a new decision vector per cutoff.
+- Operating points: for a grid of target sensitivities or specificities, the
+ROC cutoffs closest to each target, and the sensitivity, specificity, PPV
+and NPV at those cutoffs.
+
+ScoreHistogram keeps a fixed-memory, mergeable summary of the scores instead,
+from which the ROC AUC (with a bound on its error) and confusion counts are
+available while predictions are still being produced (see live_eval.py).
+
+simplify_curve and simplify_band reduce the number of points of curves
+before they are plotted; metrics are always computed on the full curves.
+
+The curves are the same as those of sklearn.metrics.roc_curve (with
+drop_intermediate) and precision_recall_curve, so cutoffs and AUCs are
+unchanged. When a class is absent the rates of that class are nan.
+"""
+
+N_CALIBRATION_BINS = 10
+# Bins of a ScoreHistogram; the scores of main.py have 5 decimals.
+N_HISTOGRAM_BINS = 10000
+# Default tolerance of simplify_curve for plots, in axis units (curves in
+# the unit square): 0.001 is half a pixel on a 5 inch figure at 100 dpi.
+PLOT_TOLERANCE = 0.001
+
+class BinaryMetrics:
+    # Metrics of one horizon, from its scores sorted in decreasing order and
+    # the truth values in the same order.
+
+    def __init__(self, sorted_scores, sorted_truth, n_bins=N_CALIBRATION_BINS):
+        self.sorted_scores = sorted_scores
+        # cumulative_positives[k] is the number of positives among the k
+        # highest scores.
+        self.cumulative_positives = np.concatenate([[0],
+            np.cumsum(sorted_truth)]).astype(np.int64)
+        self.n = len(sorted_scores)
+        self.positives = int(self.cumulative_positives[-1])
+        self.negatives = self.n - self.positives
+        self.prevalence = self.positives / self.n if self.n > 0 else np.nan
+
+        # Counts at each distinct score, used as threshold.
+        distinct = np.flatnonzero(np.diff(sorted_scores)) if self.n > 0 \
+            else np.array([], dtype=int)
+        last = np.append(distinct, self.n - 1) if self.n > 0 else distinct
+        self.thresholds = sorted_scores[last]
+        self.tps = self.cumulative_positives[last + 1]
+        self.fps = last + 1 - self.tps
+
+        self._roc()
+        self._pr()
+        errors = (sorted_scores - sorted_truth) ** 2
+        self.brier = float(errors.mean()) if self.n > 0 else np.nan
+        self._calibration(sorted_scores, sorted_truth, n_bins)
+
+    def _roc(self):
+        # Points on a straight segment are dropped, as roc_curve does.
+        tps, fps, thresholds = self.tps, self.fps, self.thresholds
+        if len(tps) > 2:
+            keep = np.flatnonzero(np.r_[True, np.logical_or(
+                np.diff(fps, 2), np.diff(tps, 2)), True])
+            tps, fps, thresholds = tps[keep], fps[keep], thresholds[keep]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.fpr = np.r_[0, fps] / self.negatives
+            self.tpr = np.r_[0, tps] / self.positives
+        self.roc_thresholds = np.r_[np.inf, thresholds]
+        self.roc_auc = trapezoid_area(self.fpr, self.tpr)
+
+    def _pr(self):
+        # Recall decreases from 1 to 0.
+        tps, fps = self.tps, self.fps
+        if len(tps) == 0:
+            self.precision = np.array([1.0])
+            self.recall = np.array([0.0])
+            self.pr_thresholds = np.array([])
+            self.pr_auc = self.average_precision = np.nan
+            return
+        precision = tps / (tps + fps)
+        # Without positives, recall is 1 at every threshold.
+        recall = tps / tps[-1] if tps[-1] > 0 else np.ones(len(tps))
+        self.precision = np.r_[precision[::-1], 1]
+        self.recall = np.r_[recall[::-1], 0]
+        self.pr_thresholds = self.thresholds[::-1]
+        self.pr_auc = trapezoid_area(self.recall, self.precision)
+        self.average_precision = float(-np.sum(np.diff(self.recall) *
+            self.precision[:-1]))
+
+    def _calibration(self, sorted_scores, sorted_truth, n_bins):
+        # Scores outside of [0, 1] are counted in the first or last bin.
+        self.bin_edges = np.linspace(0, 1, n_bins + 1)
+        bins = np.clip((sorted_scores * n_bins).astype(np.int64), 0,
+            n_bins - 1) if self.n > 0 else np.array([], dtype=np.int64)
+        self.bin_counts = np.bincount(bins, minlength=n_bins)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean_predicted = np.bincount(bins, weights=sorted_scores,
+                minlength=n_bins) / self.bin_counts
+            self.observed = np.bincount(bins, weights=sorted_truth,
+                minlength=n_bins) / self.bin_counts
+
+    def counts(self, cutoffs, strict=False):
+        # Confusion counts (tn, fp, fn, tp) for each cutoff: a score is
+        # positive if it is >= cutoff, or > cutoff if strict.
+        cutoffs = np.asarray(cutoffs, dtype=float)
+        # The sorted scores are decreasing, their opposites increasing.
+        side = 'left' if strict else 'right'
+        predicted = np.searchsorted(-self.sorted_scores, -cutoffs, side=side)
+        tp = self.cumulative_positives[predicted]
+        fp = predicted - tp
+        fn = self.positives - tp
+        tn = self.negatives - fp
+        return tn, fp, fn, tp
+
+    def operating_points(self, targets, by="sensitivity"):
+        # For each target sensitivity (or specificity), the ROC threshold
+        # whose sensitivity (specificity) is closest to the target, the first
+        # one on ties, and the rates and counts at that cutoff (scores >=
+        # cutoff are positive). Returns a dict of arrays.
+        if by not in ["sensitivity", "specificity"]:
+            raise Exception(f"Invalid operating point criterion: {by}. " +
+                "Use sensitivity or specificity.")
+        targets = np.atleast_1d(np.asarray(targets, dtype=float))
+        # tpr and fpr are nondecreasing; specificity s is fpr 1 - s.
+        rate = self.tpr if by == "sensitivity" else self.fpr
+        goal = targets if by == "sensitivity" else 1 - targets
+        above = np.clip(np.searchsorted(rate, goal, side='left'), 0,
+            len(rate) - 1)
+        below = np.clip(above - 1, 0, len(rate) - 1)
+        # First point with the same rate as the point below the target.
+        below = np.searchsorted(rate, rate[below], side='left')
+        closer = np.abs(rate[below] - goal) <= np.abs(rate[above] - goal)
+        points = np.where(closer, below, above)
+        cutoffs = self.roc_thresholds[points]
+
+        tn, fp, fn, tp = self.counts(cutoffs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {
+                "target": targets,
+                "cutoff": cutoffs,
+                "sensitivity": np.where(tp + fn != 0, tp / (tp + fn), np.nan),
+                "specificity": np.where(tn + fp != 0, tn / (tn + fp), np.nan),
+                "ppv": np.where(tp + fp != 0, tp / (tp + fp), np.nan),
+                "npv": np.where(tn + fn != 0, tn / (tn + fn), np.nan),
+                "tn": tn, "fp": fp, "fn": fn, "tp": tp
+            }
+
+    def youden_cutoff(self):
+        # The ROC threshold maximizing Youden's J index (tpr - fpr).
+        return self.roc_thresholds[np.argmax(self.tpr - self.fpr)]
+
+def operating_point_table(metrics, targets, by="sensitivity"):
+    # Operating points of several models or horizons in one table, one row
+    # per (label, target). metrics: {label: BinaryMetrics}.
+    tables = []
+    for label, label_metrics in metrics.items():
+        table = pd.DataFrame(label_metrics.operating_points(targets, by))
+        table.insert(0, "label", label)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+def trapezoid_area(x, y):
+    # Area under a monotonic curve, positive whichever the direction of x.
+    if len(x) < 2:
+        return np.nan
+    return float(abs(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2)))
+
+def horizon_metrics(truth, scores, n_bins=N_CALIBRATION_BINS):
+    # BinaryMetrics of every column (horizon) of the truth and scores arrays
+    # or DataFrames, of shape (n, n_horizons). All columns are sorted in one
+    # call. A stable sort keeps tied scores in their original order.
+    truth = np.asarray(truth, dtype=float)
+    scores = np.asarray(scores, dtype=float)
+    if scores.ndim == 1:
+        truth, scores = truth[:, None], scores[:, None]
+    order = np.argsort(-scores, axis=0, kind='stable')
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
+    sorted_truth = np.take_along_axis(truth, order, axis=0)
+    return [BinaryMetrics(sorted_scores[:, i], sorted_truth[:, i], n_bins)
+        for i in range(scores.shape[1])]
+
+def binary_metrics(truth, scores, n_bins=N_CALIBRATION_BINS):
+    # BinaryMetrics of a single horizon.
+    return horizon_metrics(np.asarray(truth).reshape(-1),
+        np.asarray(scores).reshape(-1), n_bins)[0]
+
+class ScoreHistogram:
+    # Fixed-memory summary of the scores of each horizon: the number of
+    # positives and negatives in each of n_bins equal-width bins of [0, 1].
+    # It can be updated with new scores at any time and merged with the
+    # histograms of other shards, in any order, with the same result as a
+    # single histogram of all the scores.
+    #
+    # Scores in the same bin are treated as tied, so the ROC AUC is exact up
+    # to half the proportion of (positive, negative) pairs sharing a bin,
+    # which auc_error returns. Confusion counts are exact at cutoffs on bin
+    # edges; otherwise a score is positive if its bin starts at or above the
+    # cutoff rounded down to a bin edge.
+
+    def __init__(self, n_horizons, n_bins=N_HISTOGRAM_BINS):
+        self.n_bins = n_bins
+        self.positives = np.zeros((n_horizons, n_bins), dtype=np.int64)
+        self.negatives = np.zeros((n_horizons, n_bins), dtype=np.int64)
+
+    def bins(self, scores):
+        # Scores outside of [0, 1] are counted in the first or last bin.
+        return np.clip((np.asarray(scores, dtype=float) *
+            self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+
+    def update(self, truth, scores):
+        # Adds rows of truth and scores, of shape (n, n_horizons).
+        truth = np.asarray(truth, dtype=float).reshape(len(truth), -1)
+        scores = np.asarray(scores, dtype=float).reshape(len(scores), -1)
+        for i in range(self.positives.shape[0]):
+            bins = self.bins(scores[:, i])
+            positive = truth[:, i] == 1
+            self.positives[i] += np.bincount(bins[positive],
+                minlength=self.n_bins)
+            self.negatives[i] += np.bincount(bins[~positive],
+                minlength=self.n_bins)
+        return self
+
+    def merge(self, other):
+        if self.positives.shape != other.positives.shape:
+            raise Exception("Cannot merge histograms of different shapes: " +
+                f"{self.positives.shape} and {other.positives.shape}.")
+        self.positives += other.positives
+        self.negatives += other.negatives
+        return self
+
+    def save(self, file_path):
+        np.savez_compressed(file_path, positives=self.positives,
+            negatives=self.negatives)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            histogram = cls(data["positives"].shape[0],
+                data["positives"].shape[1])
+            histogram.positives[:] = data["positives"]
+            histogram.negatives[:] = data["negatives"]
+        return histogram
+
+    def totals(self):
+        # Number of positives and negatives of each horizon.
+        return self.positives.sum(axis=1), self.negatives.sum(axis=1)
+
+    def roc_auc(self):
+        # ROC AUC of each horizon, with the scores of a bin counted as tied.
+        positives, negatives = self.totals()
+        # Positives in higher bins than each bin.
+        above = np.cumsum(self.positives[:, ::-1], axis=1)[:, ::-1] - \
+            self.positives
+        pairs = (self.negatives * (above + 0.5 * self.positives)).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return pairs / (positives * negatives)
+
+    def auc_error(self):
+        # Bound of the difference between roc_auc and the exact AUC.
+        positives, negatives = self.totals()
+        tied = (self.positives * self.negatives).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 0.5 * tied / (positives * negatives)
+
+    def roc_curve(self, horizon):
+        # fpr, tpr and thresholds (lower bin edges, decreasing) of a horizon.
+        positives = np.r_[0, np.cumsum(self.positives[horizon, ::-1])]
+        negatives = np.r_[0, np.cumsum(self.negatives[horizon, ::-1])]
+        thresholds = np.r_[np.inf, np.arange(self.n_bins)[::-1] / self.n_bins]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return negatives / negatives[-1], positives / positives[-1], \
+                thresholds
+
+    def counts(self, cutoffs):
+        # Confusion counts (tn, fp, fn, tp) of each horizon at each cutoff,
+        # arrays of shape (n_horizons, n_cutoffs).
+        first = np.clip(np.floor(np.asarray(cutoffs, dtype=float) *
+            self.n_bins + 1e-9), 0, self.n_bins).astype(np.int64)
+        # Number of positives/negatives in the bins from each bin upwards.
+        positives_from = np.concatenate([np.cumsum(self.positives[:, ::-1],
+            axis=1)[:, ::-1], np.zeros((self.positives.shape[0], 1),
+            dtype=np.int64)], axis=1)
+        negatives_from = np.concatenate([np.cumsum(self.negatives[:, ::-1],
+            axis=1)[:, ::-1], np.zeros((self.negatives.shape[0], 1),
+            dtype=np.int64)], axis=1)
+        tp = positives_from[:, first]
+        fp = negatives_from[:, first]
+        positives, negatives = self.totals()
+        return negatives[:, None] - fp, fp, positives[:, None] - tp, tp
+
+    def youden_cutoffs(self):
+        # The bin edge maximizing Youden's J index, for each horizon.
+        cutoffs = []
+        for horizon in range(self.positives.shape[0]):
+            fpr, tpr, thresholds = self.roc_curve(horizon)
+            cutoffs.append(thresholds[np.nanargmax(tpr - fpr)] if
+                np.isfinite(tpr - fpr).any() else np.nan)
+        return np.array(cutoffs)
+
+def simplify_curve(x, y, tolerance=PLOT_TOLERANCE):
+    # Ramer-Douglas-Peucker simplification: returns the indexes of the points
+    # to keep, such that every point removed is within tolerance of the
+    # segment replacing it. The first and last points are always kept. A
+    # tolerance of None or 0 keeps every point.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if not tolerance or n < 3:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, n - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+        # Distance of the points between start and end to the segment.
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = dx * dx + dy * dy
+        t = np.clip((px * dx + py * dy) / length, 0, 1) if length > 0 \
+            else np.zeros(len(px))
+        distance = np.hypot(px - t * dx, py - t * dy)
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            segments.append((start, middle))
+            segments.append((middle, end))
+    return np.flatnonzero(keep)
+
+def simplify_band(x, curves, tolerance=PLOT_TOLERANCE):
+    # Indexes to keep for curves sharing the same x, e.g. a mean curve and
+    # its confidence band, so that fill_between still has one x.
+    keep = np.zeros(len(x), dtype=bool)
+    for y in curves:
+        keep[simplify_curve(x, y, tolerance)] = True
+    return np.flatnonzero(keep)
+
+class FenwickTree:
+    # Counts of values inserted at positions 0..size-1, with prefix counts
+    # in O(log size). Insertions and queries take arrays of positions and
+    # are vectorized over them.
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = np.zeros(size + 1, dtype=np.int64)
+
+    def add(self, positions):
+        index = np.asarray(positions, dtype=np.int64) + 1
+        while len(index) > 0:
+            np.add.at(self.tree, index, 1)
+            index = index + (index & -index)
+            index = index[index <= self.size]
+
+    def prefix_count(self, positions):
+        # Number of inserted values at positions < positions.
+        index = np.asarray(positions, dtype=np.int64).copy()
+        count = np.zeros(len(index), dtype=np.int64)
+        while True:
+            valid = index > 0
+            if not valid.any():
+                return count
+            count[valid] += self.tree[index[valid]]
+            index[valid] -= index[valid] & -index[valid]
+
+def concordance_index(times, events, risks):
+    # Harrell's concordance index of risk scores (higher risk, earlier
+    # event). A pair is comparable if the subject with the shorter time had
+    # the event; subjects with the same time are comparable if only the first
+    # one had the event. Tied risks count as half concordant. Returns
+    # (c_index, number of comparable pairs).
+    #
+    # Subjects are inserted into a Fenwick tree over risk ranks in decreasing
+    # order of time, so each event is compared with all the subjects with a
+    # longer time by two prefix counts: O(n log n) instead of n^2 pairs.
+    times = np.asarray(times, dtype=float)
+    events = np.asarray(events, dtype=bool)
+    risks = np.asarray(risks, dtype=float)
+    _, ranks = np.unique(risks, return_inverse=True)
+    n_ranks = int(ranks.max()) + 1 if len(ranks) > 0 else 0
+    tree = FenwickTree(n_ranks)
+
+    concordant = 0.0
+    comparable = 0
+    order = np.argsort(-times, kind='stable')
+    sorted_times = times[order]
+    # Groups of subjects with the same time, longest time first.
+    starts = np.flatnonzero(np.r_[True, np.diff(sorted_times) != 0])
+    ends = np.r_[starts[1:], len(order)]
+    inserted = 0
+    for start, end in zip(starts, ends):
+        group = order[start:end]
+        group_events = group[events[group]]
+        censored = group[~events[group]]
+        # Censored subjects of the same time survived at least as long.
+        tree.add(ranks[censored])
+        inserted += len(censored)
+        if len(group_events) > 0 and inserted > 0:
+            event_ranks = ranks[group_events]
+            lower = tree.prefix_count(event_ranks)
+            tied = tree.prefix_count(event_ranks + 1) - lower
+            concordant += lower.sum() + 0.5 * tied.sum()
+            comparable += inserted * len(group_events)
+        tree.add(ranks[group_events])
+        inserted += len(group_events)
+    if comparable == 0:
+        return np.nan, 0
+    return concordant / comparable, comparable
+
+def time_dependent_auc(times, events, scores, horizon):
+    # Cumulative/dynamic AUC at a horizon: the probability that a subject
+    # with an event at or before the horizon (case) has a higher score than a
+    # subject still free of events after it (control). Subjects censored at
+    # the horizon are controls, those censored before it are neither.
+    # Computed from the ranks of the scores (Mann-Whitney). Returns (auc,
+    # number of cases, number of controls).
+    times = np.asarray(times, dtype=float)
+    events = np.asarray(events, dtype=bool)
+    scores = np.asarray(scores, dtype=float)
+    cases = events & (times <= horizon)
+    controls = (times > horizon) | (~events & (times == horizon))
+    n_cases, n_controls = int(cases.sum()), int(controls.sum())
+    if n_cases == 0 or n_controls == 0:
+        return np.nan, n_cases, n_controls
+    selected = scores[cases | controls]
+    is_case = cases[cases | controls]
+    # Average ranks of tied scores, starting at 1.
+    values, inverse, counts = np.unique(selected, return_inverse=True,
+        return_counts=True)
+    last_rank = np.cumsum(counts)
+    ranks = (last_rank - (counts - 1) / 2)[inverse]
+    u = ranks[is_case].sum() - n_cases * (n_cases + 1) / 2
+    return u / (n_cases * n_controls), n_cases, n_controls
@@ -0,0 +1,295 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+"""
+This script monitors the main.py portions (shards) running on a DICOM
+directory, from the progress_{start}_{end}.out files they write after each
+DICOM.
+
+For each shard, and overall:
+- progress: metadata.csv rows done (scored or excluded) out of the total.
+- throughput in series per hour, on average since the shard started, and
+over the last --window seconds (rolling).
+- ETA: remaining rows divided by the rolling throughput (or the average one
+when there are not enough samples yet). The overall ETA is that of the
+slowest shard, since shards run in parallel.
+- stragglers: running shards whose ETA is more than --straggler times the
+median ETA of the running shards, or which have not progressed for
+--stale seconds.
+
+A shard is complete once its sybil_predictions_{start}_{end}.csv file exists.
+
+Progress samples are kept in a state file, so that the rolling throughput is
+also available when the monitor is run periodically (e.g. by cron) instead of
+with --interval. The metrics are written in the Prometheus text format, e.g.
+for the textfile collector of node-exporter or for a local dashboard.
+"""
+
+PROGRESS_RE = re.compile(r"^progress_(\d+)_(\d+)\.out$")
+PROGRESS_LINE_RE = re.compile(
+    r"Current progress: (\d+) / (\d+)\. (\d+) excluded\.")
+STARTED_RE = re.compile(r"Started: (\d+)")
+SECONDS_IN_HOUR = 3600
+
+def main():
+    print("Sybil Progress Monitor")
+
+    # ArgParse library is used to manage command line arguments.
+    parser = argparse.ArgumentParser(
+        epilog="Example: monitor.py path/to/dicom_dir -i 60 \
+        -o /var/lib/node_exporter/textfile/sybil.prom"
+    )
+    parser.add_argument("dicomdir", help="The directory passed to main.py, \
+        which contains the progress_{start}_{end}.out files.")
+    parser.add_argument('-o', '--textfile', help="The metrics file, in the \
+        Prometheus text format. Default: dicomdir/sybil_progress.prom.",
+        default=None)
+    parser.add_argument('-s', '--state', help="The file in which progress \
+        samples are kept between runs. \
+        Default: dicomdir/sybil_progress_state.json.", default=None)
+    parser.add_argument('-i', '--interval', help="Update every INTERVAL \
+        seconds until every shard is complete. Default: 0 (update once).",
+        type=float, default=0)
+    parser.add_argument('-w', '--window', help="Window of the rolling \
+        throughput, in seconds. Default: 1800.", type=float, default=1800)
+    parser.add_argument('--straggler', help="A shard is a straggler if its \
+        ETA is more than this many times the median ETA. Default: 1.5.",
+        type=float, default=1.5)
+    parser.add_argument('--stale', help="A running shard is a straggler if \
+        it has not progressed for this many seconds. Default: 3600.",
+        type=float, default=3600)
+    args = parser.parse_args()
+    textfile = args.textfile
+    if textfile is None:
+        textfile = os.path.join(args.dicomdir, "sybil_progress.prom")
+    state_path = args.state
+    if state_path is None:
+        state_path = os.path.join(args.dicomdir, "sybil_progress_state.json")
+
+    while True:
+        state = load_state(state_path)
+        now = time.time()
+        shards = read_shards(args.dicomdir, state, now, args.window)
+        summary = summarize(shards, now, args.straggler, args.stale)
+        save_state(state, state_path)
+        write_textfile(textfile, shards, summary)
+        print_summary(shards, summary)
+        if args.interval <= 0 or summary["running"] == 0:
+            break
+        time.sleep(args.interval)
+
+def load_state(state_path):
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_state(state, state_path):
+    temporary_path = state_path + ".tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary_path, state_path)
+
+def parse_progress(file_path):
+    # Returns (done, total, excluded, started) or None if the file cannot be
+    # parsed. started is None for files written by older versions of main.py.
+    with open(file_path) as f:
+        content = f.read()
+    match = PROGRESS_LINE_RE.search(content)
+    if match is None:
+        return None
+    started = STARTED_RE.search(content)
+    return (int(match.group(1)), int(match.group(2)), int(match.group(3)),
+        None if started is None else int(started.group(1)))
+
+def read_shards(dicomdir, state, now, window):
+    # Reads every progress file, records a (time, done) sample per shard in
+    # state, and returns the metrics of each shard.
+    shards = []
+    for file_name in sorted(os.listdir(dicomdir)):
+        match = PROGRESS_RE.match(file_name)
+        if match is None:
+            continue
+        file_path = os.path.join(dicomdir, file_name)
+        try:
+            progress = parse_progress(file_path)
+            updated = os.path.getmtime(file_path)
+        except OSError:
+            # Being replaced by main.py.
+            continue
+        if progress is None:
+            continue
+        done, total, excluded, started = progress
+        name = f"{match.group(1)}_{match.group(2)}"
+        complete = os.path.isfile(os.path.join(dicomdir,
+            f"sybil_predictions_{name}.csv"))
+
+        # The modification time of the file is the time of the sample. Only
+        # the samples within the window are kept, and the first one, to
+        # estimate the average throughput of shards without a start time.
+        history = state.get(name)
+        if history is None or done < history["first"][1]:
+            # New shard, or the range was restarted.
+            history = {"first": [updated, done], "samples": []}
+            state[name] = history
+        samples = history["samples"]
+        if len(samples) == 0 or samples[-1][1] != done:
+            samples.append([updated, done])
+        history["samples"] = [x for x in samples if x[0] >= now - window]
+        first_sample = history["first"]
+
+        if started is not None:
+            average = per_hour(done, updated - started)
+        else:
+            average = per_hour(done - first_sample[1],
+                updated - first_sample[0])
+        recent = history["samples"]
+        rolling = None
+        if len(recent) >= 2:
+            rolling = per_hour(recent[-1][1] - recent[0][1],
+                recent[-1][0] - recent[0][0])
+        rate = rolling if rolling is not None else average
+        remaining = 0 if complete else total - done
+        eta = None
+        if remaining == 0:
+            eta = 0.0
+        elif rate:
+            eta = remaining / rate * SECONDS_IN_HOUR
+
+        shards.append({
+            "name": name,
+            "done": total if complete else done,
+            "total": total,
+            "excluded": excluded,
+            "complete": complete,
+            "average_per_hour": average,
+            "rolling_per_hour": rolling,
+            "eta_seconds": eta,
+            "idle_seconds": now - updated,
+            "straggler": False
+        })
+    return shards
+
+def per_hour(count, seconds):
+    if seconds <= 0:
+        return None
+    return count / seconds * SECONDS_IN_HOUR
+
+def summarize(shards, now, straggler, stale):
+    # Overall metrics, and straggler detection among running shards.
+    running = [s for s in shards if not s["complete"]]
+    etas = [s["eta_seconds"] for s in running if s["eta_seconds"] is not None]
+    median_eta = statistics.median(etas) if len(etas) > 0 else None
+    for shard in running:
+        slow = median_eta is not None and shard["eta_seconds"] is not None \
+            and shard["eta_seconds"] > straggler * median_eta
+        shard["straggler"] = slow or shard["idle_seconds"] > stale
+
+    def total(key):
+        values = [s[key] for s in running if s[key] is not None]
+        return sum(values) if len(values) > 0 else None
+
+    done = sum(s["done"] for s in shards)
+    series = sum(s["total"] for s in shards)
+    return {
+        "shards": len(shards),
+        "running": len(running),
+        "done": done,
+        "total": series,
+        "excluded": sum(s["excluded"] for s in shards),
+        "average_per_hour": total("average_per_hour"),
+        "rolling_per_hour": total("rolling_per_hour"),
+        "eta_seconds": max(etas) if len(etas) == len(running) and \
+            len(etas) > 0 else (0.0 if len(running) == 0 else None),
+        "stragglers": [s["name"] for s in running if s["straggler"]],
+        "time": now
+    }
+
+def write_textfile(textfile, shards, summary):
+    # Writes the metrics in the Prometheus text format, atomically so that
+    # the collector never reads a partial file. Unknown values are omitted.
+    lines = []
+
+    def metric(name, help_text, values):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values:
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            label = f'{{shard="{labels}"}}' if labels else ""
+            # repr keeps every digit, e.g. of timestamps; float() as the
+            # repr of NumPy floats names their type.
+            lines.append(f"{name}{label} {float(value)!r}" if isinstance(
+                value, float) else f"{name}{label} {value}")
+
+    def per_shard(key):
+        return [(s["name"], s[key]) for s in shards]
+
+    metric("sybil_series_done", "metadata.csv rows scored or excluded.",
+        [(None, summary["done"])] + per_shard("done"))
+    metric("sybil_series_total", "metadata.csv rows assigned to shards.",
+        [(None, summary["total"])] + per_shard("total"))
+    metric("sybil_series_excluded", "metadata.csv rows excluded.",
+        [(None, summary["excluded"])] + per_shard("excluded"))
+    metric("sybil_series_per_hour", "Average throughput since start.",
+        [(None, summary["average_per_hour"])] + per_shard("average_per_hour"))
+    metric("sybil_series_per_hour_rolling", "Throughput over the window.",
+        [(None, summary["rolling_per_hour"])] + per_shard("rolling_per_hour"))
+    metric("sybil_eta_seconds", "Estimated time to completion.",
+        [(None, summary["eta_seconds"])] + per_shard("eta_seconds"))
+    metric("sybil_shard_idle_seconds", "Time since the last progress.",
+        per_shard("idle_seconds"))
+    metric("sybil_shard_complete", "1 if the shard wrote its predictions.",
+        per_shard("complete"))
+    metric("sybil_shard_straggler", "1 if the shard is a straggler.",
+        per_shard("straggler"))
+    metric("sybil_shards_running", "Number of shards still running.",
+        [(None, summary["running"])])
+    metric("sybil_monitor_timestamp_seconds", "Time of this update.",
+        [(None, summary["time"])])
+
+    temporary_path = textfile + ".tmp"
+    with open(temporary_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary_path, textfile)
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    hours, rest = divmod(int(seconds), SECONDS_IN_HOUR)
+    return f"{hours}h{rest // 60:02d}m"
+
+def format_rate(rate):
+    return "unknown" if rate is None else f"{rate:0.1f}/h"
+
+def print_summary(shards, summary):
+    print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(summary["time"])))
+    for shard in shards:
+        status = "complete" if shard["complete"] else \
+            f"ETA {format_duration(shard['eta_seconds'])}"
+        flag = " STRAGGLER" if shard["straggler"] else ""
+        print(f"{shard['name']:>15}: {shard['done']} / {shard['total']} " +
+            f"({shard['excluded']} excluded), " +
+            f"{format_rate(shard['average_per_hour'])} average, " +
+            f"{format_rate(shard['rolling_per_hour'])} rolling, " +
+            f"{status}{flag}")
+    print(f"Overall: {summary['done']} / {summary['total']}, " +
+        f"{format_rate(summary['average_per_hour'])} average, " +
+        f"{format_rate(summary['rolling_per_hour'])} rolling, " +
+        f"{summary['running']} of {summary['shards']} shards running, " +
+        f"ETA {format_duration(summary['eta_seconds'])}")
+    if len(summary["stragglers"]) > 0:
+        print("Stragglers: " + ", ".join(summary["stragglers"]))
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
@@ -4,6 +4,8 @@ import time
 import numpy as np
 import pandas as pd
 import argparse
+
+from profiling import Profiler, phase
 """
 Prior to this script, Sybil should be used to generate a prediction.csv file.
 Sybil's CSV output should include 8 columns: pid | study_yr | pred_yr1-6
@@ -69,29 +71,55 @@ def main():
         generate the output. \
         Default: script current working directory.",
         default=os.getcwd())
+    parser.add_argument("--profile", action="store_true", help="Write a \
+        profile report (cProfile statistics, time and peak memory per phase) \
+        in the output directory. See profiling.py.")
     args = parser.parse_args()
     print("Data split:", args.datasplit)
     print("Clinical data directory:", args.clinical)
     print("Output directory:", args.outdir)
 
-    # Read in data split file provided by Sybil authors.
-    data_split = pd.read_csv(args.datasplit)
-    
-    # Find the CT screen and prsn file.
-    metadata_files = os.listdir(args.clinical)
+    profiler = Profiler(args.profile)
+
+    with phase("read"):
+        # Read in data split file provided by Sybil authors.
+        data_split = pd.read_csv(args.datasplit)
+        
+        # Find the CT screen and prsn file.
+        screen_file, prsn_file = find_clinical_files(args.clinical)
+
+        # Read in metadata CSVs
+        screen = pd.read_csv(screen_file) 
+        # We will iterate through these rows
+        
+        prsn = pd.read_csv(prsn_file)
+
+    with phase("build truth"):
+        output_df = build_actual(data_split, screen, prsn)
+
+    with phase("write"):
+        # Save output CSV in output directory
+        output_df.to_csv(args.outdir + "/nlst_actual.csv",
+            index = False)
+
+    profiler.report(args.outdir)
+
+def find_clinical_files(clinical):
+    # Returns the paths of the NLST screen and prsn CSV files in the clinical
+    # data directory.
+    metadata_files = os.listdir(clinical)
     screen_file = ""
     prsn_file = ""
     for file_name in metadata_files:
         if "nlst" in file_name and "screen" in file_name:
-            screen_file = args.clinical + file_name
+            screen_file = clinical + file_name
         if "nlst" in file_name and "prsn" in file_name:
-            prsn_file = args.clinical + file_name
+            prsn_file = clinical + file_name
+    return screen_file, prsn_file
 
-    # Read in metadata CSVs
-    screen = pd.read_csv(screen_file) 
-    # We will iterate through these rows
-    
-    prsn = pd.read_csv(prsn_file)
+def build_actual(data_split, screen, prsn):
+    # Builds the truth table (one row per CT) described at the top of this
+    # file from the data split, screen and prsn DataFrames.
 
     # This list will be a list of lists, each list being a row.
     output = [] 
@@ -169,7 +197,7 @@ def main():
         output.append(current_row)      
 
     # Convert output into a Pandas DataFrame.
-    output_df = pd.DataFrame(output, columns=[
+    return pd.DataFrame(output, columns=[
         "pid",
         "study_yr",
         "days_to_diagnosis",
@@ -184,11 +212,9 @@ def main():
         "canc_yr6",
         "sybil_data_split"
     ]) 
-    # Save output CSV in output directory
-    output_df.to_csv(args.outdir + "/nlst_actual.csv",
-        index = False)
-
-start = time.perf_counter()
-main()
-end = time.perf_counter()
-print(f"{sys.argv[0]} completed in {end - start:.4f} seconds.")
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} completed in {end - start:.4f} seconds.")
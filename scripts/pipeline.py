@@ -0,0 +1,148 @@
+import argparse
+import os
+import sys
+import time
+import pandas as pd
+
+from nlst_actual import find_clinical_files, build_actual
+from sybil_eval import evaluate, FOLLOWUP_DAYS
+from metrics import PLOT_TOLERANCE
+from profiling import Profiler, phase
+
+"""
+This script runs the evaluation pipeline in a single process:
+
+- Sybil predictions are either read from the CSV files written by main.py
+(one per --portion) and merged, or computed directly from a DICOM directory
+(only inside the Sybil container, see main.py).
+- The truth table is built as in nlst_actual.py.
+- ROC curves, confusion matrices and the other outputs of sybil_eval.py
+(including --survival and --tolerance) are generated as in sybil_eval.py.
+
+DataFrames are passed between the stages in memory, so the intermediate CSV
+files are only written when requested with --save.
+"""
+
+def main():
+    print("Sybil Evaluation Pipeline")
+
+    # ArgParse library is used to manage command line arguments.
+    parser = argparse.ArgumentParser(
+        epilog="Example: pipeline.py path/to/data_split.csv \
+        path/to/nlst_clinical_data_dir -p sybil_predictions_*.csv \
+        -o output_dir -f gender:2:e"
+    )
+    parser.add_argument("datasplit", help="a CSV file provided by Sybil \
+        authors which identifies the split of each CT by patient ID. \
+        See nlst_actual.py.")
+    parser.add_argument("clinical", help="a directory containing the NLST \
+        clinical data (screen and prsn CSV files). See nlst_actual.py.")
+    parser.add_argument('-p', "--predictions", help="Any number of \
+        prediction CSV files generated by main.py, e.g. one per portion. \
+        They are merged before evaluation.", nargs='+', default=[])
+    parser.add_argument('-d', "--dicomdir", help="Instead of prediction \
+        CSV files, run Sybil on this directory in the same process. \
+        Requires the Sybil container, see main.py.", default=None)
+    parser.add_argument('-o', "--outdir", help="A directory in which to \
+        generate the output. \
+        Default: script current working directory.",
+        default=os.getcwd())
+    parser.add_argument('-f', "--filters", help="Filters, as in \
+        sybil_eval.py. Default: no filters.", nargs='+', default=[])
+    parser.add_argument('-i', '--intersect', help="Property names for \
+        intersectional subgroups, as in sybil_eval.py. \
+        Default: no subgroups.", nargs='+', default=None)
+    parser.add_argument('-c', '--cutoffs', help="Probability cutoffs, as in \
+        sybil_eval.py. Default: Youden's J index", type=float,
+        nargs='+', default=None)
+    parser.add_argument('-t', '--tolerance', help="Tolerance of the \
+        simplification of the plotted ROC curves, as in sybil_eval.py. \
+        Default: 0.001.", type=float, default=PLOT_TOLERANCE)
+    parser.add_argument('--survival', action="store_true", help="Also \
+        evaluate the predictions as survival predictions, as in \
+        sybil_eval.py --survival.")
+    parser.add_argument('--followup', help="Follow-up in days of the \
+        survival mode, as in sybil_eval.py. Default: 2190 (6 years).",
+        type=int, default=FOLLOWUP_DAYS)
+    parser.add_argument('-s', '--save', action='store_true', help="Also \
+        save the merged predictions and the truth table as CSV files in \
+        the output directory.")
+    parser.add_argument("--profile", action="store_true", help="Write a \
+        profile report (cProfile statistics, time and peak memory per phase) \
+        in the output directory. See profiling.py.")
+    args = parser.parse_args()
+    print("Data split:", args.datasplit)
+    print("Clinical data directory:", args.clinical)
+    print("Predictions:", args.predictions)
+    print("DICOM Directory:", args.dicomdir)
+    print("Output directory:", args.outdir)
+    if args.survival:
+        print("Survival follow-up (days):", args.followup)
+
+    if len(args.predictions) == 0 and args.dicomdir is None:
+        print("Either prediction CSV files or a DICOM directory are " +
+            "required.")
+        return
+
+    profiler = Profiler(args.profile)
+    if args.dicomdir is not None:
+        prediction = run_sybil(args.dicomdir)
+    else:
+        with phase("read"):
+            prediction = merge_predictions(
+                [pd.read_csv(f) for f in args.predictions]
+            )
+
+    with phase("build truth"):
+        data_split = pd.read_csv(args.datasplit)
+        screen_file, prsn_file = find_clinical_files(args.clinical)
+        actual = build_actual(data_split, pd.read_csv(screen_file),
+            pd.read_csv(prsn_file))
+
+    if args.save:
+        prediction.to_csv(args.outdir + "/sybil_predictions.csv",
+            index = False)
+        actual.to_csv(args.outdir + "/nlst_actual.csv", index = False)
+
+    run_pipeline(actual, prediction, args.outdir, args.filters,
+        args.cutoffs, args.intersect,
+        args.followup if args.survival else None, args.tolerance)
+
+    profiler.report(args.outdir)
+
+def run_sybil(dicomdir, portion="keep_all"):
+    # main.py is only imported here because it requires the Sybil package,
+    # which is only available inside the Sybil container.
+    from main import predict_directory
+    prediction, _, _, _ = predict_directory(dicomdir, portion)
+    return prediction
+
+def merge_predictions(predictions):
+    # Concatenates the prediction DataFrames of several portions. Rows scored
+    # by more than one portion are only kept once, see merge_predictions.py.
+    if len(predictions) == 0:
+        return pd.DataFrame()
+    prediction = pd.concat(predictions, ignore_index=True)
+    if "metadata_index" in prediction.columns:
+        duplicated = prediction["metadata_index"].notna() & \
+            prediction["metadata_index"].duplicated()
+        if duplicated.any():
+            print(f"{duplicated.sum()} predictions found in more than one " +
+                "portion were dropped.")
+        prediction = prediction[~duplicated].reset_index(drop=True)
+    return prediction
+
+def run_pipeline(actual, prediction, outdir, filters=None, cutoffs=None,
+    intersect=None, followup=None, tolerance=PLOT_TOLERANCE):
+    # Evaluates in-memory truth and prediction DataFrames, see sybil_eval.py.
+    # followup: survival metrics are generated if it is given.
+    print(f"Number of CTs in truth table: {actual.shape[0]}")
+    print(f"Number of predictions: {prediction.shape[0]}")
+    evaluate(actual, prediction, outdir, filters, cutoffs, intersect,
+        followup, tolerance)
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
@@ -0,0 +1,257 @@
+import argparse
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+"""
+This script plans the portions (shards) of a DICOM directory evaluated in
+parallel by main.py, so that they take about the same time. --portion 1/N
+splits metadata.csv by row count, but the time to evaluate a series depends
+mostly on its number of images and size.
+
+- The cost of each series is estimated from metadata.csv:
+    seconds = a + b * Number of Images + c * File Size (MB)
+Series with fewer than --minimages images are excluded by main.py without
+being read, so they only cost a small fixed time.
+- When log files of previous main.py runs are given (--timings), the
+"Prediction on ... in ... seconds." lines are used: the coefficients are
+fitted to the measured times by least squares, and measured series use
+their measured time.
+- metadata.csv is cut into N contiguous ranges. The cuts minimize the cost
+of the slowest shard among all contiguous cuts (binary search on that cost,
+each tried with a greedy cut), which is at most the average shard cost plus
+the cost of one series. Contiguous ranges keep the outputs of main.py
+compatible with merge_predictions.py and monitor.py.
+
+Outputs, in the output directory:
+- shard_plan.csv: shard number (starting at 1), first and last metadata.csv
+index, number of series and of images, and predicted seconds. main.py
+consumes a shard with -p start-end.
+- sybil_nlst_array_job.pbs: a PBS array job generated from
+extras/sybil_nlst_example_job.pbs, running one shard per array index, with
+the walltime set from the slowest shard (times --margin).
+"""
+
+# Default cost coefficients, used without measured timings.
+SECONDS_PER_SERIES = 10.0
+SECONDS_PER_IMAGE = 0.1
+SECONDS_PER_MB = 0.0
+# Cost of a series excluded for having too few images.
+SKIPPED_SECONDS = 0.1
+MINIMUM_IMAGE_COUNT = 10
+# Minimum number of measured series to fit the coefficients.
+MINIMUM_TIMINGS = 10
+
+TIMING_RE = re.compile(r"Prediction on (.+) in ([\d.]+) seconds\.")
+SIZE_UNITS = {"B": 1e-6, "KB": 1e-3, "MB": 1.0, "GB": 1e3, "TB": 1e6}
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+    "extras", "sybil_nlst_example_job.pbs")
+# Array directive and index variable of each PBS flavor.
+SCHEDULERS = {
+    "torque": ("#PBS -t 1-{n}", "PBS_ARRAYID"),
+    "pbspro": ("#PBS -J 1-{n}", "PBS_ARRAY_INDEX")
+}
+
+def main():
+    print("Sybil Shard Planner")
+
+    # ArgParse library is used to manage command line arguments.
+    parser = argparse.ArgumentParser(
+        epilog="Example: plan_shards.py path/to/dicom_dir -n 20 \
+        -t sybil_nlst.out-*"
+    )
+    parser.add_argument("dicomdir", help="The directory passed to main.py, \
+        which contains metadata.csv.")
+    parser.add_argument('-n', '--shards', help="Number of shards. \
+        Default: 5.", type=int, default=5)
+    parser.add_argument('-o', '--outdir', help="A directory in which to \
+        write the plan and the PBS job. Default: script current working \
+        directory.", default=os.getcwd())
+    parser.add_argument('-t', '--timings', help="Any number of log files of \
+        previous main.py runs, whose prediction times are used to fit the \
+        cost of a series.", nargs='+', default=[])
+    parser.add_argument('-m', '--minimages', help="The --minimages value \
+        passed to main.py. Default: 10.", type=int,
+        default=MINIMUM_IMAGE_COUNT)
+    parser.add_argument('--template', help="PBS job used as a template. \
+        Default: extras/sybil_nlst_example_job.pbs.", default=TEMPLATE)
+    parser.add_argument('--scheduler', help="PBS flavor of the array job. \
+        Default: torque.", choices=SCHEDULERS.keys(), default="torque")
+    parser.add_argument('--margin', help="Walltime of the job, as a multiple \
+        of the predicted time of the slowest shard. Default: 1.5.",
+        type=float, default=1.5)
+    args = parser.parse_args()
+    print("DICOM Directory:", args.dicomdir)
+    print("Shards:", args.shards)
+    print("Output directory:", args.outdir)
+
+    metadata = pd.read_csv(os.path.join(args.dicomdir, "metadata.csv"),
+        usecols=["File Location", "Number of Images", "File Size"])
+    timings = read_timings(args.timings, metadata["File Location"])
+    cost = estimate_cost(metadata, timings, args.minimages)
+    plan = plan_shards(metadata, cost, args.shards)
+    print(plan.to_string(index=False))
+
+    plan_path = os.path.join(args.outdir, "shard_plan.csv")
+    plan.to_csv(plan_path, index=False)
+    job_path = os.path.join(args.outdir, "sybil_nlst_array_job.pbs")
+    with open(args.template) as f:
+        template = f.read()
+    with open(job_path, 'w') as f:
+        f.write(generate_job(template, plan, args.dicomdir,
+            os.path.abspath(plan_path), args.scheduler, args.margin,
+            args.minimages))
+    print(f"Wrote {plan_path} and {job_path}.")
+
+def parse_size(size):
+    # Converts a metadata.csv File Size, e.g. "80.03 MB", to megabytes.
+    match = re.match(r"\s*([\d.]+)\s*([KMGT]?B)", str(size))
+    if match is None:
+        return 0.0
+    return float(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def location_key(location):
+    # metadata.csv locations start with "./NLST/"; logged paths are
+    # prefixed with the DICOM directory.
+    location = location.rstrip("/")
+    position = location.find("/NLST/")
+    return location[position:] if position >= 0 else location
+
+def read_timings(log_paths, locations):
+    # Returns {metadata.csv index: seconds} from main.py log files. The last
+    # time of a series is kept if it was evaluated more than once.
+    index_by_location = {location_key(l): i
+        for i, l in enumerate(locations)}
+    timings = {}
+    for log_path in log_paths:
+        with open(log_path, errors="replace") as f:
+            for line in f:
+                match = TIMING_RE.search(line)
+                if match is None:
+                    continue
+                index = index_by_location.get(location_key(match.group(1)))
+                if index is not None:
+                    timings[index] = float(match.group(2))
+    if len(log_paths) > 0:
+        print(f"Measured timings: {len(timings)} series.")
+    return timings
+
+def estimate_cost(metadata, timings, minimages=MINIMUM_IMAGE_COUNT):
+    # Returns the predicted seconds of each metadata.csv row.
+    images = metadata["Number of Images"].fillna(0).to_numpy(dtype=float)
+    size = metadata["File Size"].map(parse_size).to_numpy(dtype=float)
+    features = np.column_stack([np.ones(len(images)), images, size])
+    coefficients = np.array([SECONDS_PER_SERIES, SECONDS_PER_IMAGE,
+        SECONDS_PER_MB])
+
+    if len(timings) >= MINIMUM_TIMINGS:
+        measured = np.array(list(timings.keys()))
+        seconds = np.array(list(timings.values()))
+        fitted, _, _, _ = np.linalg.lstsq(features[measured], seconds,
+            rcond=None)
+        # Negative coefficients come from collinear images and sizes.
+        coefficients = np.clip(fitted, 0, None)
+    elif len(timings) > 0:
+        print(f"Fewer than {MINIMUM_TIMINGS} measured series: default " +
+            "coefficients are used.")
+    print("Cost: {:0.4g} s + {:0.4g} s/image + {:0.4g} s/MB".format(
+        *coefficients))
+
+    cost = features @ coefficients
+    cost[images < minimages] = SKIPPED_SECONDS
+    for index, seconds in timings.items():
+        cost[index] = seconds
+    return cost
+
+def greedy_ends(cumulative, limit, max_ranges):
+    # Last row of each range when every range takes as many rows as fit
+    # within limit (at least one row). Stops after max_ranges + 1 ranges.
+    ends = []
+    base = 0.0
+    while (len(ends) == 0 or ends[-1] < len(cumulative) - 1) and \
+        len(ends) <= max_ranges:
+        low = ends[-1] + 1 if len(ends) > 0 else 0
+        end = np.searchsorted(cumulative, base + limit, side="right") - 1
+        end = max(end, low)
+        ends.append(int(end))
+        base = cumulative[end]
+    return ends
+
+def plan_shards(metadata, cost, n_shards):
+    # Cuts metadata.csv into n_shards contiguous ranges, minimizing the cost
+    # of the most expensive range.
+    n_shards = max(1, min(n_shards, len(cost)))
+    cumulative = np.cumsum(cost)
+    # Binary search of the smallest limit for which the greedy cut needs
+    # at most n_shards ranges. The total cost needs one range.
+    low = float(np.max(cost))
+    high = float(cumulative[-1])
+    for _ in range(100):
+        if high - low <= 1e-9 * high:
+            break
+        middle = (low + high) / 2
+        if len(greedy_ends(cumulative, middle, n_shards)) <= n_shards:
+            high = middle
+        else:
+            low = middle
+    ends = greedy_ends(cumulative, high, n_shards)
+    # Fewer ranges than shards: ranges of several rows are split, which
+    # does not increase the most expensive one.
+    while len(ends) < n_shards:
+        starts = [0] + [end + 1 for end in ends[:-1]]
+        lengths = [end - start + 1 for start, end in zip(starts, ends)]
+        i = int(np.argmax(lengths))
+        ends.insert(i, ends[i] - 1)
+    ends = np.array(ends)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+
+    images = metadata["Number of Images"].fillna(0).to_numpy()
+    rows = []
+    for shard, (start, end) in enumerate(zip(starts, ends)):
+        rows.append([shard + 1, int(start), int(end), int(end - start + 1),
+            int(images[start:end + 1].sum()),
+            round(float(cost[start:end + 1].sum()), 1)])
+    return pd.DataFrame(rows, columns=["shard", "start", "end", "series",
+        "images", "predicted_seconds"])
+
+def format_walltime(seconds):
+    # DD:HH:MM:SS, as in extras/sybil_nlst_example_job.pbs.
+    seconds = int(np.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{days:02d}:{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def generate_job(template, plan, dicomdir, plan_path, scheduler="torque",
+    margin=1.5, minimages=MINIMUM_IMAGE_COUNT):
+    # Adapts the example PBS job to run one shard of the plan per array
+    # index: array directive, walltime and Sybil command.
+    directive, variable = SCHEDULERS[scheduler]
+    walltime = format_walltime(plan["predicted_seconds"].max() * margin)
+    lines = []
+    for line in template.splitlines():
+        if line.startswith("#PBS -l walltime="):
+            lines.append(f"#PBS -l walltime={walltime}")
+        elif line.startswith("#PBS -N"):
+            lines.append(line)
+            lines.append("")
+            lines.append(f"# One job per shard of {os.path.basename(plan_path)}")
+            lines.append(directive.format(n=len(plan)))
+        elif line.startswith("./sybil_dir.sif"):
+            lines.append("# Range of metadata.csv indexes of this shard")
+            lines.append(f"RANGE=$(awk -F, -v shard=${variable} " +
+                "'$1 == shard {print $2 \"-\" $3}' " + plan_path + ")")
+            lines.append(f"./sybil_dir.sif {dicomdir} -p $RANGE " +
+                f"-m {minimages}")
+        else:
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
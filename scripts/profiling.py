@@ -0,0 +1,177 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak RSS is not reported.
+    resource = None
+
+"""
+Profiling used by the --profile option of main.py, nlst_actual.py,
+sybil_eval.py, train_svm.py and test_model.py.
+
+When a Profiler is started, the script runs under cProfile and tracemalloc,
+and the sections of code wrapped in `with phase("name"):` are timed. Phases
+may be nested ("evaluate/roc") and repeated, e.g. once per DICOM, in which
+case their times are summed. Outside of a started Profiler, phase() does
+nothing, so functions can be instrumented whether or not they are profiled.
+
+The report is written next to the outputs of the script:
+
+- <script>_profile.json: for the whole run and for each phase, the number
+of calls, wall time, CPU time and peak memory allocated by Python
+(tracemalloc), the peak resident set size of the process and its child
+processes (e.g. joblib workers), and the functions with the highest
+cumulative time.
+- <script>_profile.prof: the cProfile statistics, which can be read with
+pstats or snakeviz.
+
+cProfile and tracemalloc slow the script down (tracemalloc by about 2x), so
+times are only comparable between profiled runs. Only the main thread is
+profiled by cProfile; child processes are not profiled.
+"""
+
+N_TOP_FUNCTIONS = 30
+
+# The started Profiler, used by phase().
+_active = None
+
+class Profiler:
+
+    def __init__(self, enabled=False, name=None):
+        self.enabled = enabled
+        if name is None:
+            name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        self.name = name
+        # phase path -> {calls, wall_seconds, cpu_seconds, peak_bytes}
+        self.phases = {}
+        # Stack of [phase path, peak bytes seen in child phases].
+        self._stack = []
+        self._profile = None
+        if enabled:
+            self.start()
+
+    def start(self):
+        global _active
+        _active = self
+        tracemalloc.start()
+        self._stack = [["", 0]]
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled or self._profile is None:
+            yield
+            return
+        # tracemalloc only keeps one peak, so the peak of the enclosing phase
+        # is saved before it is reset for this phase.
+        _, peak = tracemalloc.get_traced_memory()
+        parent = self._stack[-1]
+        parent[1] = max(parent[1], peak)
+        path = name if parent[0] == "" else parent[0] + "/" + name
+        frame = [path, 0]
+        self._stack.append(frame)
+        tracemalloc.reset_peak()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, frame[1])
+            self._stack.pop()
+            parent[1] = max(parent[1], peak)
+            record = self.phases.setdefault(path, {"calls": 0,
+                "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_bytes": 0})
+            record["calls"] += 1
+            record["wall_seconds"] += wall
+            record["cpu_seconds"] += cpu
+            record["peak_bytes"] = max(record["peak_bytes"], peak)
+
+    def report(self, directory, suffix=""):
+        # Stops profiling and writes the report files in directory. Returns
+        # the path of the JSON file, or None if profiling is not enabled.
+        global _active
+        if not self.enabled or self._profile is None:
+            return None
+        self._profile.disable()
+        wall = time.perf_counter() - self._start_wall
+        cpu = time.process_time() - self._start_cpu
+        _, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, self._stack[0][1])
+        tracemalloc.stop()
+
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"{self.name}{suffix}_profile")
+        stats = pstats.Stats(self._profile)
+        stats.dump_stats(base + ".prof")
+        report = {
+            "script": self.name,
+            "argv": sys.argv,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "wall_seconds": round(wall, 4),
+            "cpu_seconds": round(cpu, 4),
+            "peak_traced_bytes": peak,
+            "peak_rss_bytes": peak_rss(),
+            "peak_rss_children_bytes": peak_rss(children=True),
+            "phases": {path: {
+                "calls": record["calls"],
+                "wall_seconds": round(record["wall_seconds"], 4),
+                "cpu_seconds": round(record["cpu_seconds"], 4),
+                "peak_traced_bytes": record["peak_bytes"]
+            } for path, record in self.phases.items()},
+            "functions": top_functions(stats)
+        }
+        with open(base + ".json", 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Profile written to {base}.json and {base}.prof.")
+
+        self._profile = None
+        if _active is self:
+            _active = None
+        return base + ".json"
+
+def phase(name):
+    # Times a section of code with the started Profiler, if any.
+    if _active is None:
+        return _null_phase()
+    return _active.phase(name)
+
+@contextmanager
+def _null_phase():
+    yield
+
+def peak_rss(children=False):
+    # Peak resident set size in bytes, or None if unavailable.
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def top_functions(stats, n=N_TOP_FUNCTIONS):
+    # The n functions with the highest cumulative time.
+    rows = []
+    for (file_name, line, function), (_, calls, total, cumulative, _) in \
+        stats.stats.items():
+        rows.append({
+            "function": f"{file_name}:{line}({function})",
+            "calls": calls,
+            "total_seconds": round(total, 4),
+            "cumulative_seconds": round(cumulative, 4)
+        })
+    rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+    return rows[:n]
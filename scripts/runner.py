@@ -0,0 +1,276 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+"""
+This script runs the steps of the workflow described in the README (main.py
+portions, nlst_actual.py, sybil_eval.py per filter set, test_model.py) like
+`make`: a step is only executed again if its command, parameters or inputs
+changed since its last successful run, or if one of its outputs is missing.
+
+Steps are described in a JSON file, see extras/pipeline_example.json:
+
+{
+    "stages": {
+        "predict": {
+            "command": "./sybil_dir.sif {dicomdir} -p {portion}",
+            "inputs": ["{dicomdir}/metadata.csv"],
+            "outputs": ["{dicomdir}/sybil_predictions_{portion_name}.csv"],
+            "matrix": {"portion": ["1/5", "2/5"]}
+        },
+        ...
+    },
+    "variables": {"dicomdir": "/path/to/dicom_dir"}
+}
+
+- "command" is run through the shell, from the directory of the JSON file.
+- "{name}" is replaced by a variable, a matrix value, or <name>_name (the
+value with characters that are unsafe in file names replaced by '_').
+- "matrix" expands a stage into one step per combination of values, e.g. one
+per portion or one per filter set, which are tracked separately. A value may
+be an object setting several names at once, e.g.
+{"portion": "1/2", "range": "0_37499"}.
+- A step depends on every step whose outputs are among its inputs, or that is
+listed in "after". Independent steps run concurrently (--jobs).
+
+The hashes of the last successful run of each step are recorded in a state
+file next to the JSON file. Files are hashed by content (SHA-256). Directories
+are hashed by the names, sizes and modification times of their files, since
+hashing the content of a DICOM download is not practical.
+"""
+
+STATE_FILE = ".runner_state.json"
+
+class Step:
+
+    def __init__(self, name, command, inputs, outputs, after, params):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.after = after
+        self.params = params
+        self.dependencies = set()
+
+def main():
+    print("Pipeline Runner")
+
+    # ArgParse library is used to manage command line arguments.
+    parser = argparse.ArgumentParser(
+        epilog="Example: runner.py pipeline.json -j 4"
+    )
+    parser.add_argument("config", help="a JSON file describing the steps of \
+        the pipeline. See extras/pipeline_example.json.")
+    parser.add_argument('-j', '--jobs', help="The number of steps run \
+        concurrently. Default: 1.", type=int, default=1)
+    parser.add_argument('-n', '--dry-run', action='store_true', help="Only \
+        list the steps that would be run.")
+    parser.add_argument('-f', '--force', help="Any number of step or stage \
+        names to run even if they are up to date.", nargs='+', default=[])
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.abspath(args.config))
+    with open(args.config) as f:
+        config = json.load(f)
+    steps = load_steps(config)
+    state_path = os.path.join(root, STATE_FILE)
+    state = load_state(state_path)
+
+    failed = run_steps(steps, state, state_path, root, args.jobs,
+        args.dry_run, args.force)
+    if failed:
+        sys.exit(1)
+
+def load_steps(config):
+    # Expands each stage of the configuration into one step per combination
+    # of its matrix values.
+    variables = config.get("variables", {})
+    steps = {}
+    for stage_name, stage in config["stages"].items():
+        matrix = stage.get("matrix", {})
+        keys = list(matrix.keys())
+        for values in itertools.product(*[matrix[k] for k in keys]):
+            params = dict(variables)
+            matrix_params = {}
+            for key, value in zip(keys, values):
+                # A dict value sets several parameters at once.
+                if isinstance(value, dict):
+                    matrix_params.update(value)
+                else:
+                    matrix_params[key] = value
+            params.update(matrix_params)
+            for key in list(params.keys()):
+                params[key + "_name"] = safe_name(str(params[key]))
+            name = stage_name
+            if len(keys) > 0:
+                name += "[" + ",".join(safe_name(str(v))
+                    for v in matrix_params.values()) + "]"
+            steps[name] = Step(
+                name,
+                stage["command"].format(**params),
+                [i.format(**params) for i in stage.get("inputs", [])],
+                [o.format(**params) for o in stage.get("outputs", [])],
+                stage.get("after", []),
+                matrix_params
+            )
+
+    # A step depends on the steps producing its inputs.
+    producers = {}
+    for step in steps.values():
+        for output in step.outputs:
+            producers[os.path.normpath(output)] = step.name
+    for step in steps.values():
+        for path in step.inputs:
+            producer = producers.get(os.path.normpath(path))
+            if producer is not None and producer != step.name:
+                step.dependencies.add(producer)
+        for stage_name in step.after:
+            step.dependencies.update(s for s in steps
+                if s == stage_name or s.startswith(stage_name + "["))
+    return steps
+
+def safe_name(value):
+    return "".join(c if c.isalnum() or c in "-." else "_" for c in value)
+
+def load_state(state_path):
+    if not os.path.isfile(state_path):
+        return {"steps": {}, "files": {}}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_state(state, state_path):
+    temporary_path = state_path + ".tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(temporary_path, state_path)
+
+def hash_path(path, file_cache):
+    # Content hash of a file, or a listing hash of a directory. File hashes
+    # are cached by (size, modification time) so that unchanged files are
+    # not read again.
+    if os.path.isdir(path):
+        listing = hashlib.sha256()
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories.sort()
+            for file_name in sorted(files):
+                stat = os.stat(os.path.join(directory, file_name))
+                relative_path = os.path.relpath(
+                    os.path.join(directory, file_name), path)
+                listing.update(
+                    f"{relative_path}:{stat.st_size}:{stat.st_mtime_ns}\n"
+                    .encode())
+        return "dir:" + listing.hexdigest()
+    if not os.path.isfile(path):
+        return "missing"
+    stat = os.stat(path)
+    signature = f"{stat.st_size}:{stat.st_mtime_ns}"
+    cached = file_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    content = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            content.update(block)
+    file_cache[path] = [signature, content.hexdigest()]
+    return content.hexdigest()
+
+def step_key(step, root, file_cache):
+    # Hash of everything that determines the result of a step.
+    key = hashlib.sha256()
+    key.update(step.command.encode())
+    key.update(json.dumps(step.params, sort_keys=True).encode())
+    for path in sorted(step.inputs):
+        key.update(path.encode())
+        key.update(hash_path(os.path.join(root, path), file_cache).encode())
+    return key.hexdigest()
+
+def is_stale(step, key, state, root, force):
+    if step.name in force or step.name.split("[")[0] in force:
+        return True
+    if state["steps"].get(step.name) != key:
+        return True
+    return not all(os.path.exists(os.path.join(root, o))
+        for o in step.outputs)
+
+def run_command(step, root):
+    print(f"Running {step.name}: {step.command}")
+    start = time.perf_counter()
+    result = subprocess.run(step.command, shell=True, cwd=root)
+    end = time.perf_counter()
+    print(f"{step.name} finished with code {result.returncode} in " +
+        f"{end - start:0.4f} seconds.")
+    return result.returncode
+
+def run_steps(steps, state, state_path, root, jobs=1, dry_run=False,
+    force=None):
+    # Runs the steps in dependency order, up to `jobs` at a time. A step is
+    # only checked once all of the steps it depends on have finished, since
+    # their outputs are its inputs. Returns the names of failed steps.
+    force = [] if force is None else force
+    done, failed, running = set(), set(), {}
+    # Steps that a dry run would execute; their dependents would run too.
+    would_run = set()
+    pending = dict(steps)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            progress = False
+            for name, step in list(pending.items()):
+                if step.dependencies & failed:
+                    print(f"Skipping {name}: a dependency failed.")
+                    failed.add(name)
+                    del pending[name]
+                    progress = True
+                    continue
+                if not step.dependencies <= done:
+                    continue
+                del pending[name]
+                progress = True
+                key = step_key(step, root, state["files"])
+                if not (is_stale(step, key, state, root, force) or
+                    step.dependencies & would_run
+                ):
+                    print(f"{name} is up to date.")
+                    done.add(name)
+                    continue
+                if dry_run:
+                    print(f"Would run {name}: {step.command}")
+                    would_run.add(name)
+                    done.add(name)
+                    continue
+                running[executor.submit(run_command, step, root)] = \
+                    (step, key)
+            if not running:
+                if pending and not progress:
+                    print("Circular dependencies between: " +
+                        ", ".join(pending.keys()))
+                    failed.update(pending.keys())
+                    pending = {}
+                continue
+            finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in finished:
+                step, key = running.pop(future)
+                if future.result() == 0:
+                    done.add(step.name)
+                    state["steps"][step.name] = key
+                else:
+                    failed.add(step.name)
+                    state["steps"].pop(step.name, None)
+                if not dry_run:
+                    save_state(state, state_path)
+    if not dry_run:
+        save_state(state, state_path)
+    if failed:
+        print("Failed steps: " + ", ".join(sorted(failed)))
+    return failed
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
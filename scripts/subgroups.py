@@ -0,0 +1,246 @@
+import re
+import numpy as np
+import pandas as pd
+
+"""
+Bitmap index used by sybil_eval.py to select subgroups of the aligned
+actual/prediction table.
+
+Each (column, value) or (column, operator, value) term is computed once as a
+packed bitmap (one bit per row, numpy uint8) and cached. Subgroups are then
+built by combining those bitmaps with bitwise AND/OR/NOT, so the underlying
+column arrays are never copied or re-scanned, no matter how many subgroups
+are requested.
+
+Filter terms use the same format as the command line of sybil_eval.py:
+property_name:value:operator, e.g. race:2:e. The `in` operator accepts a
+comma-separated set of values, e.g. race:1,4:in.
+
+Terms can be combined into expressions:
+    &   -> and
+    |   -> or
+    ~   -> not
+    ( ) -> grouping
+Example: "gender:2:e & (race:2:e | race:3:e) & ~sybil_data_split:0:e"
+"""
+
+OPERATOR_DICT = {
+    'e'     :   '==',
+    'ne'    :   '!=',
+    'g'     :   '>',
+    'l'     :   '<',
+    'ge'    :   '>=',
+    'le'    :   '<=',
+    'in'    :   'in'
+}
+
+# Number of set bits in each possible byte, used to count packed bitmaps.
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+_TOKEN_RE = re.compile(r"\s*(?:([&|~()])|([^\s&|~()]+))")
+
+class SubgroupIndex:
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.n_rows = df.shape[0]
+        self.columns = list(df.columns)
+        # column -> {distinct value: packed bitmap}
+        self._value_bitmaps = {}
+        # (column, operator, value) -> packed bitmap
+        self._term_cache = {}
+        self._all = np.packbits(np.ones(self.n_rows, dtype=bool))
+        self._none = np.zeros_like(self._all)
+
+    def _column(self, column):
+        # Ensure valid property name
+        if column not in self.columns:
+            columns_str = ', '.join(str(c) for c in self.columns)
+            raise Exception(f"Invalid property name: {column}. " \
+                "\nPlease select a property name from the following list: " \
+                f"\n{columns_str}")
+        return self.df[column].to_numpy()
+
+    def values(self, column):
+        # Precomputes one equality bitmap per distinct value of a column in a
+        # single pass over the column, then returns the distinct values.
+        if column not in self._value_bitmaps:
+            codes, uniques = pd.factorize(self._column(column), sort=True)
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            bitmaps = []
+            for i in range(len(uniques)):
+                mask = np.zeros(self.n_rows, dtype=bool)
+                mask[order[bounds[i]:bounds[i + 1]]] = True
+                bitmaps.append(np.packbits(mask))
+            self._value_bitmaps[column] = dict(zip(uniques, bitmaps))
+        return list(self._value_bitmaps[column].keys())
+
+    def _equal(self, column, value):
+        self.values(column)
+        return self._value_bitmaps[column].get(value, self._none)
+
+    def term(self, column, value, op='e'):
+        # Returns the packed bitmap of a single filter term.
+        if op not in OPERATOR_DICT.keys():
+            operators_str = ', '.join(OPERATOR_DICT.keys())
+            raise Exception(f"Invalid operator: {op}. " \
+                "\nPlease select an operator from the following list: " \
+                f"\n{operators_str}")
+        if op == 'in':
+            value = tuple(value) if isinstance(value, (list, tuple, set)) \
+                else tuple(_parse_value(v) for v in str(value).split(','))
+        elif isinstance(value, str):
+            value = _parse_value(value)
+        key = (column, op, value)
+        if key in self._term_cache:
+            return self._term_cache[key]
+
+        if op == 'e':
+            bitmap = self._equal(column, value)
+        elif op == 'ne':
+            bitmap = self.negate(self._equal(column, value))
+        elif op == 'in':
+            bitmap = self.union(*[self._equal(column, v) for v in value])
+        else:
+            array = self._column(column)
+            if op == 'g':
+                mask = array > value
+            elif op == 'l':
+                mask = array < value
+            elif op == 'ge':
+                mask = array >= value
+            else:
+                mask = array <= value
+            bitmap = np.packbits(mask)
+        self._term_cache[key] = bitmap
+        return bitmap
+
+    def parse_term(self, filt):
+        # Accepts a filter formatted as property_name:value:operator.
+        parse_list = filt.split(':')
+        if len(parse_list) != 3:
+            raise Exception(f"Invalid filter: {filt}. " \
+                "\nFilters are formatted as property_name:value:operator, " \
+                "e.g. race:2:e.")
+        try:
+            return self.term(parse_list[0], parse_list[1], parse_list[2])
+        except Exception as e:
+            raise Exception(f"Invalid filter {filt}: {e}")
+
+    def evaluate(self, expression):
+        # Parses a filter expression (see top of file) and returns its packed
+        # bitmap.
+        tokens = _tokenize(expression)
+        if len(tokens) == 0:
+            return self._all
+        bitmap, position = self._parse_or(tokens, 0)
+        if position != len(tokens):
+            raise Exception(f"Unexpected '{tokens[position]}' in filter " \
+                f"expression: {expression}")
+        return bitmap
+
+    def evaluate_all(self, expressions):
+        # Multiple expressions (e.g. command line filters) are combined with
+        # 'and', matching the original behavior of sybil_eval.py.
+        return self.intersect(*[self.evaluate(e) for e in expressions])
+
+    def _parse_or(self, tokens, position):
+        bitmap, position = self._parse_and(tokens, position)
+        while position < len(tokens) and tokens[position] == '|':
+            other, position = self._parse_and(tokens, position + 1)
+            bitmap = np.bitwise_or(bitmap, other)
+        return bitmap, position
+
+    def _parse_and(self, tokens, position):
+        bitmap, position = self._parse_not(tokens, position)
+        while position < len(tokens) and tokens[position] == '&':
+            other, position = self._parse_not(tokens, position + 1)
+            bitmap = np.bitwise_and(bitmap, other)
+        return bitmap, position
+
+    def _parse_not(self, tokens, position):
+        if position >= len(tokens):
+            raise Exception("Filter expression ended unexpectedly.")
+        token = tokens[position]
+        if token == '~':
+            bitmap, position = self._parse_not(tokens, position + 1)
+            return self.negate(bitmap), position
+        if token == '(':
+            bitmap, position = self._parse_or(tokens, position + 1)
+            if position >= len(tokens) or tokens[position] != ')':
+                raise Exception("Missing ')' in filter expression.")
+            return bitmap, position + 1
+        if token in ['&', '|', ')']:
+            raise Exception(f"Unexpected '{token}' in filter expression.")
+        return self.parse_term(token), position + 1
+
+    def intersect(self, *bitmaps):
+        output = self._all
+        for bitmap in bitmaps:
+            output = np.bitwise_and(output, bitmap)
+        return output
+
+    def union(self, *bitmaps):
+        output = self._none
+        for bitmap in bitmaps:
+            output = np.bitwise_or(output, bitmap)
+        return output
+
+    def negate(self, bitmap):
+        # Padding bits past the last row are cleared by masking with _all.
+        return np.bitwise_and(np.invert(bitmap), self._all)
+
+    def count(self, bitmap):
+        return int(_POPCOUNT[bitmap].sum())
+
+    def mask(self, bitmap):
+        # Unpacks a bitmap into a boolean row mask usable with DataFrame.loc.
+        return np.unpackbits(bitmap, count=self.n_rows).astype(bool)
+
+    def indices(self, bitmap):
+        return np.flatnonzero(self.mask(bitmap))
+
+    def intersections(self, columns, within=None, min_size=1):
+        # Yields every intersectional subgroup over the distinct values of the
+        # given columns, e.g. ['race', 'gender'] -> (race=1, gender=1),
+        # (race=1, gender=2), ... as ({column: value}, bitmap) pairs.
+        # Empty partial intersections are pruned before descending further.
+        if within is None:
+            within = self._all
+        for column in columns:
+            self.values(column)
+
+        def descend(depth, bitmap, key):
+            if self.count(bitmap) < min_size:
+                return
+            if depth == len(columns):
+                yield dict(key), bitmap
+                return
+            column = columns[depth]
+            for value, value_bitmap in self._value_bitmaps[column].items():
+                yield from descend(depth + 1,
+                    np.bitwise_and(bitmap, value_bitmap),
+                    key + [(column, value)])
+
+        yield from descend(0, within, [])
+
+def _tokenize(expression):
+    tokens = []
+    for symbol, term in _TOKEN_RE.findall(expression):
+        tokens.append(symbol if symbol else term)
+    return tokens
+
+def _parse_value(value):
+    # Filter values arrive as strings from the command line.
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+def subgroup_name(key):
+    # Converts an intersections() key into filter notation, e.g.
+    # {'race': 2, 'gender': 1} -> ['race:2:e', 'gender:1:e'].
+    return [f"{column}:{value}:e" for column, value in key.items()]
@@ -1,4 +1,3 @@
-from sklearn.metrics import roc_curve, auc, confusion_matrix
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
@@ -7,10 +6,14 @@ import sys
 import os
 import argparse
 
+from subgroups import SubgroupIndex, subgroup_name
+from profiling import Profiler, phase
+from metrics import (horizon_metrics, concordance_index, time_dependent_auc,
+    simplify_curve, PLOT_TOLERANCE)
 
 """
-This script is used to generate ROC curves, AUC, and confusion matrices based
-on a variety of user inputs.
+This script is used to generate ROC curves, AUC, calibration and confusion
+matrices based on a variety of user inputs.
 
 It is designed to be specifically utilized with the other scripts in this
 project which generate the prerequisite CSVs for this script.
@@ -22,13 +25,19 @@ Cancer Imaging Archive).
 
 # Constants
 N_PREDICTION_YEARS = 6
-
-OPERATOR_DICT = {
-    'e'     :   '==',
-    'g'     :   '>',
-    'l'     :   '<',
-    'ge'    :   '>=',
-    'le'    :   '<='
+DAYS_IN_YEAR = 365 # As in nlst_actual.py
+# Follow-up after each CT used as censoring time in survival mode, in days.
+FOLLOWUP_DAYS = N_PREDICTION_YEARS * DAYS_IN_YEAR
+
+# Replacements for filter expression symbols in output directory names.
+DIR_NAME_SYMBOLS = {
+    ' '     :   '',
+    '('     :   '',
+    ')'     :   '',
+    ','     :   '-',
+    '&'     :   'and',
+    '|'     :   'or',
+    '~'     :   'not'
 }
 
 # Global rounding: the number of digits to the right of the decimal point
@@ -58,76 +67,123 @@ def main():
     parser.add_argument('-f', "--filters", help="Any number of filters to \
         apply to the data, formated as such: property_name:value:operator, \
         e.g. race:2:e. Operator options: \
-        e -> equal, g -> greater than, l -> less than, \
-        ge -> greater than or equal to, le -> less than or equal to. \
+        e -> equal, ne -> not equal, g -> greater than, l -> less than, \
+        ge -> greater than or equal to, le -> less than or equal to, \
+        in -> one of a comma-separated set, e.g. race:1,4:in. \
+        Filters may be combined within one argument using & (and), | (or), \
+        ~ (not) and parentheses, e.g. \"race:2:e | race:3:e\". \
+        Separate arguments are combined with 'and'. \
         Default: no filters.", 
         nargs='+', default=[])
+    parser.add_argument('-i', '--intersect', help="Any number of property \
+        names. Evaluation is repeated for every intersectional subgroup of \
+        the distinct values of these properties (after applying filters), \
+        e.g. -i race gender. Each subgroup has its own output directory. \
+        Default: no subgroups.", nargs='+', default=None)
     parser.add_argument('-c', '--cutoffs', help="Any number of probability \
         cutoffs to be used for the generation of multiple confusion matrices. \
         Default: Youden's J index", type=float,
         nargs='+', default=None)
+    parser.add_argument('-t', '--tolerance', help="Tolerance of the \
+        simplification of the plotted ROC curves, in axis units. 0 plots \
+        every point. AUCs are computed on the full curves. Default: 0.001.",
+        type=float, default=PLOT_TOLERANCE)
+    parser.add_argument('-s', '--survival', action="store_true", help="Also \
+        evaluate the predictions as survival predictions from \
+        days_to_diagnosis: concordance index of the last year's prediction \
+        and time-dependent AUC of each year.")
+    parser.add_argument('--followup', help="In survival mode, the follow-up \
+        of each CT in days: participants without cancer are censored at this \
+        time, and cancers diagnosed later are not counted. \
+        Default: 2190 (6 years).", type=int, default=FOLLOWUP_DAYS)
+    parser.add_argument("--profile", action="store_true", help="Write a \
+        profile report (cProfile statistics, time and peak memory per phase) \
+        in the output directory. See profiling.py.")
     args = parser.parse_args()
     print("Actual:", args.actual)
     print("Prediction:", args.prediction)
     print("Output directory:", args.outdir)
     print("Filters:", args.filters)
     print("Cutoffs:", args.cutoffs)
+    print("Intersect:", args.intersect)
+    if args.survival:
+        print("Survival follow-up (days):", args.followup)
+
+    profiler = Profiler(args.profile)
 
     # Read in CSVs
-    actual = pd.read_csv(args.actual)
-    prediction = pd.read_csv(args.prediction)
-
-    # Filter the actual CSV
-    if len(args.filters) > 0:
-        actual_filtered = parse_filters(actual, args.filters)
-    else:
-        actual_filtered = actual
-
-    # Initialize new actual dataframe
-    actual_aligned = []
-    prediction_aligned = []
-
-    # Iterate through the filtered CSV
-    for index, row in actual_filtered.iterrows():
-        query_str = ""
-        # Find entries with the same PID
-        query_str += "pid == " + str(row["pid"]) + " and "
-        # Find entries with the same screening year
-        query_str += "study_yr == " + str(row["study_yr"])
-        queried_prediction = prediction.query(query_str)
-        n_predictions = queried_prediction.shape[0]
-
-        # There are multiple CT scans per individual patient per study year.
-        # Because of this, the actual data and prediction data don't align.
-        # Thus, repeated actual data columns must be generated to match the
-        # prediction data.
-        actual_values = []
-        for year in range(1,N_PREDICTION_YEARS+1):
-            column_name = "canc_yr" + str(year)
-            actual_value = row[column_name]
-            actual_values.append(actual_value)
-        for repeat in range(n_predictions):
-            actual_aligned.append(actual_values)
-
-        # Add the prediction probability values to the aligned DataFrame.
-        for index in range(n_predictions):
-            prediction_values = []
-            for year in range(1,N_PREDICTION_YEARS+1):
-                column_name = "pred_yr" + str(year)
-                prediction_value = queried_prediction.iloc[index][column_name]
-                prediction_values.append(prediction_value)
-            prediction_aligned.append(prediction_values)
-   
+    with phase("read"):
+        actual = pd.read_csv(args.actual)
+        prediction = pd.read_csv(args.prediction)
+
+    evaluate(actual, prediction, args.outdir, args.filters, args.cutoffs,
+        args.intersect, args.followup if args.survival else None,
+        args.tolerance)
+
+    profiler.report(args.outdir)
+
+def evaluate(actual, prediction, outdir, filters=None, cutoffs=None,
+    intersect=None, followup=None, tolerance=PLOT_TOLERANCE):
+    # Generates the ROC curves and confusion matrices for the actual and
+    # prediction DataFrames (see nlst_actual.py and main.py), for the
+    # filtered data or each intersectional subgroup.
+    # followup: follow-up in days for the survival metrics, which are only
+    # generated if it is given.
+    # tolerance: simplification of the plotted curves (see metrics.py).
+    filters = [] if filters is None else list(filters)
+
+    # Align the actual values to the predictions, then index the aligned
+    # table so that filters and subgroups are selected with bitmaps.
+    with phase("align"):
+        aligned = align(actual, prediction)
+    with phase("filter"):
+        index = SubgroupIndex(aligned)
+        selected = index.evaluate_all(filters)
+    if len(filters) > 0:
+        print(f"Query: {' & '.join(f'({f})' for f in filters)}")
+        print(f"Number of entries satisfying query: {index.count(selected)}")
+
+    if intersect:
+        for key, bitmap in index.intersections(intersect, selected):
+            subgroup_filters = filters + subgroup_name(key)
+            print("Subgroup: " +
+                ' & '.join(f'({f})' for f in subgroup_filters))
+            with phase("evaluate"):
+                evaluate_subgroup(aligned, index.mask(bitmap),
+                    subgroup_filters, outdir, cutoffs, followup, tolerance)
+        return
+
+    with phase("evaluate"):
+        evaluate_subgroup(aligned, index.mask(selected), filters, outdir,
+            cutoffs, followup, tolerance)
+
+def align(actual, prediction):
+    # There are multiple CT scans per individual patient per study year.
+    # Because of this, the actual data and prediction data don't align.
+    # Thus, repeated actual data rows are generated to match the prediction
+    # data. An inner merge keeps the order of the actual rows, and within
+    # each (pid, study_yr) the order of the predictions.
+    prediction_columns = ["pid", "study_yr"] + \
+        ["pred_yr" + str(year) for year in range(1,N_PREDICTION_YEARS+1)]
+    return actual.merge(prediction[prediction_columns],
+        on=["pid", "study_yr"], how="inner", suffixes=("", "_prediction"))
+
+def evaluate_subgroup(aligned, mask, filters, outdir, cutoffs,
+    followup=None, tolerance=PLOT_TOLERANCE):
     # Create DataFrames
     # These dataframes can now be compared-
     # year1 of the actual aligned df can be compared with year1 of the
     # prediction aligned df, year2 with year2, and so on.
     column_names = ["year" + str(i) for i in range(1,N_PREDICTION_YEARS+1)]
     actual_aligned_df = pd.DataFrame(
-        actual_aligned, columns = column_names
+        aligned.loc[mask, ["canc_yr" + str(i)
+            for i in range(1,N_PREDICTION_YEARS+1)]].to_numpy(),
+        columns = column_names
     )
     prediction_aligned_df = pd.DataFrame(
-        prediction_aligned, columns = column_names
+        aligned.loc[mask, ["pred_yr" + str(i)
+            for i in range(1,N_PREDICTION_YEARS+1)]].to_numpy(),
+        columns = column_names
     )
     
     print(f"Number of associated CT DICOMs: {prediction_aligned_df.shape[0]}")
@@ -138,42 +194,64 @@ def main():
         print("There are no entries left in actual values after filtering. " +
             "Quitting.")
         return
-    if prediction_aligned_df.shape[0] == 0:
-        print("There are no entries left in prediction values after aligning" +
-            " to actual values. Quitting.")
-        return
 
     # Create output directory named based on filters.
-    output_directory = args.outdir + '/' + generate_dir_name(args.filters)
+    output_directory = outdir + '/' + generate_dir_name(filters)
     if not os.path.exists(output_directory):
         os.mkdir(output_directory)
 
-    # Execute function to generate multi-ROC curve, generates PNG.
-    optimal_cutoffs = generate_multi_roc(
-        actual_aligned_df,
-        prediction_aligned_df,
-        output_directory
-    )
+    # The scores of every year are sorted once; the ROC curves, calibration
+    # and confusion matrices are all derived from them (see metrics.py).
+    with phase("metrics"):
+        metrics = horizon_metrics(actual_aligned_df, prediction_aligned_df)
+        generate_metrics_summary(actual_aligned_df, metrics, output_directory)
 
-    # Execute function to generate multiple confusion matrices, generates one
-    # CSV file per prediction year.
-    if args.cutoffs:
-        generate_confusion_matrices(
-            actual_aligned_df,
-            prediction_aligned_df,
-            output_directory,
-            args.cutoffs,
-            mode = "all"
-        )
-    else:
-        generate_confusion_matrices(
+    # Execute function to generate multi-ROC curve, generates PNG.
+    with phase("roc"):
+        optimal_cutoffs = generate_multi_roc(
             actual_aligned_df,
             prediction_aligned_df,
             output_directory,
-            optimal_cutoffs,
-            mode = "one_each"
+            metrics,
+            tolerance
         )
 
+    # Execute function to generate calibration curves, generates PNG and CSV.
+    with phase("calibration"):
+        generate_calibration(actual_aligned_df, metrics, output_directory)
+
+    # Execute function to generate multiple confusion matrices, generates one
+    # CSV file per prediction year.
+    with phase("confusion matrices"):
+        if cutoffs:
+            generate_confusion_matrices(
+                actual_aligned_df,
+                prediction_aligned_df,
+                output_directory,
+                cutoffs,
+                mode = "all",
+                metrics = metrics
+            )
+        else:
+            generate_confusion_matrices(
+                actual_aligned_df,
+                prediction_aligned_df,
+                output_directory,
+                optimal_cutoffs,
+                mode = "one_each",
+                metrics = metrics
+            )
+
+    # Execute function to generate the survival metrics, generates CSV.
+    if followup is not None:
+        with phase("survival"):
+            generate_survival_metrics(
+                aligned.loc[mask, "days_to_diagnosis"].to_numpy(),
+                prediction_aligned_df,
+                output_directory,
+                followup
+            )
+
 def generate_dir_name(filters: list[str]) -> str:
     # This function generates the name of the output directory depending on the
     # filters used in the command line arguments.
@@ -184,6 +262,9 @@ def generate_dir_name(filters: list[str]) -> str:
         output += '_'
         filter_clean = filt.replace(':', '')
         filter_clean = filter_clean.replace('_', '')
+        # Expression symbols are not safe in directory names.
+        for symbol, word in DIR_NAME_SYMBOLS.items():
+            filter_clean = filter_clean.replace(symbol, word)
         output += filter_clean
     return output
 
@@ -198,50 +279,25 @@ def parse_filters(df: pd.DataFrame, filters: list[str]) -> pd.DataFrame:
     # 2 = the value used for comparison
     # e = the chosen comparison operator, in this case 'equal to'
     # The filter therefore selects only individuals whose race is equal to 2.
+    # See subgroups.py for the expression syntax (and, or, not, in).
+
+    index = SubgroupIndex(df)
+    selected = index.evaluate_all(filters)
+    print(f"Query: {' & '.join(f'({f})' for f in filters)}")
+    print(f"Number of entries satisfying query: {index.count(selected)}")
+    return df.loc[index.mask(selected)]
 
-    query_str = ""
-    for index in range(len(filters)):
-        parse_list = filters[index].split(':')
-        appended_str = ""
-        
-        # Add property name
-        # Ensure valid property name
-        if parse_list[0] not in df.columns:
-            columns_str = ', '.join(df.columns)
-            raise Exception("Invalid property name found in filter " \
-                f"{filters[index]}: {parse_list[0]}. " \
-                "\nPlease select a property name from the following list: " \
-                f"\n{columns_str}")
-        appended_str += parse_list[0] + " "
-
-        # Add operator
-        # Ensure valid operator
-        if parse_list[2] not in OPERATOR_DICT.keys():
-            operators_str = ', '.join(OPERATOR_DICT.keys())
-            raise Exception("Invalid operator found in filter " \
-                f"({filters[index]}): {parse_list[2]}. " \
-                "\nPlease select an operator from the following list: " \
-                f"\n{operators_str}")
-        appended_str += OPERATOR_DICT[parse_list[2]] + " "
-
-        # Add value
-        appended_str += parse_list[1]
-
-        # Add 'and'
-        if index != len(filters) - 1:
-            appended_str += " and "
-
-        query_str += appended_str
-    print(f"Query: {query_str}")
-    output = df.query(query_str)
-    print(f"Number of entries satisfying query: {output.shape[0]}")
-    return df.query(query_str)      
-
-def generate_multi_roc(actual, prediction, out_dir):
+def generate_multi_roc(actual, prediction, out_dir, metrics=None,
+    tolerance=PLOT_TOLERANCE):
     # This function uses actual and prediction values to create a multi-ROC
     # curve PNG image, which it then stores in a specified output directory.
     # The generated image is labeled such that each curve is identified by year,
     # and area under curve (AUC) value is provided for each curve.
+    # metrics: the metrics of each year (see metrics.py), if already
+    # computed.
+    # tolerance: the curves are simplified before they are plotted, which
+    # keeps the image small and fast to render for large cohorts; the AUC is
+    # computed on the full curve.
     
     print("Generating Multi-ROC curve...")
 
@@ -249,19 +305,20 @@ def generate_multi_roc(actual, prediction, out_dir):
     # J index, or equivalently, the sum of sensitivity and specificity, across
     # all points of the ROC curve.
     # One cutoff per ROC curve.
+    if metrics is None:
+        metrics = horizon_metrics(actual, prediction)
     output = []
     plt.figure(figsize = (5, 5), dpi = 100)
-    for year in actual:
-        current_actual = actual[year].tolist()
-        current_prediction = prediction[year].tolist()
-        fpr, tpr, threshold = roc_curve(current_actual, current_prediction)
+    for year, year_metrics in zip(actual, metrics):
+        fpr, tpr = year_metrics.fpr, year_metrics.tpr
         # Calculate Area Under Curve (AUC), round to nearest 5 decimal points.
-        roc_auc = round(auc(fpr, tpr), GR)
+        roc_auc = round(year_metrics.roc_auc, GR)
 
-        optimal_cutoff = threshold[np.argmax(tpr - fpr)]
+        optimal_cutoff = year_metrics.youden_cutoff()
         output.append(optimal_cutoff)
 
-        plt.plot(fpr, tpr, linestyle = "-",
+        keep = simplify_curve(fpr, tpr, tolerance)
+        plt.plot(fpr[keep], tpr[keep], linestyle = "-",
             label = f"{year}: AUC = {roc_auc}")
 
     plt.xlabel("1 - Specificity")
@@ -271,12 +328,97 @@ def generate_multi_roc(actual, prediction, out_dir):
 
     file_name = "multi_roc.png"
     plt.savefig(out_dir + "/" + file_name)
+    # Many subgroups may be plotted in one run, so release each figure.
+    plt.close()
     return output
 
+def generate_metrics_summary(actual, metrics, out_dir):
+    # This function writes the AUCs, average precision and Brier score of each
+    # prediction year to a CSV file.
+    rows = []
+    for year, year_metrics in zip(actual, metrics):
+        rows.append([year, year_metrics.n, year_metrics.positives,
+            year_metrics.roc_auc, year_metrics.pr_auc,
+            year_metrics.average_precision, year_metrics.brier])
+    summary = pd.DataFrame(rows, columns=["year", "n", "n_positive",
+        "roc_auc", "pr_auc", "average_precision", "brier"])
+    summary.round(GR).to_csv(out_dir + "/metrics.csv", index=False)
+
+def generate_calibration(actual, metrics, out_dir):
+    # This function writes the binned calibration curve of each prediction
+    # year (mean predicted probability against observed rate of cancer) to a
+    # CSV file, and plots them in a PNG image.
+
+    print("Generating calibration curves...")
+
+    tables = []
+    plt.figure(figsize = (5, 5), dpi = 100)
+    for year, year_metrics in zip(actual, metrics):
+        tables.append(pd.DataFrame({
+            "year": year,
+            "bin_lower": year_metrics.bin_edges[:-1],
+            "bin_upper": year_metrics.bin_edges[1:],
+            "n": year_metrics.bin_counts,
+            "mean_predicted": year_metrics.mean_predicted,
+            "observed": year_metrics.observed
+        }))
+        filled = year_metrics.bin_counts > 0
+        plt.plot(year_metrics.mean_predicted[filled],
+            year_metrics.observed[filled], marker = ".", linestyle = "-",
+            label = f"{year}: Brier = {round(year_metrics.brier, GR)}")
+    plt.plot([0, 1], [0, 1], color = "#E7E7E7", linestyle = "dashed")
+
+    plt.xlabel("Mean predicted probability")
+    plt.ylabel("Observed rate")
+    plt.title("Sybil Calibration", loc = "center")
+    plt.legend(loc = "upper left")
+
+    plt.savefig(out_dir + "/calibration.png")
+    plt.close()
+    pd.concat(tables).round(GR).to_csv(out_dir + "/calibration.csv",
+        index=False)
+
+def generate_survival_metrics(days_to_diagnosis, prediction, out_dir,
+    followup=FOLLOWUP_DAYS):
+    # This function evaluates the predictions against the time to diagnosis
+    # instead of the yearly cancer columns, and writes the results to a CSV
+    # file:
+    # - concordance index (Harrell's C) of the last year's prediction, as a
+    # risk score for the time to diagnosis.
+    # - time-dependent AUC of each year's prediction: CTs with a diagnosis
+    # within n years against CTs still without cancer after n years. CTs
+    # censored before n years are not counted, unlike in the yearly columns.
+    # Participants without cancer (days_to_diagnosis of -1) are censored at
+    # the follow-up time, as are cancers diagnosed later. Diagnoses before
+    # the CT count as diagnoses at day 0.
+
+    print("Generating survival metrics...")
+
+    days = np.asarray(days_to_diagnosis, dtype=float)
+    events = (days != -1) & (days <= followup)
+    times = np.where(events, np.maximum(days, 0), followup)
+
+    rows = []
+    c_index, pairs = concordance_index(times, events,
+        prediction.iloc[:, -1].to_numpy())
+    rows.append(["c_index", prediction.columns[-1], c_index,
+        int(events.sum()), np.nan, pairs])
+    for index, year in enumerate(prediction):
+        td_auc, n_cases, n_controls = time_dependent_auc(times, events,
+            prediction[year].to_numpy(), (index + 1) * DAYS_IN_YEAR)
+        rows.append(["td_auc", year, td_auc, n_cases, n_controls, np.nan])
+    output = pd.DataFrame(rows, columns=["metric", "year", "value",
+        "n_cases", "n_controls", "n_pairs"]).astype({"n_controls": "Int64",
+        "n_pairs": "Int64"})
+    print(output.round(GR).to_string(index=False))
+    output.round(GR).to_csv(out_dir + "/survival.csv", index=False)
+
 def generate_confusion_matrices(actual, prediction, out_dir, cutoffs,
-    mode='one_each'):
+    mode='one_each', metrics=None):
     # This function uses actual and prediction values to create multiple
     # confusion matrices using the provided cutoffs (thresholds).
+    # metrics: the metrics of each year (see metrics.py), if already
+    # computed.
     
     print("Generating confusion matrices...")
     print(f"Cutoffs: {cutoffs}")
@@ -296,29 +438,38 @@ def generate_confusion_matrices(actual, prediction, out_dir, cutoffs,
                 "not equal to the number of prediction years.")
             return
 
+    if metrics is None:
+        metrics = horizon_metrics(actual, prediction)
+
     for index, year in enumerate(actual):
         csv_name = "confusion_matrices_" + year + ".csv"
         with open(out_dir + "/" + csv_name, 'w') as current_csv:
             if mode == "all":
                 for cutoff in cutoffs:
                     matrix_csv = counts_to_matrix(
-                        actual[year], prediction[year], cutoff)
+                        actual[year], prediction[year], cutoff,
+                        metrics[index])
                     current_csv.write(matrix_csv)
             elif mode == "one_each":
                 matrix_csv = counts_to_matrix(
-                    actual[year], prediction[year], cutoffs[index])
+                    actual[year], prediction[year], cutoffs[index],
+                    metrics[index])
                 current_csv.write(matrix_csv)
     
-def counts_to_matrix(truth, prediction, cutoff):
+def counts_to_matrix(truth, prediction, cutoff, metrics=None):
     # This function accepts a truth array, prediction array, and cutoff, then
     # returns a string in CSV format representing a confusion matrix with
     # additional descriptive statistics:
     # Sensitivity, Specificity, Accuracy, Positive Predictive Value, and
     # Negative Predictive Value.
+    # Predictions above the cutoff are positive. The counts are looked up in
+    # the sorted scores of metrics (see metrics.py) if given.
     
     output = f"Probability cutoff,=,{round(cutoff, GR)}\n"
-    pred = np.where(prediction > cutoff, 1, 0)
-    tn, fp, fn, tp = confusion_matrix(truth, pred).ravel()
+    if metrics is None:
+        metrics = horizon_metrics(truth, prediction)[0]
+    tn, fp, fn, tp = [int(count) for count in
+        metrics.counts(cutoff, strict=True)]
     total = tn+fp+fn+tp
 
     # Write confusion matrix
@@ -345,8 +496,9 @@ def counts_to_matrix(truth, prediction, cutoff):
 
     return output
 
-start = time.perf_counter()
-main()
-end = time.perf_counter()
-print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
+if __name__ == "__main__":
+    start = time.perf_counter()
+    main()
+    end = time.perf_counter()
+    print(f"{sys.argv[0]} Completed in {end - start:0.4f} seconds.")
 
@@ -0,0 +1,177 @@
+import os
+import sys
+import numpy as np
+import pytest
+from sklearn.metrics import (roc_curve, roc_auc_score, precision_recall_curve,
+    average_precision_score, brier_score_loss, confusion_matrix)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'scripts'))
+from metrics import (binary_metrics, horizon_metrics, concordance_index,
+    time_dependent_auc, simplify_curve, ScoreHistogram)
+
+"""
+Compares the single-sort metrics, the survival metrics and the curve
+simplification of metrics.py with sklearn or brute-force references on
+random data.
+"""
+
+def random_scores(rng, n, ties=False):
+    # Rounded scores produce many tied thresholds.
+    truth = (rng.random(n) < rng.uniform(0.05, 0.5)).astype(int)
+    scores = np.clip(rng.normal(0.3 + 0.3 * truth, 0.2), 0, 1)
+    if ties:
+        scores = np.round(scores, 1)
+    return truth, scores
+
+@pytest.mark.parametrize("seed", range(10))
+def test_binary_metrics_match_sklearn(seed):
+    rng = np.random.default_rng(seed)
+    truth, scores = random_scores(rng, int(rng.integers(20, 2000)),
+        ties=seed % 2 == 0)
+    if truth.min() == truth.max():
+        truth[0] = 1 - truth[0]
+    metrics = binary_metrics(truth, scores)
+
+    fpr, tpr, thresholds = roc_curve(truth, scores)
+    assert np.allclose(metrics.fpr, fpr)
+    assert np.allclose(metrics.tpr, tpr)
+    assert np.array_equal(metrics.roc_thresholds, thresholds)
+    assert metrics.roc_auc == pytest.approx(roc_auc_score(truth, scores))
+
+    precision, recall, pr_thresholds = precision_recall_curve(truth, scores)
+    assert np.allclose(metrics.precision, precision)
+    assert np.allclose(metrics.recall, recall)
+    assert np.array_equal(metrics.pr_thresholds, pr_thresholds)
+    assert metrics.average_precision == \
+        pytest.approx(average_precision_score(truth, scores))
+    assert metrics.brier == pytest.approx(brier_score_loss(truth, scores))
+
+    for cutoff in rng.choice(scores, 5):
+        expected = confusion_matrix(truth, scores >= cutoff,
+            labels=[0, 1]).ravel()
+        assert np.array_equal(np.ravel(metrics.counts([cutoff])), expected)
+        expected = confusion_matrix(truth, scores > cutoff,
+            labels=[0, 1]).ravel()
+        assert np.array_equal(np.ravel(metrics.counts([cutoff], strict=True)),
+            expected)
+
+def test_horizon_metrics_match_single_horizons():
+    rng = np.random.default_rng(0)
+    truth = (rng.random((500, 6)) < 0.2).astype(int)
+    scores = np.round(rng.random((500, 6)), 2)
+    for i, metrics in enumerate(horizon_metrics(truth, scores)):
+        single = binary_metrics(truth[:, i], scores[:, i])
+        assert metrics.roc_auc == single.roc_auc
+        assert np.array_equal(metrics.tpr, single.tpr)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_operating_points_match_argmin(seed):
+    rng = np.random.default_rng(seed)
+    truth, scores = random_scores(rng, 400, ties=seed % 2 == 0)
+    metrics = binary_metrics(truth, scores)
+    fpr, tpr, thresholds = roc_curve(truth, scores)
+    targets = np.linspace(0, 1, 11)
+    points = metrics.operating_points(targets)
+    for target, cutoff in zip(targets, points["cutoff"]):
+        assert cutoff == thresholds[np.argmin(np.abs(tpr - target))]
+    points = metrics.operating_points(targets, by="specificity")
+    for target, cutoff in zip(targets, points["cutoff"]):
+        assert cutoff == thresholds[np.argmin(np.abs(1 - fpr - target))]
+
+def naive_concordance(times, events, risks):
+    # Every pair: comparable if the shorter time is an event, or if the
+    # times are equal and only one of the two is an event.
+    concordant, comparable = 0.0, 0
+    for i in range(len(times)):
+        if not events[i]:
+            continue
+        for j in range(len(times)):
+            if i == j:
+                continue
+            if times[i] < times[j] or (times[i] == times[j] and
+                not events[j]):
+                comparable += 1
+                if risks[i] > risks[j]:
+                    concordant += 1
+                elif risks[i] == risks[j]:
+                    concordant += 0.5
+    return concordant / comparable, comparable
+
+@pytest.mark.parametrize("seed", range(10))
+def test_concordance_index_matches_pairs(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(2, 200))
+    # Integer times and rounded risks produce ties of both.
+    times = rng.integers(1, 20, n).astype(float)
+    events = rng.random(n) < 0.4
+    risks = np.round(rng.random(n) - 0.02 * times, 1)
+    events[0] = True
+    times[0] = 1
+    if np.all(times == 1):
+        times[1] = 2
+    c, pairs = concordance_index(times, events, risks)
+    expected_c, expected_pairs = naive_concordance(times, events, risks)
+    assert pairs == expected_pairs
+    assert c == pytest.approx(expected_c)
+
+def test_concordance_index_without_pairs():
+    c, pairs = concordance_index([1, 2, 3], [False, False, False],
+        [0.1, 0.2, 0.3])
+    assert np.isnan(c) and pairs == 0
+
+@pytest.mark.parametrize("seed", range(10))
+def test_time_dependent_auc_matches_pairs(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(10, 300))
+    times = rng.integers(1, 10, n).astype(float)
+    events = rng.random(n) < 0.3
+    scores = np.round(rng.random(n), 1)
+    horizon = float(rng.integers(2, 8))
+    cases = events & (times <= horizon)
+    controls = (times > horizon) | (~events & (times == horizon))
+    auc, n_cases, n_controls = time_dependent_auc(times, events, scores,
+        horizon)
+    assert (n_cases, n_controls) == (cases.sum(), controls.sum())
+    if n_cases == 0 or n_controls == 0:
+        assert np.isnan(auc)
+        return
+    difference = scores[cases][:, None] - scores[controls][None, :]
+    expected = ((difference > 0).sum() + 0.5 * (difference == 0).sum()) / \
+        (n_cases * n_controls)
+    assert auc == pytest.approx(expected)
+
+def segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else \
+        min(1.0, max(0.0, ((px - ax) * dx + (py - ay) * dy) / length))
+    return np.hypot(px - ax - t * dx, py - ay - t * dy)
+
+@pytest.mark.parametrize("tolerance", [0.001, 0.01, 0.05])
+def test_simplify_curve_within_tolerance(tolerance):
+    rng = np.random.default_rng(0)
+    truth, scores = random_scores(rng, 3000)
+    metrics = binary_metrics(truth, scores)
+    x, y = metrics.fpr, metrics.tpr
+    kept = simplify_curve(x, y, tolerance)
+    assert kept[0] == 0 and kept[-1] == len(x) - 1
+    assert len(kept) < len(x)
+    # Every point dropped is within tolerance of the segment replacing it.
+    for start, end in zip(kept[:-1], kept[1:]):
+        for i in range(start + 1, end):
+            assert segment_distance(x[i], y[i], x[start], y[start], x[end],
+                y[end]) <= tolerance
+    assert np.array_equal(simplify_curve(x, y, 0), np.arange(len(x)))
+
+def test_score_histogram_auc_within_error():
+    rng = np.random.default_rng(0)
+    truth, scores = random_scores(rng, 5000)
+    histogram = ScoreHistogram(1, 1000)
+    # Updates in several parts, merged, as by live_eval.py.
+    other = ScoreHistogram(1, 1000)
+    histogram.update(truth[:2000, None], scores[:2000, None])
+    other.update(truth[2000:, None], scores[2000:, None])
+    histogram.merge(other)
+    exact = roc_auc_score(truth, scores)
+    assert abs(histogram.roc_auc()[0] - exact) <= histogram.auc_error()[0]
@@ -0,0 +1,100 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'scripts'))
+from subgroups import SubgroupIndex, subgroup_name
+
+"""
+Compares the bitmaps of SubgroupIndex with boolean masks computed directly
+with pandas, on random tables and random filter expressions.
+"""
+
+OPERATORS = {
+    'e': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'g': lambda column, value: column > value,
+    'l': lambda column, value: column < value,
+    'ge': lambda column, value: column >= value,
+    'le': lambda column, value: column <= value
+}
+
+def random_table(rng, n):
+    return pd.DataFrame({
+        'race': rng.integers(1, 7, n),
+        'gender': rng.integers(1, 3, n),
+        'age': rng.integers(55, 75, n),
+        'bmi': np.round(rng.normal(27, 4, n), 1)
+    })
+
+def random_term(rng, df):
+    # Returns a filter term and its reference mask.
+    column = str(rng.choice(df.columns))
+    if rng.random() < 0.2:
+        values = sorted(set(rng.choice(df[column].unique(), 2).tolist()))
+        term = f"{column}:{','.join(str(v) for v in values)}:in"
+        return term, df[column].isin(values).to_numpy()
+    op = str(rng.choice(list(OPERATORS.keys())))
+    value = rng.choice(df[column].to_numpy())
+    return f"{column}:{value}:{op}", \
+        OPERATORS[op](df[column], value).to_numpy()
+
+def random_expression(rng, df, depth=0):
+    # Returns a filter expression and its reference mask.
+    kind = rng.integers(0, 4) if depth < 3 else 0
+    if kind == 0:
+        return random_term(rng, df)
+    if kind == 1:
+        expression, mask = random_expression(rng, df, depth + 1)
+        return f"~({expression})", ~mask
+    left, left_mask = random_expression(rng, df, depth + 1)
+    right, right_mask = random_expression(rng, df, depth + 1)
+    if kind == 2:
+        return f"({left}) & ({right})", left_mask & right_mask
+    return f"({left}) | ({right})", left_mask | right_mask
+
+@pytest.mark.parametrize("seed", range(10))
+def test_evaluate_matches_pandas(seed):
+    rng = np.random.default_rng(seed)
+    # Row counts that are not multiples of 8 exercise the bitmap padding.
+    df = random_table(rng, int(rng.integers(1, 500)))
+    index = SubgroupIndex(df)
+    for _ in range(20):
+        expression, expected = random_expression(rng, df)
+        bitmap = index.evaluate(expression)
+        assert np.array_equal(index.mask(bitmap), expected), expression
+        assert index.count(bitmap) == expected.sum()
+
+def test_evaluate_all_is_conjunction():
+    rng = np.random.default_rng(0)
+    df = random_table(rng, 301)
+    index = SubgroupIndex(df)
+    expected = (df['race'] == 2).to_numpy() & (df['age'] >= 60).to_numpy()
+    bitmap = index.evaluate_all(["race:2:e", "age:60:ge"])
+    assert np.array_equal(index.mask(bitmap), expected)
+    assert np.array_equal(index.mask(index.evaluate_all([])),
+        np.ones(len(df), dtype=bool))
+
+def test_intersections_match_groupby():
+    rng = np.random.default_rng(1)
+    df = random_table(rng, 777)
+    index = SubgroupIndex(df)
+    within = index.evaluate("age:65:l")
+    subset = df[df['age'] < 65]
+    expected = subset.groupby(['race', 'gender']).size().to_dict()
+    found = {}
+    for key, bitmap in index.intersections(['race', 'gender'], within):
+        found[(key['race'], key['gender'])] = index.count(bitmap)
+        mask = index.evaluate_all(subgroup_name(key)) & within
+        assert np.array_equal(mask, bitmap)
+    assert found == expected
+
+def test_invalid_filters():
+    index = SubgroupIndex(random_table(np.random.default_rng(2), 10))
+    for expression in ["race:2", "height:2:e", "race:2:x", "(race:2:e",
+        "race:2:e &"]:
+        with pytest.raises(Exception):
+            index.evaluate(expression)